@@ -21,6 +21,7 @@ from phenoplier.commands.run.correlation.correlate import correlate
 from phenoplier.commands.run.correlation.postprocess import postprocess
 from phenoplier.commands.run.correlation.filter import filter
 from phenoplier.commands.run.correlation.generate import generate
+from phenoplier.commands.run.correlation.convert import convert
 from phenoplier.commands.util.enums import DownloadAction
 from phenoplier.commands.get import ActionMap
 from phenoplier.commands.project import to_multiplier
@@ -64,6 +65,7 @@ cmd_group_gene_corr.command()(correlate)
 cmd_group_gene_corr.command()(postprocess)
 cmd_group_gene_corr.command()(filter)
 cmd_group_gene_corr.command()(generate)
+cmd_group_gene_corr.command()(convert)
 # Add the "gene-corr" command group to the "run" command group
 cmd_group_run.add_typer(cmd_group_gene_corr, name="gene-corr")
 
@@ -25,6 +25,7 @@ def invoke_corr_preprocess(
         reference_panel:            RefPanel,
         eqtl_model:                 EqtlModel,
         output_dir:                 Path,
+        smultixcan_condition_number: int = 30,
         project_dir:                Path = conf.CURRENT_DIR,
         ) -> Tuple[int, str]:
     # @formatter:on
@@ -40,6 +41,7 @@ def invoke_corr_preprocess(
         "-s {spredixcan_folder} "
         "-n {spredixcan_file_pattern} "
         "-f {smultixcan_file} "
+        "-num {smultixcan_condition_number} "
         "-p {project_dir} "
         "-o {output_dir} "
     )
@@ -51,6 +53,7 @@ def invoke_corr_preprocess(
         spredixcan_folder=spredixcan_folder,
         spredixcan_file_pattern=spredixcan_file_pattern,
         smultixcan_file=smultixcan_file,
+        smultixcan_condition_number=smultixcan_condition_number,
         reference_panel=reference_panel,
         eqtl_model=eqtl_model,
         project_dir=project_dir,
@@ -79,6 +82,10 @@ def invoke_corr_correlate(
         input_dir:                      Path = None,
         output_dir:                     Path = None,
         project_dir:                    Path = conf.CURRENT_DIR,
+        n_shards:                       int = 1,
+        shard_index:                    int = None,
+        merge_shards:                   bool = False,
+        window_distance:                float = None,
 ) -> Tuple[int, str]:
     # @formatter:on
     """
@@ -90,10 +97,23 @@ def invoke_corr_correlate(
         "-r {reference_panel} "
         "-m {eqtl_model} "
         "-s {chromosome} "
+        "-num {smultixcan_condition_number} "
         "-i {input_dir} "
         "-p {project_dir} "
         "-o {output_dir} "
     )
+    if compute_within_distance:
+        _BASE_COMMAND += "-w "
+    if debug_mode:
+        _BASE_COMMAND += "-d "
+    if n_shards > 1:
+        _BASE_COMMAND += f"--n-shards {n_shards} "
+    if shard_index is not None:
+        _BASE_COMMAND += f"--shard-index {shard_index} "
+    if merge_shards:
+        _BASE_COMMAND += "--merge-shards "
+    if window_distance is not None:
+        _BASE_COMMAND += f"--window-distance {window_distance} "
 
     # Build the command
     command = _BASE_COMMAND.format(
@@ -178,7 +198,7 @@ def invoke_corr_filter(
         "-c {cohort} "
         "-r {reference_panel} "
         "-m {eqtl_model} "
-        "-d {distances} "
+        "{distances} "
         "-g {genes_symbols} "
         "-o {output_dir} "
         "-p {project_dir} "
@@ -189,7 +209,8 @@ def invoke_corr_filter(
         cohort=cohort,
         reference_panel=reference_panel,
         eqtl_model=eqtl_model,
-        distances=distances,
+        # the option is given once per distance
+        distances=" ".join(f"-d {d}" for d in distances),
         genes_symbols=genes_symbols,
         output_dir=output_dir,
         project_dir=project_dir,
@@ -248,6 +269,29 @@ def invoke_corr_generate(
     return success, message
 
 
+# @formatter:off
+def invoke_corr_convert(
+        input_dir:                      Path,
+        output_dir:                     Path = None,
+        remove_old_files:               bool = False,
+) -> Tuple[int, str]:
+    # @formatter:on
+    """
+    Invokes the gene-corr convert command with the given arguments.
+    """
+    command = ["run", "gene-corr", "convert", "-i", str(input_dir)]
+    if output_dir is not None:
+        command += ["-o", str(output_dir)]
+    if remove_old_files:
+        command += ["-d"]
+
+    # Execute the command using runner.invoke
+    result = runner.invoke(cli.app, command)
+    success = result.exit_code == 0
+    message = result.stdout if success else result.exc_info
+    return success, message
+
+
 def invoke_get(
         mode:           DownloadAction,
         project_dir:    Path = conf.CURRENT_DIR,
@@ -0,0 +1,61 @@
+from typing import Annotated
+from pathlib import Path
+
+from rich import print
+from tqdm import tqdm
+
+from phenoplier.gls import GLSPhenoplier
+from phenoplier.constants.arg import Corr_Convert_Args as Args
+from phenoplier.commands.run.correlation.generate import store_df, store_block
+
+
+def convert(
+        input_dir:          Annotated[Path, Args.INPUT_DIR.value],
+        output_dir:         Annotated[Path, Args.OUTPUT_DIR.value] = None,
+        remove_old_files:   Annotated[bool, Args.REMOVE_OLD_FILES.value] = False,
+):
+    """
+    Converts LV-specific correlation matrices computed by older versions of the 'generate' command (sparse matrices in
+    .npz files, or dense blocks with the correlation matrix and the inverse of its Cholesky factor in .npy files) to the
+    current format (the Cholesky factor of the block with the LV genes in .npy files, which can be memory-mapped).
+    """
+    if not input_dir.is_dir():
+        raise ValueError(f"Input dir does not exist: {input_dir}")
+
+    output_dir = input_dir if output_dir is None else output_dir
+    output_dir.mkdir(parents=True, exist_ok=True)
+    print(f"Converting files in {input_dir}. Output to {output_dir}")
+
+    old_files = sorted(
+        f for f in input_dir.glob("*.np[yz]")
+        if f.suffix == ".npz" or (f.stem not in ("metadata", "gene_names") and "_chol" not in f.stem)
+    )
+    print(f"Found {len(old_files)} files in an old format")
+
+    for old_file in tqdm(old_files, ncols=100):
+        base_filename = old_file.stem
+        if base_filename in ("metadata", "gene_names"):
+            if not (output_dir / (base_filename + ".npy")).exists():
+                data = GLSPhenoplier.load_chol_inv_data(input_dir, base_filename)
+                store_df(output_dir, data, base_filename)
+            continue
+
+        # only the correlation matrix is needed to compute the Cholesky factor;
+        # files with the inverse of the factor (and gene positions) are skipped
+        if not base_filename.endswith("_corr_mat"):
+            continue
+
+        lv_code = base_filename.removesuffix("_corr_mat")
+        if (output_dir / (lv_code + "_chol.npy")).exists():
+            # already converted
+            continue
+
+        block_chol, block_idx = GLSPhenoplier.load_chol_block(input_dir, lv_code)
+        store_block(output_dir, block_chol, block_idx, f"{lv_code}_chol")
+
+    if remove_old_files:
+        for old_file in old_files:
+            old_file.unlink()
+        print(f"Removed {len(old_files)} files in an old format")
+
+    print("Conversion done.")
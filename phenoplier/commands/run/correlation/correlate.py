@@ -7,11 +7,27 @@ from pathlib import Path
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from tqdm import tqdm
 from rich.text import Text
 
 from phenoplier.config import settings as conf
 from phenoplier.entity import Gene
+from phenoplier.gene_svd_cache import GeneSvdCache
+from phenoplier.variant_set import VariantSet
+from phenoplier.whitening import CholeskyWhitener
+from phenoplier.ssm_correlations import (
+    get_gene_ssm_projection,
+    get_ssm_projection_from_svd,
+    get_gene_n_snps,
+    compute_ssm_correlations,
+    get_correlation_shards,
+    compute_ssm_correlations_blocks,
+    compute_ssm_correlations_window,
+    merge_ssm_correlations_blocks,
+    get_genes_within_distance,
+    get_gene_pairs_within_distance,
+)
 from phenoplier.commands.util.utils import load_settings_files, load_pickle_or_gz_pickle
 from phenoplier.commands.util.enums import Cohort, RefPanel, EqtlModel
 from phenoplier.constants.arg import Corr_Correlate_Args as Args
@@ -19,6 +35,161 @@ from phenoplier.constants.arg import Corr_Correlate_Args as Args
 logger = logging.getLogger(__name__)
 
 
+def _get_shard_filename(chromosome: int, shard_index: int, n_shards: int) -> str:
+    return f"gene_corrs-chr{chromosome}-shard{shard_index}_of_{n_shards}.pkl"
+
+
+def _compute_correlations(
+        gene_chr_objs: list,
+        genes_needed: set,
+        spredixcan_genes_models: pd.DataFrame,
+        gwas_variants_ids_set: VariantSet,
+        reference_panel: str,
+        eqtl_model: str,
+        chromosome: int,
+        smultixcan_condition_number: int,
+        debug_mode: bool,
+        blocks: list = None,
+        block_pairs: list = None,
+        window: tuple = None,
+        genes_svd: dict = None,
+):
+    """
+    Computes the SSM projection of each gene (from the SVD of its tissues correlations), and then the correlations
+    of all pairs of genes at once (or only those in some pairs of gene blocks, if block_pairs is given, or only those
+    within a distance, if window is given as a tuple with genes start and end positions and the distance in bp).
+    Genes not in genes_needed (if given) are skipped. Projections are computed from the SVDs in genes_svd (see
+    GeneSvdCache) for the genes in it.
+
+    Returns:
+        A tuple with the correlation matrix (a dictionary with the correlations of each pair of blocks, see
+        compute_ssm_correlations_blocks, or a sparse matrix if window is given) and a list with the positions of genes
+        that failed (only in debug mode).
+    """
+    gene_projections = []
+    failed_genes = []
+    for gene_idx, gene_obj in enumerate(tqdm(gene_chr_objs, ncols=100)):
+        if genes_needed is not None and gene_idx not in genes_needed:
+            gene_projections.append(None)
+            continue
+
+        if genes_svd is not None and gene_obj.ensembl_id in genes_svd:
+            gene_svd = genes_svd[gene_obj.ensembl_id]
+            gene_projections.append(
+                None if gene_svd is None else get_ssm_projection_from_svd(gene_svd, smultixcan_condition_number)
+            )
+            continue
+
+        gene_tissues = spredixcan_genes_models.loc[gene_obj.ensembl_id, "tissue"]
+
+        try:
+            # if the projection is None, it's very likely because:
+            #  * the gene has no prediction models
+            #  * all the SNPs predictors for the gene are not present in the reference panel
+            # and its correlations with other genes are zero
+            gene_projections.append(
+                get_gene_ssm_projection(
+                    gene_obj,
+                    tissues=gene_tissues,
+                    snps_subset=gwas_variants_ids_set,
+                    reference_panel=reference_panel,
+                    model_type=eqtl_model,
+                    condition_number=smultixcan_condition_number,
+                )
+            )
+
+        except Warning as e:
+            if not debug_mode:
+                raise e
+            print(f"RuntimeWarning for gene {gene_obj.ensembl_id}")
+            print(traceback.format_exc())
+            gene_projections.append(None)
+            failed_genes.append(gene_idx)
+
+        except Exception as e:
+            if not debug_mode:
+                raise e
+            print(f"Exception for gene {gene_obj.ensembl_id}")
+            print(traceback.format_exc())
+            gene_projections.append(None)
+            failed_genes.append(gene_idx)
+
+    snps_cov, _ = Gene._read_snps_cov(f"chr{chromosome}", reference_panel, eqtl_model)
+    if block_pairs is not None:
+        return compute_ssm_correlations_blocks(gene_projections, snps_cov, blocks, block_pairs), failed_genes
+    if window is not None:
+        return compute_ssm_correlations_window(gene_projections, snps_cov, *window), failed_genes
+
+    return compute_ssm_correlations(gene_projections, snps_cov), failed_genes
+
+
+def _merge_shard_files(shards_dir: Path, chromosome: int, n_shards: int, gene_ids: list, blocks: list):
+    """
+    Reads the files of all shards of a chromosome, and returns the correlation matrix and the positions of genes
+    that failed in any shard.
+    """
+    blocks_data = {}
+    failed_genes = set()
+    for shard_index in range(n_shards):
+        shard_file = shards_dir / _get_shard_filename(chromosome, shard_index, n_shards)
+        if not shard_file.exists():
+            raise FileNotFoundError(f"Shard file not found: {shard_file}")
+
+        shard_data = pd.read_pickle(shard_file)
+        if shard_data["genes"] != gene_ids or shard_data["blocks"] != blocks:
+            raise ValueError(f"Shard was computed with different genes: {shard_file}")
+
+        blocks_data.update(shard_data["blocks_data"])
+        failed_genes.update(shard_data["failed_genes"])
+
+    return merge_ssm_correlations_blocks(blocks, blocks_data), sorted(failed_genes)
+
+
+def _store_window_correlations(
+        gene_corrs_data: sparse.csr_matrix,
+        failed_genes: list,
+        gene_chr_objs: list,
+        gene_chr_ids: list,
+        compute_within_distance: bool,
+        output_file: Path,
+):
+    """
+    Checks and stores the correlations of genes within a window (see compute_ssm_correlations_window) as a sparse data
+    frame, without building the dense matrix of the chromosome: gene pairs outside the window were not computed, so
+    they are not stored. Positive definiteness is not checked here, since it needs the dense matrix; 'postprocess'
+    checks (and adjusts) the matrix of each chromosome.
+    """
+    print(f"Number of nonzero correlations within window: {gene_corrs_data.nnz}")
+
+    if compute_within_distance:
+        gene_corrs_data = gene_corrs_data.tocoo()
+        in_distance = get_gene_pairs_within_distance(gene_chr_objs, gene_corrs_data.row, gene_corrs_data.col)
+        gene_corrs_data = sparse.csr_matrix(
+            (gene_corrs_data.data[in_distance], (gene_corrs_data.row[in_distance], gene_corrs_data.col[in_distance])),
+            shape=gene_corrs_data.shape,
+        )
+
+    # Standard checks and stats
+    if len(failed_genes) > 0 or np.isnan(gene_corrs_data.data).any():
+        raise ValueError("There are NaN values in the gene_corrs_df")
+    _min_val = gene_corrs_data.data.min(initial=0.0)
+    if not _min_val >= -0.05:
+        raise ValueError(f"Minimum value in gene_corrs_df is {_min_val}, expected at least -0.05")
+    _max_val = gene_corrs_data.data.max(initial=0.0)  # this captures the diagonal
+    if not _max_val <= 1.05:
+        raise ValueError(f"Maximum value in gene_corrs_df is {_max_val}, expected at most 1.05")
+
+    gene_corrs_flat = pd.Series(sparse.triu(gene_corrs_data).tocoo().data)
+    print(f"Descriptive statistics of correlations within window: {os.linesep} {gene_corrs_flat.describe()}")
+    gene_corrs_quantiles = gene_corrs_flat.quantile(np.arange(0, 1, 0.05))
+    print(f"Quantiles of correlations within window: {os.linesep} {gene_corrs_quantiles}")
+
+    # Output
+    gene_corrs_df = pd.DataFrame.sparse.from_spmatrix(gene_corrs_data, index=gene_chr_ids, columns=gene_chr_ids)
+    gene_corrs_df.to_pickle(output_file)
+    print(f"Shape of gene_corrs_df: {gene_corrs_df.shape}")
+
+
 def correlate(
         cohort: Annotated[Cohort, Args.COHORT_NAME.value],
         reference_panel: Annotated[RefPanel, Args.REFERENCE_PANEL.value],
@@ -30,9 +201,17 @@ def correlate(
         input_dir: Annotated[Path, Args.INPUT_DIR.value] = None,
         output_dir: Annotated[Path, Args.OUTPUT_DIR.value] = None,
         project_dir: Annotated[Path, Args.PROJECT_DIR.value] = conf.CURRENT_DIR,
+        n_shards: Annotated[int, Args.N_SHARDS.value] = 1,
+        shard_index: Annotated[int, Args.SHARD_INDEX.value] = None,
+        merge_shards: Annotated[bool, Args.MERGE_SHARDS.value] = False,
+        window_distance: Annotated[float, Args.WINDOW_DISTANCE.value] = None,
 ):
     """
     Computes predicted expression correlations between all genes in the MultiPLIER models.
+
+    The gene pairs of a chromosome can be split into shards (--n-shards and --shard-index) computed independently;
+    then, running the command again with --merge-shards writes the correlation matrix of the chromosome. With
+    --window-distance, only gene pairs within that distance are computed (and stored).
     """
 
     load_settings_files(project_dir)
@@ -43,6 +222,14 @@ def correlate(
     if not 1 <= chromosome <= 22:
         raise ValueError("Chromosome number must be between 1 and 22")
 
+    sharded = n_shards > 1 and not merge_shards
+    if sharded and (shard_index is None or not 0 <= shard_index < n_shards):
+        raise ValueError(f"Shard index must be between 0 and {n_shards - 1}")
+    if merge_shards and n_shards == 1:
+        raise ValueError("The number of shards to merge must be given")
+    if window_distance is not None and n_shards > 1:
+        raise ValueError("Shards cannot be used with a window distance")
+
     cohort = cohort.lower()
     eqtl_model_files_prefix = conf.TWAS["PREDICTION_MODELS"][f"{eqtl_model}_PREFIX"]
 
@@ -52,6 +239,12 @@ def correlate(
     logger.info(f"eQTL model: {eqtl_model}) / {eqtl_model_files_prefix}")
     logger.info(f"Chromosome: {chromosome}")
     logger.info(f"S-MultiXcan condition number: {smultixcan_condition_number}")
+    if sharded:
+        logger.info(f"Shard: {shard_index} of {n_shards}")
+    elif merge_shards:
+        logger.info(f"Merging {n_shards} shards")
+    if window_distance is not None:
+        logger.info(f"Compute correlations within a window of {window_distance} mb only")
     if compute_within_distance:
         logger.info("Compute correlations within distance")
 
@@ -71,17 +264,21 @@ def correlate(
 
     # Load previous matrix generation pipeline results
     pre_results_dir = output_dir_base if not input_dir else input_dir
-    input_file = Path(pre_results_dir) / "gwas_variant_ids.pkl"
-    if not input_file.exists():
-        input_file = Path(pre_results_dir) / "gwas_variant_ids.pkl.gz"
-    if not input_file.exists():
-        err_msg = f"Input file not found: {input_file}"
-        logger.exception(err_msg)
-        raise FileNotFoundError(err_msg)
-
-    gwas_variants_ids_set = load_pickle_or_gz_pickle(input_file)
-    print(f"Length of input gwas_variant_ids.pkl file: {len(gwas_variants_ids_set)}")
-    print(f"First 5 elements of input gwas_variant_ids.pkl file: {list(gwas_variants_ids_set)[:5]}")
+    input_file = Path(pre_results_dir) / "gwas_variant_ids.npy"
+    if input_file.exists():
+        gwas_variants_ids_set = VariantSet.load(input_file)
+    else:
+        # results of older versions of 'preprocess' only have the pickled set of IDs
+        input_file = Path(pre_results_dir) / "gwas_variant_ids.pkl"
+        if not input_file.exists():
+            input_file = Path(pre_results_dir) / "gwas_variant_ids.pkl.gz"
+        if not input_file.exists():
+            err_msg = f"Input file not found: {input_file}"
+            logger.exception(err_msg)
+            raise FileNotFoundError(err_msg)
+
+        gwas_variants_ids_set = VariantSet.from_ids(load_pickle_or_gz_pickle(input_file))
+    print(f"Number of GWAS variants in {input_file.name}: {len(gwas_variants_ids_set)}")
 
     spredixcan_genes_models = pd.read_pickle(pre_results_dir / "gene_tissues.pkl")
     print(f"Shape of input gene_tissues.pkl file: {spredixcan_genes_models.shape}")
@@ -117,60 +314,94 @@ def correlate(
     n_comb = n + int(n * (n - 1) / 2.0)
     print(f"Number of gene combinations: {n_comb}")
 
-    gene_corrs = []
-    gene_corrs_data = np.full((n, n), np.nan, dtype=np.float64)
-
-    with tqdm(ncols=100, total=n_comb) as pbar:
-        for gene1_idx in range(0, len(gene_chr_objs)):
-            gene1_obj = gene_chr_objs[gene1_idx]
-            gene1_tissues = spredixcan_genes_models.loc[gene1_obj.ensembl_id, "tissue"]
-
-            for gene2_idx in range(gene1_idx, len(gene_chr_objs)):
-                gene2_obj = gene_chr_objs[gene2_idx]
-                gene2_tissues = spredixcan_genes_models.loc[gene2_obj.ensembl_id, "tissue"]
-
-                pbar.set_description(f"{gene1_obj.ensembl_id} / {gene2_obj.ensembl_id}")
-
-                try:
-                    r = gene1_obj.get_ssm_correlation(
-                        other_gene=gene2_obj,
-                        tissues=gene1_tissues,
-                        other_tissues=gene2_tissues,
-                        snps_subset=gwas_variants_ids_set,
-                        condition_number=smultixcan_condition_number,
-                        reference_panel=reference_panel,
-                        model_type=eqtl_model,
-                        use_within_distance=compute_within_distance,
-                    )
-
-                    if r is None:
-                        # if r is None, it's very likely because:
-                        #  * one of the genes has no prediction models
-                        #  * all the SNPs predictors for the gene are not present in the reference panel
-                        r = 0.0
-
-                    gene_corrs.append(r)
-                    gene_corrs_data[gene1_idx, gene2_idx] = r
-                    gene_corrs_data[gene2_idx, gene1_idx] = r
-
-                except Warning as e:
-                    if not debug_mode:
-                        raise e
-                    print(f"RuntimeWarning for genes {gene1_obj.ensembl_id} and {gene2_obj.ensembl_id}")
-                    print(traceback.format_exc())
-                    gene_corrs.append(np.nan)
-
-                except Exception as e:
-                    if not debug_mode:
-                        raise e
-                    print(f"Exception for genes {gene1_obj.ensembl_id} and {gene2_obj.ensembl_id}",)
-                    print(traceback.format_exc())
-                    gene_corrs.append(np.nan)
-
-                pbar.update(1)
+    gene_chr_ids = [g.ensembl_id for g in gene_chr_objs]
+    shards_dir = output_dir / "shards"
+
+    # SVDs of genes computed by 'preprocess' with the same SNPs, reference panel, prediction model and condition
+    # number (if any)
+    genes_svd = GeneSvdCache(
+        pre_results_dir / GeneSvdCache.FOLDER, gwas_variants_ids_set, reference_panel, eqtl_model,
+        smultixcan_condition_number,
+    ).load(chromosome)
+    print(f"Number of genes with SVD computed by 'preprocess': {len(genes_svd)}")
+
+    # gene pairs are split into shards by blocks of genes, balanced by their number of SNPs
+    blocks, shards = None, None
+    if n_shards > 1:
+        genes_n_snps = [
+            get_gene_n_snps(
+                gene_obj,
+                tissues=spredixcan_genes_models.loc[gene_obj.ensembl_id, "tissue"],
+                snps_subset=gwas_variants_ids_set,
+                model_type=eqtl_model,
+            )
+            for gene_obj in gene_chr_objs
+        ]
+        blocks, shards = get_correlation_shards(genes_n_snps, n_shards)
+
+    if merge_shards:
+        gene_corrs_data, failed_genes = _merge_shard_files(shards_dir, chromosome, n_shards, gene_chr_ids, blocks)
+        print(f"Merged {n_shards} shards from {shards_dir}")
+    else:
+        # only the genes in the blocks of the shard are needed
+        genes_needed = None
+        if sharded:
+            genes_needed = {
+                gene_idx
+                for pair in shards[shard_index]
+                for block_idx in pair
+                for gene_idx in range(*blocks[block_idx])
+            }
+            print(f"Number of pairs of gene blocks in shard: {len(shards[shard_index])}")
+
+        gene_corrs_data, failed_genes = _compute_correlations(
+            gene_chr_objs,
+            genes_needed,
+            spredixcan_genes_models,
+            gwas_variants_ids_set,
+            reference_panel,
+            eqtl_model,
+            chromosome,
+            smultixcan_condition_number,
+            debug_mode,
+            blocks=blocks,
+            block_pairs=shards[shard_index] if sharded else None,
+            # as in 'filter', the distance is the full window around each gene
+            window=(
+                genes_chr["start_position"].to_numpy(),
+                genes_chr["end_position"].to_numpy(),
+                window_distance / 2.0 * 1e6,
+            ) if window_distance is not None else None,
+            genes_svd=genes_svd,
+        )
+        if window_distance is not None:
+            _store_window_correlations(
+                gene_corrs_data, failed_genes, gene_chr_objs, gene_chr_ids, compute_within_distance, output_file
+            )
+            return
+
+        if sharded:
+            shards_dir.mkdir(exist_ok=True, parents=True)
+            shard_file = shards_dir / _get_shard_filename(chromosome, shard_index, n_shards)
+            pd.to_pickle(
+                {
+                    "genes": gene_chr_ids,
+                    "blocks": blocks,
+                    "blocks_data": gene_corrs_data,
+                    "failed_genes": failed_genes,
+                },
+                shard_file,
+            )
+            print(f"Shard {shard_index} of {n_shards} written to {shard_file}")
+            return
+
+    if compute_within_distance:
+        gene_corrs_data[~get_genes_within_distance(gene_chr_objs)] = 0.0
+    gene_corrs_data[failed_genes, :] = np.nan
+    gene_corrs_data[:, failed_genes] = np.nan
+    gene_corrs = gene_corrs_data[np.triu_indices(n)]
 
     gene_corrs_flat = pd.Series(gene_corrs)
-    gene_chr_ids = [g.ensembl_id for g in gene_chr_objs]
     gene_corrs_df = pd.DataFrame(
         data=gene_corrs_data,
         index=gene_chr_ids,
@@ -205,8 +436,7 @@ def correlate(
 
     # Ad-hoc tests
     try:
-        chol_mat = np.linalg.cholesky(gene_corrs_df.to_numpy())
-        cov_inv = np.linalg.inv(chol_mat)
+        CholeskyWhitener.from_corr_matrix(gene_corrs_df.to_numpy())
         # logger.info("Works!")
     except Exception as e:
         logger.info(f"Cholesky decomposition failed: {str(e)}")
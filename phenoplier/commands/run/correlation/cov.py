@@ -1,17 +1,23 @@
 import gc
-import sqlite3
+import shutil
+import multiprocessing
+import concurrent.futures
 from pathlib import Path
 from typing import Annotated
 
 import pandas as pd
 import numpy as np
 import typer
+import fastparquet
+import tables
+from scipy.linalg import blas
 from tqdm import tqdm
 from rich import print
 import os
 
 from phenoplier.config import settings as conf
 from phenoplier.entity import Gene
+from phenoplier.prediction_weights import PredictionWeightsIndex
 from phenoplier.commands.util.utils import load_settings_files
 from phenoplier.commands.util.enums import MatrixDtype, RefPanel, EqtlModel
 from phenoplier.constants.arg import Corr_Cov_Args as Args
@@ -26,21 +32,272 @@ def get_reference_panel_file(directory: Path, file_pattern: str) -> Path:
     return files[0]
 
 
-def covariance(df, dtype):
-    n = df.shape[0]
-    df = df.sub(df.mean(), axis=1).astype(dtype)
-    return df.T.dot(df) / (n - 1)
+class CovarianceAccumulator(object):
+    """
+    Computes the covariance matrix of variables from batches of samples (rows),
+    so the whole data matrix is never in memory.
+
+    Each batch is shifted by the mean of the first one (to keep the sums of
+    products small and numerically stable), and its sums and cross-products are
+    accumulated in a numpy array with the given dtype. For float32 and float64,
+    cross-products are updated in place with BLAS (syrk), which only computes
+    the upper triangle.
+
+    Args:
+        n_variables:
+            Number of variables (columns of the batches).
+        dtype:
+            The numpy dtype of the covariance matrix.
+    """
+
+    BLOCK_SIZE = 4096
+
+    def __init__(self, n_variables: int, dtype=np.float64):
+        self.dtype = np.dtype(dtype)
+        self.n = 0
+        self.shift = None
+        self.sums = np.zeros(n_variables, dtype=np.float64)
+        self.cross_products = np.zeros((n_variables, n_variables), dtype=self.dtype, order="F")
+
+    def update(self, batch: np.ndarray):
+        """
+        Adds a batch of samples (an array with one row per sample).
+        """
+        batch = np.asarray(batch, dtype=np.float64)
+        if batch.shape[0] == 0:
+            return
+
+        if self.shift is None:
+            self.shift = batch.mean(axis=0)
+
+        batch = batch - self.shift
+        self.n += batch.shape[0]
+        self.sums += batch.sum(axis=0)
+
+        batch = batch.astype(self.dtype, copy=False)
+        if self.dtype == np.float64:
+            blas.dsyrk(1.0, batch, beta=1.0, c=self.cross_products, trans=1, overwrite_c=1)
+        elif self.dtype == np.float32:
+            blas.ssyrk(1.0, batch, beta=1.0, c=self.cross_products, trans=1, overwrite_c=1)
+        else:
+            self.cross_products += np.triu(batch.T @ batch)
+
+    def get_covariance(self) -> np.ndarray:
+        """
+        Returns the covariance matrix of all samples added. The accumulated
+        cross-products are used as its storage, so no more samples can be
+        added after this.
+        """
+        if self.n < 2:
+            raise ValueError(f"At least two samples are needed to compute the covariance, but {self.n} were added")
+
+        n_variables = self.sums.shape[0]
+        cov = self.cross_products
+        self.cross_products = None
+
+        # blocks of rows, so the outer product of the sums is never computed at once
+        for i in range(0, n_variables, CovarianceAccumulator.BLOCK_SIZE):
+            block = slice(i, i + CovarianceAccumulator.BLOCK_SIZE)
+            cov[block, i:] -= (np.outer(self.sums[block], self.sums[i:]) / self.n).astype(self.dtype)
+            cov[block, i:] /= self.n - 1
+            # copy the upper triangle of these rows to the lower one
+            cov[i:, block] = np.triu(cov[block, i:]).T + np.triu(cov[i:, block], k=1)
+
+        return cov
+
+
+def covariance(df, dtype, batch_size: int = None):
+    """
+    Returns the covariance matrix of the columns of a data frame, computed with
+    batches of batch_size rows (all rows at once if not given).
+    """
+    if df.shape[0] == 0:
+        raise ValueError("The data frame has no rows")
+
+    batch_size = batch_size or df.shape[0]
+    acc = CovarianceAccumulator(df.shape[1], dtype)
+    for i in range(0, df.shape[0], batch_size):
+        acc.update(df.iloc[i: i + batch_size].to_numpy(dtype=np.float64))
+
+    return pd.DataFrame(acc.get_covariance(), index=df.columns, columns=df.columns, copy=False)
+
+
+def iter_genotypes_batches(chromosome_file: Path, snps_ids: list, batch_size: int):
+    """
+    Reads the genotypes of some SNPs from a reference panel file, one row group
+    at a time, and yields arrays with at most batch_size samples (rows).
+    """
+    pf = fastparquet.ParquetFile(chromosome_file)
+    for row_group in pf.iter_row_groups(columns=snps_ids):
+        genotypes = row_group[snps_ids].to_numpy(dtype=np.float64)
+        for i in range(0, genotypes.shape[0], batch_size):
+            yield genotypes[i: i + batch_size]
 
 
-def compute_snps_cov(snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype):
+def compute_snps_cov(snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size=1000):
+    """
+    Computes the covariance of the SNPs in snps_df (all in the same chromosome)
+    that have genotypes in the reference panel. Genotypes are read and
+    accumulated in batches of at most batch_size samples (see
+    CovarianceAccumulator), so the memory used is the covariance matrix
+    (with dtype cov_dtype) plus one row group of the reference panel file.
+    """
     assert snps_df["chr"].unique().shape[0] == 1
     chromosome = snps_df["chr"].unique()[0]
 
     snps_ids = list(set(snps_df["varID"]).intersection(variants_ids_with_genotype))
     chromosome_file = get_reference_panel_file(reference_panel_dir, f"chr{chromosome}.variants")
-    snps_genotypes = pd.read_parquet(chromosome_file, columns=snps_ids)
 
-    return covariance(snps_genotypes, cov_dtype)
+    acc = CovarianceAccumulator(len(snps_ids), cov_dtype)
+    for batch in iter_genotypes_batches(chromosome_file, snps_ids, batch_size):
+        acc.update(batch)
+
+    return pd.DataFrame(acc.get_covariance(), index=snps_ids, columns=snps_ids, copy=False)
+
+
+def read_ld_regions(ld_regions_file: Path) -> pd.DataFrame:
+    """
+    Reads a BED file with LD regions (such as eur_ld.bed.gz), and returns a
+    data frame with columns "chr" (as an integer), "start" and "stop", sorted by
+    chromosome and start. Regions in other chromosomes (such as X) are removed.
+    """
+    regions = pd.read_csv(
+        ld_regions_file, sep=r"\s+", header=None, usecols=[0, 1, 2], names=["chr", "start", "stop"], dtype=str
+    )
+    regions = regions.assign(
+        chr=pd.to_numeric(regions["chr"].str.removeprefix("chr"), errors="coerce"),
+        start=pd.to_numeric(regions["start"], errors="coerce"),
+        stop=pd.to_numeric(regions["stop"], errors="coerce"),
+    ).dropna()  # header and other chromosomes
+
+    return regions.astype(int).sort_values(["chr", "start"]).reset_index(drop=True)
+
+
+def get_snps_ld_blocks(positions, chr_ld_regions: pd.DataFrame) -> np.ndarray:
+    """
+    Returns the LD region (its index in chr_ld_regions, the regions of one
+    chromosome sorted by start) of SNPs given their positions (1-based, as in
+    variant IDs). SNPs between two regions are assigned to the previous one, and
+    SNPs before the first region get -1.
+    """
+    starts = chr_ld_regions["start"].to_numpy()
+    # BED regions are 0-based
+    return np.searchsorted(starts, np.asarray(positions) - 1, side="right") - 1
+
+
+def compute_snps_cov_ld_blocks(
+        snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, ld_regions, batch_size=1000
+):
+    """
+    Like compute_snps_cov, but it only computes covariances between SNPs in the
+    same LD region (see read_ld_regions). It returns a data frame with SNP IDs as
+    index and their LD block number in column "block" (ordered by block and
+    position, as rows of the block's matrix), and a flat numpy array with the
+    covariance matrices of the blocks, one after the other (see
+    phenoplier.snps_cov_store.BlockDiagonalCov).
+    """
+    assert snps_df["chr"].unique().shape[0] == 1
+    chromosome = snps_df["chr"].unique()[0]
+
+    snps_df = snps_df[snps_df["varID"].isin(variants_ids_with_genotype)].drop_duplicates("varID")
+    snps_df = snps_df.assign(
+        block=get_snps_ld_blocks(snps_df["position"], ld_regions[ld_regions["chr"] == chromosome])
+    ).sort_values(["block", "position", "varID"])
+    snps_ids = snps_df["varID"].tolist()
+    snps_blocks = pd.factorize(snps_df["block"])[0]
+
+    blocks_bounds = np.flatnonzero(np.diff(snps_blocks, prepend=-1, append=-1))
+    blocks_slices = [slice(s, e) for s, e in zip(blocks_bounds[:-1], blocks_bounds[1:])]
+    chromosome_file = get_reference_panel_file(reference_panel_dir, f"chr{chromosome}.variants")
+
+    accs = [CovarianceAccumulator(b.stop - b.start, cov_dtype) for b in blocks_slices]
+    for batch in iter_genotypes_batches(chromosome_file, snps_ids, batch_size):
+        for acc, block in zip(accs, blocks_slices):
+            acc.update(batch[:, block])
+
+    blocks_cov = np.concatenate([np.array([], dtype=cov_dtype)] + [acc.get_covariance().ravel() for acc in accs])
+    return pd.DataFrame({"block": snps_blocks}, index=pd.Index(snps_ids, name="varID")), blocks_cov
+
+
+def compute_chr_cov(
+        snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size=1000, ld_regions=None
+) -> dict:
+    """
+    Computes the covariance of the SNPs of a chromosome, and returns a
+    dictionary with the keys and data frames to store in the output HDF5 file:
+    "chr{num}" with the whole covariance matrix, or, if LD regions are given,
+    "chr{num}_blocks" and "chr{num}_blocks_cov" (see compute_snps_cov_ld_blocks).
+    """
+    chromosome = snps_df["chr"].unique()[0]
+    if ld_regions is None:
+        return {
+            f"chr{chromosome}": compute_snps_cov(
+                snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size
+            )
+        }
+
+    snps_blocks, blocks_cov = compute_snps_cov_ld_blocks(
+        snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, ld_regions, batch_size
+    )
+    return {f"chr{chromosome}_blocks": snps_blocks, f"chr{chromosome}_blocks_cov": pd.Series(blocks_cov)}
+
+
+def check_chr_cov(chr_cov: dict, n_expected: int):
+    """
+    Checks that the covariance of a chromosome (see compute_chr_cov) has the
+    expected number of SNPs and no NA values.
+    """
+    snps_data = next(iter(chr_cov.values()))
+    expected_shape = (n_expected, 1) if "block" in snps_data.columns else (n_expected, n_expected)
+    if not snps_data.shape == expected_shape:
+        raise ValueError("Unexpected shape")
+    if any(data.isna().to_numpy().any() for data in chr_cov.values()):
+        raise ValueError("Unexpected NA values")
+
+
+def compute_chr_cov_shard(
+        snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size, ld_regions, shard_file
+) -> Path:
+    """
+    Computes the covariance of the SNPs of a chromosome (see compute_chr_cov)
+    and writes it to its own HDF5 file (a shard), so chromosomes can be computed
+    by different processes. The file is written with a temporary name first, so
+    an interrupted process does not leave a partial shard.
+    """
+    chr_cov = compute_chr_cov(snps_df, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size, ld_regions)
+
+    shard_file = Path(shard_file)
+    tmp_file = shard_file.with_suffix(f".{os.getpid()}.tmp")
+    with pd.HDFStore(tmp_file, mode="w", complevel=4) as store:
+        for key, data in chr_cov.items():
+            assert not data.isna().to_numpy().any()
+            store[key] = data
+    os.replace(tmp_file, shard_file)
+
+    return shard_file
+
+
+def append_chr_cov_shard(output_file: Path, shard_file: Path):
+    """
+    Appends the data of a shard (see compute_chr_cov_shard) to the output HDF5
+    file, and removes the shard. The HDF5 nodes are copied with PyTables, so the
+    covariance matrices are never loaded in memory as data frames.
+    """
+    with tables.open_file(shard_file, mode="r") as shard, tables.open_file(output_file, mode="a") as output:
+        for node in shard.iter_nodes("/"):
+            shard.copy_node(node, newparent=output.root, recursive=True)
+    Path(shard_file).unlink()
+
+
+def get_chromosomes_by_size(variants_df: pd.DataFrame, variants_ids_with_genotype: set) -> list:
+    """
+    Returns the chromosomes sorted by their number of SNPs with genotypes
+    (largest first), so the largest covariance matrices are computed first and
+    the worker processes are kept busy until the end.
+    """
+    n_snps = variants_df[variants_df["varID"].isin(variants_ids_with_genotype)].groupby("chr")["varID"].nunique()
+    n_snps = n_snps.reindex(variants_df["chr"].unique(), fill_value=0)
+    return n_snps.sort_values(ascending=False, kind="stable").index.tolist()
 
 
 def cov(
@@ -48,11 +305,24 @@ def cov(
         eqtl_model:                 Annotated[EqtlModel, Args.EQTL_MODEL.value],
         multiplier_matrix_z:        Annotated[Path, Args.MULTIPLIER_Z.value] = None,
         covariance_matrix_dtype:    Annotated[MatrixDtype, Args.COVARIANCE_MATRIX_DTYPE.value] = MatrixDtype.f64,
+        batch_size:                 Annotated[int, Args.BATCH_SIZE.value] = 1000,
+        ld_blocks:                  Annotated[bool, Args.LD_BLOCKS.value] = False,
+        ld_regions_file:            Annotated[Path, Args.LD_REGIONS_FILE.value] = None,
+        n_jobs:                     Annotated[int, Args.N_JOBS.value] = 1,
         project_dir:                Annotated[Path, Args.PROJECT_DIR.value] = conf.CURRENT_DIR,
         output_dir:                 Annotated[Path, Args.OUTPUT_DIR.value] = None,
 ):
     """
     Computes the covariance for each chromosome of all variants present in prediction models.
+
+    Genotypes are read one row group at a time, and sums and cross-products are accumulated in batches of samples
+    (see --batch-size), so the genotypes of a whole chromosome are never in memory.
+
+    With --ld-blocks, only covariances between SNPs in the same LD region are computed and stored (SNPs in different
+    regions are assumed to be independent), which makes the output file orders of magnitude smaller.
+
+    With --n-jobs, chromosomes are computed in parallel processes (largest first), each one writing a shard file that
+    is appended to the output file as soon as it is finished.
     """
     # Check project directory
     load_settings_files(project_dir)
@@ -91,30 +361,25 @@ def cov(
     cov_dtype = cov_dtype_dict.get(covariance_matrix_dtype, np.float64)
     print(f"Covariance matrix dtype used: {str(cov_dtype)}")
 
-    mashr_models_db_files = list(Path(conf.TWAS["PREDICTION_MODELS"][eqtl_model]).glob("*.db"))
+    ld_regions = None
+    if ld_blocks:
+        ld_regions_file = ld_regions_file or Path(conf.GENERAL["EUR_LD_REGIONS_FILE"])
+        if not Path(ld_regions_file).exists():
+            raise typer.BadParameter(f"LD regions file does not exist: {str(ld_regions_file)}")
+        ld_regions = read_ld_regions(ld_regions_file)
+        print(f"Using {ld_regions.shape[0]} LD regions from: {ld_regions_file}")
+
+    # Get SNPs in predictions models (the index is saved in the cache directory and shared with other commands)
+    weights_index = PredictionWeightsIndex.get(eqtl_model)
     # Check number of MASHR models
     NUM_MAX_FILES = 49
-    if len(mashr_models_db_files) != NUM_MAX_FILES:
-        raise ValueError(f"Number of MASHR models is not {NUM_MAX_FILES}: {len(mashr_models_db_files)}")
-    
-    # Gett SNPs in predictions models
-    all_variants_ids = []
-
-    for m in mashr_models_db_files:
-        print(f"Processing {m.name}")
-        tissue = m.name.split(eqtl_model_files_prefix)[1].split(".db")[0]
-
-        with sqlite3.connect(m) as conn:
-            df = pd.read_sql("select gene, varID from weights", conn)
-            df["gene"] = df["gene"].apply(lambda x: x.split(".")[0])
-            df = df.assign(tissue=tissue)
+    if len(weights_index.tissues) != NUM_MAX_FILES:
+        raise ValueError(f"Number of MASHR models is not {NUM_MAX_FILES}: {len(weights_index.tissues)}")
 
-            all_variants_ids.append(df)
-
-    all_gene_snps = pd.concat(all_variants_ids, ignore_index=True)
+    all_gene_snps = weights_index.get_inventory()[["gene", "varID", "tissue"]]
     print(f"Gene SNPs shape:{os.linesep}{all_gene_snps.shape}")
     print(f"First 5 rows of gene SNPs:{os.linesep}{all_gene_snps.head()}")
-    all_snps_in_models = set(all_gene_snps["varID"].unique())
+    all_snps_in_models = set(weights_index.variants.tolist())
 
     # MultiPLIER Z
     matrix_z_path = multiplier_matrix_z or conf.GENE_MODULE_MODEL["MODEL_Z_MATRIX_FILE"]
@@ -155,37 +420,17 @@ def cov(
     print(f"Keeping only genes in MultiPLIER Z model:{os.linesep}{all_gene_snps.shape}")
 
     # (For MultiPLIER genes): How many variants in predictions models are present in the reference panel?
-    all_snps_in_models_multiplier = set(all_gene_snps["varID"])
+    multiplier_variant_codes = np.unique(all_gene_snps["varID"].cat.codes.to_numpy())
+    all_snps_in_models_multiplier = set(weights_index.variants[multiplier_variant_codes].tolist())
     n_snps_in_models = len(all_snps_in_models_multiplier)
     n_snps_in_ref_panel = len(all_snps_in_models_multiplier.intersection(variants_ids_with_genotype))
     print(f"Number of SNPs in models (MultiPLIER genes): {n_snps_in_models}")
     print(f"Number of SNPs in reference panel (MultiPLIER genes): {n_snps_in_ref_panel}")
     print(f"Fraction of SNPs in reference panel (MultiPLIER genes): {n_snps_in_ref_panel / n_snps_in_models}")
 
-    # Preprocess SNPs data
-    variants_ld_block_df = all_gene_snps[["varID"]].drop_duplicates()
-    variants_info = variants_ld_block_df["varID"].str.split("_", expand=True)
-    print(f"Variants info (raw) shape:{os.linesep}{variants_info.shape}")
-    # validate data
-    if not variants_ld_block_df.shape[0] == variants_info.shape[0]:
-        raise ValueError("Dataframes do not have the same number of rows")
-    variants_ld_block_df = variants_ld_block_df.join(variants_info)[["varID", 0, 1, 2, 3]]
-    # validate data again
-    if not variants_ld_block_df.shape[0] == variants_info.shape[0]:
-        raise ValueError("Dataframes do not have the same number of rows")
-    print(f"First 5 rows of variants info (raw):{os.linesep}{variants_info.head()}")
-
-    variants_ld_block_df = variants_ld_block_df.rename(
-        columns={
-            0: "chr",
-            1: "position",
-            2: "ref_allele",
-            3: "eff_allele",
-        }
-    )
-    variants_ld_block_df["chr"] = variants_ld_block_df["chr"].apply(lambda x: int(x[3:]))
-    print(f"Variants info (processed) shape:{os.linesep}{variants_info.shape}")
-    variants_ld_block_df["position"] = variants_ld_block_df["position"].astype(int)
+    # Preprocess SNPs data (IDs are parsed once per variant in the index)
+    variants_ld_block_df = weights_index.get_variants_info().iloc[multiplier_variant_codes]
+    print(f"Variants info (processed) shape:{os.linesep}{variants_ld_block_df.shape}")
     print(f"First 5 rows of variants info (processed):{os.linesep}{variants_ld_block_df.head()}")
 
     # Compute covariance for each chromosome block
@@ -194,11 +439,8 @@ def cov(
     if not _tmp_snps.shape[0] > 0:
         raise ValueError("No SNPs for chromosome 22")
     n_expected = len(set(_tmp_snps["varID"]).intersection(variants_ids_with_genotype))
-    _tmp = compute_snps_cov(_tmp_snps, reference_panel_dir, variants_ids_with_genotype, cov_dtype)
-    if not _tmp.shape == (n_expected, n_expected):
-        raise ValueError("Unexpected shape")
-    if _tmp.isna().any().any():
-        raise ValueError("Unexpected NA values")
+    _tmp = compute_chr_cov(_tmp_snps, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size, ld_regions)
+    check_chr_cov(_tmp, n_expected)
     del _tmp, _tmp_snps
 
     output_file_name_template = f"{conf.TWAS['LD_BLOCKS']['OUTPUT_FILE_NAME']}"
@@ -207,24 +449,59 @@ def cov(
 
     # Compute covariance and save
     with pd.HDFStore(output_file, mode="w", complevel=4) as store:
-        pbar = tqdm(
-            variants_ld_block_df.groupby("chr"),
-            ncols=100,
-            total=variants_ld_block_df["chr"].unique().shape[0],
-        )
-
         store["metadata"] = variants_ld_block_df
 
-        for grp_name, grp_data in pbar:
-            pbar.set_description(f"{grp_name} {grp_data.shape}")
-            snps_cov = compute_snps_cov(grp_data, reference_panel_dir, variants_ids_with_genotype, cov_dtype)
-            assert not snps_cov.isna().any().any()
-            store[f"chr{grp_name}"] = snps_cov
-
-            del snps_cov
-            store.flush()
-
-            gc.collect()
+    if n_jobs > 1:
+        shards_dir = output_file.with_suffix(".shards")
+        shards_dir.mkdir(parents=True, exist_ok=True)
+        chromosomes = get_chromosomes_by_size(variants_ld_block_df, variants_ids_with_genotype)
+        print(f"Computing {len(chromosomes)} chromosomes with {n_jobs} processes (shards in {shards_dir})")
+
+        # worker processes are spawned, not forked, so they never inherit open HDF5 files (not supported by PyTables)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_jobs, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = []
+            for chromosome in chromosomes:
+                grp_data = variants_ld_block_df[variants_ld_block_df["chr"] == chromosome]
+                # only the SNPs of the chromosome are sent to the worker process
+                grp_variants_ids = set(grp_data["varID"]).intersection(variants_ids_with_genotype)
+                futures.append(
+                    executor.submit(
+                        compute_chr_cov_shard, grp_data, reference_panel_dir, grp_variants_ids, cov_dtype,
+                        batch_size, ld_regions, shards_dir / f"chr{chromosome}.h5",
+                    )
+                )
+
+            # shards are appended to the output file as they finish
+            pbar = tqdm(concurrent.futures.as_completed(futures), ncols=100, total=len(futures))
+            for future in pbar:
+                shard_file = future.result()
+                pbar.set_description(shard_file.stem)
+                append_chr_cov_shard(output_file, shard_file)
+
+        shutil.rmtree(shards_dir)
+    else:
+        with pd.HDFStore(output_file, mode="a", complevel=4) as store:
+            pbar = tqdm(
+                variants_ld_block_df.groupby("chr"),
+                ncols=100,
+                total=variants_ld_block_df["chr"].unique().shape[0],
+            )
+
+            for grp_name, grp_data in pbar:
+                pbar.set_description(f"{grp_name} {grp_data.shape}")
+                snps_cov = compute_chr_cov(
+                    grp_data, reference_panel_dir, variants_ids_with_genotype, cov_dtype, batch_size, ld_regions
+                )
+                for key, data in snps_cov.items():
+                    assert not data.isna().to_numpy().any()
+                    store[key] = data
+
+                del snps_cov
+                store.flush()
+
+                gc.collect()
 
     # Ad-hot tests
     _tmp = variants_ld_block_df[variants_ld_block_df["chr"] == 1]
@@ -235,8 +512,5 @@ def cov(
         raise ValueError("No SNPs for chromosome 1")
 
     with pd.HDFStore(output_file, mode="r") as store:
-        df = store["chr1"]
-        if not df.shape == (n_expected, n_expected):
-            raise ValueError("Unexpected shape")
-        if df.isna().any().any():
-            raise ValueError("Unexpected NA values")
+        keys = ["chr1"] if ld_regions is None else ["chr1_blocks", "chr1_blocks_cov"]
+        check_chr_cov({k: store[k] for k in keys}, n_expected)
@@ -13,6 +13,8 @@ from phenoplier.entity import Gene
 from phenoplier.commands.util.enums import Cohort, RefPanel, EqtlModel
 from phenoplier.constants.arg import Corr_Filter_Args as Args
 from phenoplier.commands.util.utils import load_settings_files
+from phenoplier.gene_corrs_store import GeneCorrsStore
+from phenoplier.whitening import BlockDiagCorrMatrix
 from phenoplier.correlations import (
     check_pos_def,
     adjust_non_pos_def,
@@ -50,90 +52,121 @@ def filter(
 
     output_dir_base.mkdir(parents=True, exist_ok=True)
     print(f"Using output dir base: {output_dir_base}")
-    # Read the gene correlation symbols
-    gene_corrs_file = output_dir_base / "gene_corrs-symbols.pkl" if genes_symbols is None else genes_symbols
-    gene_corrs = pd.read_pickle(gene_corrs_file)
+    # Read the gene correlation symbols (from a store, if available)
+    if genes_symbols is None:
+        genes_symbols = output_dir_base / f"gene_corrs-symbols{GeneCorrsStore.SUFFIX}"
+        if not GeneCorrsStore.is_store(genes_symbols):
+            genes_symbols = output_dir_base / "gene_corrs-symbols.pkl"
+    if GeneCorrsStore.is_store(genes_symbols):
+        # memory-mapped, so blocks are read when they are used
+        gene_corrs_store = GeneCorrsStore(genes_symbols)
+        gene_corrs = gene_corrs_store.load()
+        gene_names = gene_corrs_store.index
+    else:
+        gene_corrs = pd.read_pickle(genes_symbols)
+        gene_names = gene_corrs.index
+    # genes in the output matrices are in the same order as in the input one
+    input_blocks = gene_corrs.blocks if isinstance(gene_corrs, BlockDiagCorrMatrix) else [gene_corrs]
     print(f"Shape of gene correlation matrix: {gene_corrs.shape}")
-    print(f"First 5 rows of gene correlation matrix: {os.linesep} {gene_corrs.head()}")
-    genes_corrs_nonzero_sum = (gene_corrs > 0.0).astype(int).sum().sum()
+    print(f"First 5 rows of gene correlation matrix: {os.linesep} {input_blocks[0].head()}")
+    genes_corrs_nonzero_sum = sum(int((b.to_numpy() > 0.0).sum()) for b in input_blocks)
     print(f"Number of nonzero cells: {genes_corrs_nonzero_sum}")
 
     # Get gene objects
-    gene_objs = [Gene(name=gene_name) for gene_name in gene_corrs.index]
+    gene_objs = pd.Series([Gene(name=gene_name) for gene_name in gene_names], index=gene_names)
     print(f"Length of gene objects: {len(gene_objs)}")
+    gene_chrs = pd.Series([str(g.chromosome) for g in gene_objs], index=gene_names)
+
+    # genes in different chromosomes are never within a distance, so the matrix is filtered by chromosome, and the
+    # dense matrix with all genes is only built to save it as a pickle file
+    is_block_diag = all(GeneCorrsStore._is_block_diag(b, gene_chrs) for b in input_blocks)
+    chr_blocks = [cb for b in input_blocks for cb in BlockDiagCorrMatrix.from_dataframe(b, gene_chrs).blocks]
+    print(f"Number of chromosomes: {len(chr_blocks)}")
 
     # Subset full correlation matrix using difference "within distances" across genes
     for full_distance in distances:
         print(f"Using within distance: {full_distance}")
         distance = full_distance / 2.0
 
-        genes_within_distance = np.eye(len(gene_objs)).astype(bool)
-        for g0_idx in range(len(gene_objs) - 1):
-            g0_obj = gene_objs[g0_idx]
-            for g1_idx in range(g0_idx + 1, len(gene_objs)):
-                g1_obj = gene_objs[g1_idx]
-
-                g0_g1_wd = g0_obj.within_distance(g1_obj, distance * 1e6)
-
-                genes_within_distance[g0_idx, g1_idx] = g0_g1_wd
-                genes_within_distance[g1_idx, g0_idx] = g0_g1_wd
-
-        genes_within_distance = pd.DataFrame(
-            genes_within_distance,
-            index=gene_corrs.index.copy(),
-            columns=gene_corrs.columns.copy()
-        )
-
-        # subset full correlation matrix
-        gene_corrs_within_distance = gene_corrs[genes_within_distance].fillna(0.0)
-        if gene_corrs_within_distance.equals(gene_corrs):
+        blocks_within_distance = []
+        is_subset = not is_block_diag
+        for chr_block in chr_blocks:
+            block_gene_objs = gene_objs.loc[chr_block.index].tolist()
+
+            genes_within_distance = np.eye(len(block_gene_objs)).astype(bool)
+            for g0_idx in range(len(block_gene_objs) - 1):
+                g0_obj = block_gene_objs[g0_idx]
+                for g1_idx in range(g0_idx + 1, len(block_gene_objs)):
+                    g1_obj = block_gene_objs[g1_idx]
+
+                    g0_g1_wd = g0_obj.within_distance(g1_obj, distance * 1e6)
+
+                    genes_within_distance[g0_idx, g1_idx] = g0_g1_wd
+                    genes_within_distance[g1_idx, g0_idx] = g0_g1_wd
+
+            # subset the block of the full correlation matrix
+            chr_block_data = chr_block.to_numpy()
+            block_within_distance = pd.DataFrame(
+                np.where(genes_within_distance, chr_block_data, 0.0),
+                index=chr_block.index.copy(),
+                columns=chr_block.columns.copy(),
+            )
+            if not np.allclose(block_within_distance.to_numpy(), chr_block_data):
+                is_subset = True
+
+            # Check if the block is positive definite
+            if not check_pos_def(block_within_distance, debug_messages=False):
+                chr_name = gene_chrs.loc[chr_block.index[0]]
+                print(f"Chromosome {chr_name} not positive definite, fixing... ", flush=True, end="")
+                corr_data_adjusted = adjust_non_pos_def(block_within_distance)
+
+                is_pos_def = check_pos_def(corr_data_adjusted, debug_messages=False)
+                assert is_pos_def, "Could not adjust gene correlation matrix"
+
+                print("Fixed! comparing...", flush=True, end="\n")
+                compare_matrices(block_within_distance, corr_data_adjusted)
+
+                # save
+                block_within_distance = corr_data_adjusted
+
+            # Checks
+            if block_within_distance.isna().any().any():
+                raise ValueError("NaNs in the gene correlation matrix within distance")
+            if np.isinf(block_within_distance.to_numpy()).any():
+                raise ValueError("Infs in the gene correlation matrix within distance")
+            if np.iscomplex(block_within_distance.to_numpy()).any():
+                raise ValueError("Complex numbers in the gene correlation matrix within distance")
+
+            blocks_within_distance.append(block_within_distance)
+
+        if not is_subset:
             raise ValueError("Error subsetting gene correlation matrix")
-        if np.allclose(gene_corrs_within_distance.to_numpy(), gene_corrs.to_numpy()):
-            raise ValueError("Error subsetting gene correlation matrix")
-        print(f"First 5 rows of gene correlation matrix within distance: {os.linesep} {gene_corrs_within_distance.head()}")
-
-        # Check if the matrix is positive definite
-        is_pos_def = check_pos_def(gene_corrs_within_distance)
-        if is_pos_def:
-            print("All good.", flush=True, end="\n")
-        else:
-            print("Not positive definite, fixing... ", flush=True, end="")
-            corr_data_adjusted = adjust_non_pos_def(gene_corrs_within_distance)
-
-            is_pos_def = check_pos_def(corr_data_adjusted)
-            assert is_pos_def, "Could not adjust gene correlation matrix"
-
-            print("Fixed! comparing...", flush=True, end="\n")
-            compare_matrices(gene_corrs_within_distance, corr_data_adjusted)
+        print("All good.", flush=True, end="\n")
 
-            # save
-            gene_corrs_within_distance = corr_data_adjusted
-
-        # Checks
-        if gene_corrs_within_distance.isna().any().any():
-            raise ValueError("NaNs in the gene correlation matrix within distance")
-        if np.isinf(gene_corrs_within_distance.to_numpy()).any():
-            raise ValueError("Infs in the gene correlation matrix within distance")
-        if np.iscomplex(gene_corrs_within_distance.to_numpy()).any():
-            raise ValueError("Complex numbers in the gene correlation matrix within distance")
+        gene_corrs_within_distance = BlockDiagCorrMatrix(blocks_within_distance)
+        print(f"First 5 rows of gene correlation matrix within distance: {os.linesep} {blocks_within_distance[0].head()}")
 
         # Show some stats
-        genes_corrs_sum = gene_corrs_within_distance.sum()
+        genes_corrs_sum = pd.concat([b.sum() for b in blocks_within_distance])
         n_genes_included = genes_corrs_sum[genes_corrs_sum > 1.0].shape[0]
-        genes_corrs_nonzero_sum = (gene_corrs_within_distance > 0.0).astype(int).sum().sum()
+        genes_corrs_nonzero_sum = sum(int((b.to_numpy() > 0.0).sum()) for b in blocks_within_distance)
 
         print(f"Number of genes with correlations with other genes: {n_genes_included}")
         print(f"Number of nonzero cells: {genes_corrs_nonzero_sum}")
 
-        corr_matrix_flat = gene_corrs_within_distance.mask(
-            np.triu(np.ones(gene_corrs_within_distance.shape)).astype(bool)
-        ).stack()
+        # correlations between genes in the same chromosome
+        corr_matrix_flat = pd.Series(
+            np.concatenate([b.to_numpy()[np.tril_indices(b.shape[0], k=-1)] for b in blocks_within_distance])
+        )
         print(corr_matrix_flat.describe().apply(str))
 
-        # Save the new matrix
+        # Save the new matrix as a store that can be memory-mapped, with a block per chromosome
+        output_store = output_dir_base / f"gene_corrs-symbols-within_distance_{int(full_distance)}mb{GeneCorrsStore.SUFFIX}"
+        GeneCorrsStore.write(output_store, gene_corrs_within_distance, gene_chrs, gene_names)
+
+        # and as a (dense) pickle file
         output_file = output_dir_base / f"gene_corrs-symbols-within_distance_{int(full_distance)}mb.pkl.gz"
-        gene_corrs_within_distance.to_pickle(output_file)
         with gzip.GzipFile(output_file, "w") as f:
-            pickle.dump(gene_corrs_within_distance, f)
-        print(f"Done. Saved to {output_file}")
+            pickle.dump(gene_corrs_within_distance.to_dataframe(gene_names), f)
+        print(f"Done. Saved to {output_file} and {output_store}")
         print()
@@ -5,26 +5,33 @@ from pathlib import Path
 
 import pandas as pd
 import numpy as np
-from scipy import sparse
 from tqdm import tqdm
 
 from phenoplier.config import settings as conf
 from phenoplier.gls import GLSPhenoplier
+from phenoplier.gene_corrs_store import GeneCorrsStore
+from phenoplier.whitening import BlockDiagCorrMatrix, get_whitener
 from phenoplier.commands.util.enums import Cohort, RefPanel, EqtlModel
 from phenoplier.constants.arg import Corr_Generate_Args as Args
 from phenoplier.commands.util.utils import load_settings_files, load_pickle_or_gz_pickle
 
 
 def exists_df(output_dir, base_filename):
-    full_filepath = output_dir / (base_filename + ".npz")
+    full_filepath = output_dir / (base_filename + ".npy")
     return full_filepath.exists()
 
 
 def store_df(output_dir, nparray, base_filename):
-    if base_filename in ("metadata", "gene_names"):
-        np.savez_compressed(output_dir / (base_filename + ".npz"), data=nparray)
-    else:
-        sparse.save_npz(output_dir / (base_filename + ".npz"), sparse.csc_matrix(nparray), compressed=False)
+    np.save(output_dir / (base_filename + ".npy"), nparray)
+
+
+def store_block(output_dir, block, block_idx, base_filename):
+    """
+    Stores the block of an LV-specific matrix (a dense array) and the positions
+    of its genes. See GLSPhenoplier.load_chol_block.
+    """
+    store_df(output_dir, block, base_filename)
+    store_df(output_dir, block_idx, base_filename + "_gene_idx")
 
 
 def get_output_dir(gene_corr_filename, output_dir_base):
@@ -41,23 +48,75 @@ def compute_chol_inv(lv_code, gene_corrs_dict, multiplier_z, output_dir_base, re
         output_dir = get_output_dir(gene_corr_filename, output_dir_base)
         output_dir.mkdir(parents=True, exist_ok=True)
 
+        # the LV-specific matrix is an identity matrix plus a block with the top
+        # genes of the LV, so only the Cholesky factor of that block is stored
+        # (the correlation matrix and the inverse of the factor are derived from
+        # it when needed)
+        gene_names = gene_corrs.index
         lv_data = multiplier_z[lv_code]
-        corr_mat_sub = GLSPhenoplier.get_sub_mat(gene_corrs, lv_data, lv_percentile)
-        store_df(output_dir, corr_mat_sub.to_numpy(), f"{lv_code}_corr_mat")
-
-        chol_mat = np.linalg.cholesky(corr_mat_sub)
-        chol_inv = np.linalg.inv(chol_mat)
-        store_df(output_dir, chol_inv, lv_code)
+        block_genes = GLSPhenoplier.get_sub_mat_genes(gene_names, lv_data, lv_percentile)
+        block_idx = np.sort(gene_names.get_indexer(block_genes))
+        block_genes = gene_names[block_idx]
+        if isinstance(gene_corrs, GeneCorrsStore):
+            # memory-mapped, so only the correlations of the LV genes are read
+            corr_mat_block = gene_corrs.read(block_genes)
+        elif isinstance(gene_corrs, BlockDiagCorrMatrix):
+            corr_mat_block = gene_corrs.subset(block_genes)
+        else:
+            corr_mat_block = gene_corrs.iloc[block_idx, block_idx]
+
+        if isinstance(corr_mat_block, BlockDiagCorrMatrix):
+            # blocks (such as chromosomes) are factorized independently, unless
+            # they are not contiguous in the order of genes
+            if not corr_mat_block.index.equals(block_genes):
+                corr_mat_block = corr_mat_block.to_dataframe(block_genes).to_numpy()
+        else:
+            corr_mat_block = corr_mat_block.to_numpy()
+
+        block_whitener = get_whitener(corr_mat_block)
+        store_block(output_dir, block_whitener.chol_factor, block_idx, f"{lv_code}_chol")
 
         if not exists_df(output_dir, "metadata"):
             metadata = np.array([reference_panel, eqtl_model])
             store_df(output_dir, metadata, "metadata")
 
         if not exists_df(output_dir, "gene_names"):
-            gene_names = np.array(gene_corrs.index.tolist())
+            gene_names = np.array(gene_names.tolist())
             store_df(output_dir, gene_names, "gene_names")
 
 
+def get_gene_corrs_input_file(gene_corrs_file):
+    """
+    Returns the file with the gene correlation matrix that is read for a pickle
+    file (gene_corrs_file, such as 'gene_corrs-symbols-within_distance_5mb.pkl.gz'):
+    the store with the same name (see GeneCorrsStore), if it exists, or the
+    pickle file otherwise.
+    """
+    store_file = gene_corrs_file.with_name(gene_corrs_file.name.removesuffix(".pkl.gz") + GeneCorrsStore.SUFFIX)
+    if GeneCorrsStore.is_store(store_file):
+        return store_file
+    return gene_corrs_file
+
+
+def load_gene_corrs_dict(gene_corrs_dir):
+    """
+    Returns a dictionary with the gene correlation matrices in gene_corrs_dir
+    (files 'gene_corrs-symbols*.pkl.gz') by file name. Matrices in a store next
+    to a pickle file (see get_gene_corrs_input_file) are read lazily from the
+    store (see compute_chol_inv), but they are still named after the pickle
+    file, so output folders (see get_output_dir) do not depend on the format.
+    """
+    gene_corrs_dict = {}
+    for f in sorted(gene_corrs_dir.glob("gene_corrs-symbols*.pkl.gz")):
+        input_file = get_gene_corrs_input_file(f)
+        if input_file != f:
+            gene_corrs_dict[f.name] = GeneCorrsStore(input_file)
+        else:
+            gene_corrs_dict[f.name] = load_pickle_or_gz_pickle(f)
+
+    return gene_corrs_dict
+
+
 def generate(
         cohort: Annotated[Cohort, Args.COHORT_NAME.value],
         reference_panel: Annotated[RefPanel, Args.REFERENCE_PANEL.value],
@@ -92,7 +151,7 @@ def generate(
 
     # Load the gene_corrs_symbols
     gene_corrs_dir = output_dir_base if genes_symbols_dir is None else genes_symbols_dir
-    gene_corrs_dict = {f.name: load_pickle_or_gz_pickle(f) for f in gene_corrs_dir.glob("gene_corrs-symbols*.pkl.gz")}
+    gene_corrs_dict = load_gene_corrs_dict(gene_corrs_dir)
     # Make sure the gene_corrs_dict is not empty
     if not gene_corrs_dict:
         raise FileNotFoundError(f"No gene_corrs files found in {gene_corrs_dir}")
@@ -1,19 +1,19 @@
+import os
+import json
+import hashlib
 import logging
 import datetime
 import concurrent.futures
-from typing import Annotated
+from typing import Annotated, List
 from pathlib import Path
 
-import pandas as pd
-import numpy as np
-from scipy import sparse
-from tqdm import tqdm
-
 from phenoplier.config import settings as conf
-from phenoplier.gls import GLSPhenoplier
+from phenoplier.gene_corrs_store import GeneCorrsStore
 from phenoplier.commands.util.enums import Cohort, RefPanel, EqtlModel
-# from phenoplier.constants.cli import Corr_Generate_Args as Args
-from phenoplier.commands.util.utils import load_settings_files
+from phenoplier.commands.run.correlation.generate import (
+    get_output_dir as get_generate_output_dir,
+    get_gene_corrs_input_file,
+)
 from phenoplier.constants.arg import (
     Common_Args,
     Corr_Preprocess_Args,
@@ -24,17 +24,171 @@ from phenoplier.constants.arg import (
 from phenoplier.commands.invoker import (
     invoke_corr_preprocess,
     invoke_corr_correlate,
-    invoke_corr_postprocess)
+    invoke_corr_postprocess,
+    invoke_corr_filter,
+    invoke_corr_generate)
 
 logger = logging.getLogger(__name__)
 
+MANIFEST_FILENAME = "pipeline_manifest.json"
+CHROMOSOMES = list(range(1, 23))
+
+
+def get_files_fingerprint(paths: List[Path]) -> list:
+    """
+    Returns the path, size and modification time of files (or all files in a folder, recursively), which are used
+    instead of their content to check if the inputs of a stage changed (input files such as GWAS can be very large).
+    Missing files are included with no size and modification time.
+    """
+    fingerprint = []
+    for path in paths:
+        path = Path(path)
+        files = sorted(f for f in path.rglob("*") if f.is_file()) if path.is_dir() else [path]
+        for f in files:
+            if f.exists():
+                f_stat = f.stat()
+                fingerprint.append([str(f.resolve()), f_stat.st_size, f_stat.st_mtime_ns])
+            else:
+                fingerprint.append([str(f.resolve()), None, None])
+    return fingerprint
+
+
+def get_inputs_hash(params: dict, input_files: List[Path]) -> str:
+    """
+    Returns a hash of the parameters and input files (see get_files_fingerprint) of a stage.
+    """
+    inputs = {
+        "params": {k: str(v) for k, v in params.items()},
+        "files": get_files_fingerprint(input_files),
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(manifest_file: Path) -> dict:
+    """
+    Reads the manifest with the stages completed by a previous run. An empty manifest is returned if the file does
+    not exist or cannot be read.
+    """
+    manifest_file = Path(manifest_file)
+    if manifest_file.exists():
+        try:
+            with open(manifest_file, "r") as f:
+                manifest = json.load(f)
+            if isinstance(manifest.get("stages"), dict):
+                return manifest
+        except (json.JSONDecodeError, AttributeError):
+            pass
+
+        logger.warning(f"Pipeline manifest could not be read, all stages will be run: {manifest_file}")
+
+    return {"stages": {}}
+
+
+def save_checkpoint(manifest_file: Path, manifest: dict):
+    """
+    Writes the manifest. It is written with a temporary name first, so an interrupted run does not leave a partial
+    file.
+    """
+    manifest_file = Path(manifest_file)
+    tmp_file = manifest_file.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
 
-def save_checkpoint():
-    raise NotImplementedError()
 
+def is_stage_done(manifest: dict, stage: str, inputs_hash: str) -> bool:
+    """
+    Returns True if a stage was completed with the same inputs and its outputs still exist.
+    """
+    stage_data = manifest["stages"].get(stage)
+    return (
+        stage_data is not None
+        and stage_data["inputs_hash"] == inputs_hash
+        and all(Path(f).exists() for f in stage_data["outputs"])
+    )
+
+
+def mark_stage_done(manifest_file: Path, manifest: dict, stage: str, inputs_hash: str, outputs: List[Path]):
+    """
+    Records the completion of a stage in the manifest and saves it.
+    """
+    manifest["stages"][stage] = {
+        "inputs_hash": inputs_hash,
+        "outputs": [str(f) for f in outputs],
+        "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+    }
+    save_checkpoint(manifest_file, manifest)
 
-def load_checkpoint():
-    raise NotImplementedError()
+
+def get_available_memory() -> int:
+    """
+    Returns the memory (in bytes) available for new processes, or None if it cannot be determined.
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def get_n_workers(n_tasks: int, n_jobs: int = None, memory_per_job: float = 4.0) -> int:
+    """
+    Returns the number of processes used to run tasks in parallel: n_jobs if given, or the number of available
+    cores limited by the available memory and the estimated memory (in GB) used by each task. It is never larger
+    than the number of tasks.
+    """
+    if n_jobs is None:
+        if hasattr(os, "sched_getaffinity"):
+            n_jobs = len(os.sched_getaffinity(0))
+        else:
+            n_jobs = os.cpu_count() or 1
+
+        available_memory = get_available_memory()
+        if available_memory is not None and memory_per_job > 0:
+            n_jobs = min(n_jobs, int(available_memory // (memory_per_job * 1024**3)))
+
+    return max(1, min(n_jobs, n_tasks))
+
+
+def _invoke(invoke_func, **kwargs):
+    """
+    Runs a command with one of the invoker functions, and returns whether it succeeded and its output (or error) as
+    a string, so that it can be sent back from a worker process.
+    """
+    try:
+        suc, msg = invoke_func(**kwargs)
+    except Exception as e:
+        return False, repr(e)
+
+    return suc, str(msg)
+
+
+def run_stage(manifest_file: Path, manifest: dict, stage: str, inputs_hash: str, outputs: List[Path], invoke_func,
+              **kwargs):
+    """
+    Runs a stage with an invoker function, unless it was already completed with the same inputs. The process exits
+    if the stage fails.
+    """
+    if is_stage_done(manifest, stage, inputs_hash):
+        logger.info(f"Subroutine <{stage}> is up to date, skipping.")
+        return
+
+    logger.info(f"Running subroutine <{stage}>...")
+    suc, msg = _invoke(invoke_func, **kwargs)
+    if not suc:
+        logger.error(f"Subroutine <{stage}> failed.")
+        logger.error(msg)
+        exit(1)
+
+    mark_stage_done(manifest_file, manifest, stage, inputs_hash, outputs)
+    logger.info(f"Subroutine <{stage}> finished successfully.")
 
 
 # Get the current timestamp
@@ -54,93 +208,168 @@ def pipeline(
         spredixcan_file_pattern: Annotated[str, Corr_Preprocess_Args.SPREDIXCAN_FILE_PATTERN.value],
         smultixcan_file: Annotated[Path, Corr_Preprocess_Args.SMULTIXCAN_FILE.value],
         # Correlate arguments
-        # chromosome: Annotated[int, Corr_Correlate_Args.CHROMOSOME.value] = None,
         smultixcan_condition_number: Annotated[int, Corr_Correlate_Args.SMULTIXCAN_CONDITION_NUMBER.value] = 30,
         compute_within_distance: Annotated[bool, Corr_Correlate_Args.COMPUTE_WITHIN_DISTANCE.value] = False,
         correlate_debug_mode: Annotated[bool, Corr_Correlate_Args.DEBUG_MODE.value] = False,
+        n_jobs: Annotated[int, Corr_Pipeline_Args.N_JOBS.value] = None,
+        memory_per_job: Annotated[float, Corr_Pipeline_Args.MEMORY_PER_JOB.value] = 4.0,
+        # Filter and generate arguments
+        distances: Annotated[List[float], Corr_Pipeline_Args.DISTANCES.value] = [5],
+        lv_codes: Annotated[List[int], Corr_Pipeline_Args.LV_CODES.value] = None,
         # Common arguments with default values
         project_dir: Annotated[Path, Common_Args.PROJECT_DIR.value] = conf.CURRENT_DIR,
         output_dir: Annotated[Path, Corr_Pipeline_Args.OUTPUT_DIR.value] = pipeline_res_dir,
+        restart: Annotated[bool, Corr_Pipeline_Args.RESTART.value] = False,
 ):
     """
     This command integrated all other commands to compute the final gene-gene correlation matrix, and is recommended
     to be used in a cluster environment. Checkpoints will be created during the computation, so it can be resumed if
     interrupted. For finer-grained control, use the other commands below.
+
+    It runs 'preprocess', then 'correlate' for all chromosomes in parallel processes, and then 'postprocess',
+    'filter' and 'generate'. Each completed stage is recorded (with a hash of its parameters and input files) in
+    the file pipeline_manifest.json of the output directory, so running the command again with the same output
+    directory skips the stages that are up to date.
     """
-    # logger.info("Running subroutine <preprocess>...")
-    # suc, msg = invoke_corr_preprocess(
-    #     cohort=cohort,
-    #     gwas_file=gwas_file,
-    #     spredixcan_folder=spredixcan_folder,
-    #     spredixcan_file_pattern=spredixcan_file_pattern,
-    #     smultixcan_file=smultixcan_file,
-    #     reference_panel=reference_panel,
-    #     eqtl_model=eqtl_model,
-    #     project_dir=project_dir,
-    #     output_dir=output_dir,
-    # )
-    # if suc:
-    #     logger.info("Subroutine <preprocess> finished successfully.")
-    # else:
-    #     logger.error("Subroutine <preprocess> failed.")
-    #     logger.error(msg)
-    #     exit(1)
-    #
-
-    logger.info("Running subroutine <correlate>...")
-
-    def run_correlate(chromosome):
-        suc, msg = invoke_corr_correlate(
-            cohort=cohort,
-            reference_panel=reference_panel,
-            eqtl_model=eqtl_model,
-            chromosome=chromosome,
-            smultixcan_condition_number=smultixcan_condition_number,
-            compute_within_distance=compute_within_distance,
-            debug_mode=correlate_debug_mode,
-            output_dir=output_dir,
-            project_dir=project_dir,
-        )
-        if suc:
-            logger.info(f"Subroutine <correlate> for chromosome {chromosome} finished successfully.")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Using output directory: {output_dir}")
+
+    manifest_file = output_dir / MANIFEST_FILENAME
+    manifest = {"stages": {}} if restart else load_checkpoint(manifest_file)
+
+    common_args = dict(
+        cohort=cohort,
+        reference_panel=reference_panel,
+        eqtl_model=eqtl_model,
+        project_dir=project_dir,
+    )
+
+    # preprocess
+    preprocess_outputs = [output_dir / "gene_tissues.pkl", output_dir / "genes_info.pkl"]
+    run_stage(
+        manifest_file, manifest, "preprocess",
+        get_inputs_hash(
+            dict(
+                common_args,
+                spredixcan_file_pattern=spredixcan_file_pattern,
+                smultixcan_condition_number=smultixcan_condition_number,
+            ),
+            [gwas_file, spredixcan_folder, smultixcan_file],
+        ),
+        preprocess_outputs,
+        invoke_corr_preprocess,
+        gwas_file=gwas_file,
+        spredixcan_folder=spredixcan_folder,
+        spredixcan_file_pattern=spredixcan_file_pattern,
+        smultixcan_file=smultixcan_file,
+        smultixcan_condition_number=smultixcan_condition_number,
+        output_dir=output_dir,
+        **common_args,
+    )
+
+    # correlate (one process per chromosome)
+    correlate_args = dict(
+        common_args,
+        smultixcan_condition_number=smultixcan_condition_number,
+        compute_within_distance=compute_within_distance,
+        debug_mode=correlate_debug_mode,
+    )
+    correlate_outputs = {c: output_dir / "by_chr" / f"gene_corrs-chr{c}.pkl" for c in CHROMOSOMES}
+
+    pending = {}
+    for chromosome in CHROMOSOMES:
+        inputs_hash = get_inputs_hash(dict(correlate_args, chromosome=chromosome), preprocess_outputs)
+        if is_stage_done(manifest, f"correlate-chr{chromosome}", inputs_hash):
+            logger.info(f"Subroutine <correlate> for chromosome {chromosome} is up to date, skipping.")
         else:
-            logger.error(f"Subroutine <correlate> for chromosome {chromosome} failed.")
-            logger.error(msg)
+            pending[chromosome] = inputs_hash
+
+    if len(pending) > 0:
+        max_workers = get_n_workers(len(pending), n_jobs, memory_per_job)
+        logger.info(f"Running subroutine <correlate> for {len(pending)} chromosomes with {max_workers} processes...")
+
+        failed = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            future_to_chromosome = {
+                executor.submit(
+                    _invoke, invoke_corr_correlate,
+                    chromosome=chromosome, input_dir=output_dir, output_dir=output_dir, **correlate_args,
+                ): chromosome
+                for chromosome in pending
+            }
+
+            # each chromosome is recorded as soon as it finishes, and the others keep running if one fails
+            for future in concurrent.futures.as_completed(future_to_chromosome):
+                chromosome = future_to_chromosome[future]
+                try:
+                    suc, msg = future.result()
+                except Exception as exc:
+                    suc, msg = False, repr(exc)
+
+                if suc:
+                    mark_stage_done(
+                        manifest_file, manifest, f"correlate-chr{chromosome}", pending[chromosome],
+                        [correlate_outputs[chromosome]],
+                    )
+                    logger.info(f"Subroutine <correlate> for chromosome {chromosome} finished successfully.")
+                else:
+                    logger.error(f"Subroutine <correlate> for chromosome {chromosome} failed.")
+                    logger.error(msg)
+                    failed.append(chromosome)
+
+        if len(failed) > 0:
+            logger.error(f"Subroutine <correlate> failed for chromosomes: {sorted(failed)}")
             exit(1)
-        return suc
-
-    chromosomes = [1]
-    # Use ThreadPoolExecutor for multithreading
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        # Start the operations and mark each future with its chromosome
-        future_to_chromosome = {executor.submit(run_correlate, chromosome): chromosome for chromosome in chromosomes}
-
-        for future in concurrent.futures.as_completed(future_to_chromosome):
-            chromosome = future_to_chromosome[future]
-            try:
-                future.result()
-            except Exception as exc:
-                logger.error(f"Subroutine <correlate> for chromosome {chromosome} generated an exception: {exc}")
-                exit(1)
     logger.info("Subroutine <correlate> finished successfully.")
 
-    # logger.info("Running subroutine <postprocess>...")
-    # postprocess_input_dir = output_dir / "by_chr"
-    # postprocess_genes_info_file = output_dir / "genes_info.pkl"
-    # suc, msg = invoke_corr_postprocess(
-    #     cohort=cohort,
-    #     reference_panel=reference_panel,
-    #     eqtl_model=eqtl_model,
-    #     input_dir=postprocess_input_dir,
-    #     genes_info=postprocess_genes_info_file,
-    #     output_dir=output_dir,
-    #     project_dir=project_dir,
-    # )
-    # if suc:
-    #     logger.info("Subroutine <postprocess> finished successfully.")
-    # else:
-    #     logger.error("Subroutine <postprocess> failed.")
-    #     logger.error(msg)
-    #     exit(1)
+    # postprocess
+    genes_symbols_file = output_dir / "gene_corrs-symbols.pkl"
+    genes_symbols_store = genes_symbols_file.with_suffix(GeneCorrsStore.SUFFIX)
+    postprocess_outputs = [genes_symbols_file, genes_symbols_store]
+    run_stage(
+        manifest_file, manifest, "postprocess",
+        get_inputs_hash(common_args, list(correlate_outputs.values()) + [output_dir / "genes_info.pkl"]),
+        postprocess_outputs,
+        invoke_corr_postprocess,
+        input_dir=output_dir / "by_chr",
+        genes_info=output_dir / "genes_info.pkl",
+        output_dir=output_dir,
+        **common_args,
+    )
+
+    # filter (one stage per distance), which writes a pickle file and a store with the same matrix
+    filter_outputs = []
+    for distance in distances:
+        filter_output = output_dir / f"gene_corrs-symbols-within_distance_{int(distance)}mb.pkl.gz"
+        filter_store = output_dir / f"gene_corrs-symbols-within_distance_{int(distance)}mb{GeneCorrsStore.SUFFIX}"
+        run_stage(
+            manifest_file, manifest, f"filter-{int(distance)}mb",
+            get_inputs_hash(dict(common_args, distance=distance), postprocess_outputs),
+            [filter_output, filter_store],
+            invoke_corr_filter,
+            distances=[distance],
+            genes_symbols=genes_symbols_store if GeneCorrsStore.is_store(genes_symbols_store) else genes_symbols_file,
+            output_dir=output_dir,
+            **common_args,
+        )
+        filter_outputs.append(filter_output)
+
+    # generate (one stage per LV), for all matrices computed by filter; outputs are named after the pickle files, and
+    # inputs are the files that are actually read (stores, if they exist)
+    generate_inputs = [get_gene_corrs_input_file(f) for f in filter_outputs]
+    generate_outputs = [get_generate_output_dir(f.name, output_dir) for f in filter_outputs]
+    for lv_code in lv_codes or []:
+        run_stage(
+            manifest_file, manifest, f"generate-LV{lv_code}",
+            get_inputs_hash(dict(common_args, lv_code=lv_code), generate_inputs),
+            generate_outputs,
+            invoke_corr_generate,
+            lv_code=lv_code,
+            genes_symbols_dir=output_dir,
+            output_dir=output_dir,
+            **common_args,
+        )
 
+    logger.info(f"Pipeline finished successfully. Results in: {output_dir}")
     return
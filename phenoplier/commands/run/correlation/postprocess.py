@@ -13,10 +13,11 @@ from phenoplier.entity import Gene
 from phenoplier.commands.util.enums import Cohort, RefPanel, EqtlModel
 from phenoplier.constants.arg import Corr_Postprocess_Args as Args
 from phenoplier.commands.util.utils import load_settings_files
+from phenoplier.gene_corrs_store import GeneCorrsStore
+from phenoplier.whitening import BlockDiagCorrMatrix
 from phenoplier.correlations import (
     check_pos_def,
     adjust_non_pos_def,
-    compare_matrices,
 )
 
 
@@ -67,6 +68,9 @@ def postprocess(
     """
     Reads all gene correlations across all chromosomes and computes a single correlation matrix by assembling a big
     correlation matrix with all genes.
+
+    Since genes in different chromosomes are not correlated, positive definiteness is checked (and fixed) for each
+    chromosome's block only, and blocks are copied into the full matrix by position.
     """
     load_settings_files(project_dir)
     cohort = cohort.value
@@ -125,21 +129,33 @@ def postprocess(
     print(f"Shape of the processed genes info: {genes_info.shape}")
     print(f"Fist 5 processed genes info: {os.linesep} {genes_info.head()}")
 
-    # Create full correlation matrix
-    full_corr_matrix = pd.DataFrame(
-        np.zeros((genes_info.shape[0], genes_info.shape[0])),
-        index=genes_info["id"].tolist(),
-        columns=genes_info["id"].tolist(),
-    )
-    if not full_corr_matrix.index.is_unique and full_corr_matrix.columns.is_unique:
+    # Assemble the correlation matrix from the blocks of all chromosomes. Genes in different chromosomes are not
+    # correlated, so the matrix is block diagonal: it is positive definite if and only if each block is, and only
+    # blocks are checked (and adjusted if needed)
+    genes_pos = pd.Index(genes_info["id"])
+    if not genes_pos.is_unique:
         raise ValueError("Gene IDs are not unique")
 
+    corr_blocks = []
     for chr_corr_file in all_gene_corr_files:
         print(f"Processing {chr_corr_file.name}...")
         # get correlation matrix for this chromosome
         corr_data = pd.read_pickle(chr_corr_file)
-        # save gene correlation matrix
-        full_corr_matrix.loc[corr_data.index, corr_data.columns] = corr_data
+        if any(isinstance(dtype, pd.SparseDtype) for dtype in corr_data.dtypes):
+            # computed with a window distance (see 'correlate')
+            corr_data = corr_data.sparse.to_dense()
+        if not corr_data.index.equals(corr_data.columns):
+            raise ValueError(f"Rows and columns of the gene correlation matrix are different: {chr_corr_file.name}")
+
+        # genes in the same order as in genes info
+        corr_data_pos = genes_pos.get_indexer(corr_data.index)
+        if (corr_data_pos < 0).any():
+            raise ValueError(f"Genes not found in genes info: {chr_corr_file.name}")
+        corr_data_order = np.argsort(corr_data_pos)
+        corr_data = corr_data.iloc[corr_data_order, corr_data_order]
+
+        if not np.all(np.isclose(np.diag(corr_data.to_numpy()), 1.0)):
+            raise ValueError(f"Diagonal elements are not 1.0: {chr_corr_file.name}")
 
         # save inverse of Cholesky decomposition of gene correlation matrix
         # first, adjust correlation matrix if it is not positive definite
@@ -152,37 +168,31 @@ def postprocess(
             corr_data = adjust_non_pos_def(corr_data)
             if not check_pos_def(corr_data):
                 raise ValueError("Could not adjust gene correlation matrix")
-            # save
-            full_corr_matrix.loc[corr_data.index, corr_data.columns] = corr_data
-    print()
-
-    # Checks
-    print("Checking if diagonal elements are zero...")
-    if not np.all(np.isclose(full_corr_matrix.to_numpy().diagonal(), 1.0)):
-        raise ValueError("Diagonal elements are not 1.0")
-    # In some cases, even if the submatrices are adjusted, the whole one is not.
-    # So here check that again.
-    is_pos_def = check_pos_def(full_corr_matrix)
-    if is_pos_def:
-        print("All good.", flush=True, end="\n")
-    else:
-        print("Not positive definite, fixing... ", flush=True, end="")
-        corr_data_adjusted = adjust_non_pos_def(full_corr_matrix)
 
-        is_pos_def = check_pos_def(corr_data_adjusted)
-        assert is_pos_def, "Could not adjust gene correlation matrix"
-
-        print("Fixed! comparing...", flush=True, end="\n")
-        compare_matrices(full_corr_matrix, corr_data_adjusted)
+        corr_blocks.append((corr_data_pos.min(), corr_data))
+    print()
 
-        full_corr_matrix = corr_data_adjusted
+    # blocks in the order of genes info, so each one starts where the previous one ends
+    corr_blocks = [b for _, b in sorted(corr_blocks, key=lambda x: x[0])]
+    blocks_pos = np.concatenate([genes_pos.get_indexer(b.index) for b in corr_blocks])
+    if not np.array_equal(blocks_pos, np.arange(genes_pos.shape[0])):
+        raise ValueError("Genes of the chromosomes do not match genes info")
 
     # TODO: Add output name to template, sharing across commands
     output_file = output_dir_base / "gene_corrs-symbols.pkl"
-    gene_corrs = full_corr_matrix.rename(index=Gene.GENE_ID_TO_NAME_MAP(), columns=Gene.GENE_ID_TO_NAME_MAP())
-    gene_corrs.to_pickle(output_file)
+    gene_names_map = Gene.GENE_ID_TO_NAME_MAP()
+    gene_corrs_blocks = BlockDiagCorrMatrix(
+        [b.rename(index=gene_names_map, columns=gene_names_map) for b in corr_blocks]
+    )
+    full_corr_matrix = gene_corrs_blocks.to_dataframe()
+    full_corr_matrix.to_pickle(output_file)
+
+    # also save it as a store that can be memory-mapped, with a block per chromosome
+    gene_chrs = genes_info.set_index("id")["chr"].rename(index=gene_names_map)
+    output_store = output_file.with_suffix(GeneCorrsStore.SUFFIX)
+    GeneCorrsStore.write(output_store, gene_corrs_blocks, gene_chrs)
 
-    print(f"Computation of gene correlations completed successfully. Output file: {output_file}")
+    print(f"Computation of gene correlations completed successfully. Output file: {output_file} (and {output_store})")
 
     if plot_output_dir is not None:
         plot_distribution_and_heatmap(full_corr_matrix)
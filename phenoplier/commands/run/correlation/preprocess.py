@@ -11,6 +11,9 @@ from rich.text import Text
 
 from phenoplier.config import settings as conf
 from phenoplier.entity import Gene
+from phenoplier.gene_svd_cache import GeneSvdCache
+from phenoplier.variant_set import VariantSet
+from phenoplier.ssm_correlations import get_gene_svd, select_singular_values
 from phenoplier.commands.util.utils import load_settings_files, get_model_tissue_names
 from phenoplier.commands.util.enums import Cohort, RefPanel, EqtlModel
 from phenoplier.constants.arg import Corr_Preprocess_Args as Args
@@ -26,6 +29,7 @@ def preprocess(
         spredixcan_file_pattern:    Annotated[str, Args.SPREDIXCAN_FILE_PATTERN.value],
         smultixcan_file:            Annotated[Path, Args.SMULTIXCAN_FILE.value],
         multiplier_z_path:          Annotated[Path, Args.MULTIPLIER_Z.value] = None,
+        smultixcan_condition_number: Annotated[int, Args.SMULTIXCAN_CONDITION_NUMBER.value] = 30,
         project_dir:                Annotated[Path, Args.PROJECT_DIR.value] = conf.CURRENT_DIR,
         output_dir:                 Annotated[Path, Args.OUTPUT_DIR.value] = None,
 ):
@@ -113,6 +117,12 @@ def preprocess(
         pickle.dump(gwas_variants_ids_set, handle, protocol=pickle.HIGHEST_PROTOCOL)
     print(f"GWAS variant IDs saved to: {output_file}")
 
+    # the same variants as integer keys, which is what 'correlate' reads
+    gwas_variants = VariantSet.from_ids(gwas_variants_ids_set)
+    output_file = output_dir_base / "gwas_variant_ids.npy"
+    gwas_variants.save(output_file)
+    print(f"GWAS variant keys saved to: {output_file}")
+
     # TWAS data processing
     # obtain tissue information
     prediction_model_tissues = get_model_tissue_names(eqtl_model)
@@ -246,32 +256,18 @@ def preprocess(
         """
         Add genes' variance captured by principal components
         """
-        gene_id = gene_row.name
-        gene_tissues = gene_row["tissue"]
-        gene_obj = spredixcan_gene_obj[gene_id]
-        u, s, vt = gene_obj.get_tissues_correlations_svd(
-            tissues=gene_tissues,
-            snps_subset=gwas_variants_ids_set,
-            reference_panel=reference_panel,
-            model_type=eqtl_model,
-        )
-        return s
+        gene_svd = genes_svd[gene_row.name]
+        if gene_svd is None:
+            return None
+        # top eigenvalues selected as in Gene.get_tissues_correlations_svd
+        s = gene_svd["s"]
+        return s[select_singular_values(s, smultixcan_condition_number)]
 
     def _get_gene_variances(gene_row):
-        gene_id = gene_row.name
-        gene_tissues = gene_row["tissue"]
-        tissue_variances = {}
-        gene_obj = spredixcan_gene_obj[gene_id]
-        for tissue in gene_tissues:
-            tissue_var = gene_obj.get_pred_expression_variance(
-                tissue=tissue,
-                reference_panel=reference_panel,
-                model_type=eqtl_model,
-                snps_subset=gwas_variants_ids_set,
-            )
-            if tissue_var is not None:
-                tissue_variances[tissue] = tissue_var
-        return tissue_variances
+        gene_svd = genes_svd[gene_row.name]
+        if gene_svd is None:
+            return {}
+        return dict(zip(gene_svd["tissues"].tolist(), gene_svd["variances"].tolist()))
 
     # Add covariates based on S-PrediXcan results. This extends the previous file with more columns
     with Progress(
@@ -282,6 +278,25 @@ def preprocess(
         # Get gene's objects
         spredixcan_gene_obj = {gene_id: Gene(ensembl_id=gene_id) for gene_id in spredixcan_genes_models.index}
 
+        # SVD of the tissues correlations of each gene, saved by chromosome so 'correlate' does not compute them again
+        genes_svd = {
+            gene_id: get_gene_svd(
+                gene_obj,
+                tissues=spredixcan_genes_models.loc[gene_id, "tissue"],
+                snps_subset=gwas_variants,
+                reference_panel=reference_panel,
+                model_type=eqtl_model,
+            )
+            for gene_id, gene_obj in spredixcan_gene_obj.items()
+        }
+        gene_svd_cache = GeneSvdCache(
+            output_dir_base / GeneSvdCache.FOLDER, gwas_variants, reference_panel, eqtl_model,
+            smultixcan_condition_number,
+        )
+        genes_chrs = genes_info.set_index("id").loc[list(genes_svd.keys()), "chr"]
+        for chromosome, chr_genes in genes_chrs.groupby(genes_chrs):
+            gene_svd_cache.write(int(chromosome), {gene_id: genes_svd[gene_id] for gene_id in chr_genes.index})
+
         # Add genes' variance captured by principal components
         try:
             spredixcan_genes_tissues_pc_variance = spredixcan_genes_models.apply(_get_gene_pc_variance, axis=1)
@@ -392,12 +407,12 @@ def preprocess(
             t_snps = set(gene_models[gene_id].index)
             gene_unique_snps.update(t_snps)
 
-        gene_unique_snps_in_gwas = gwas_variants_ids_set.intersection(gene_unique_snps)
+        n_gene_unique_snps_in_gwas = int(gwas_variants.contains(list(gene_unique_snps)).sum())
 
         return pd.Series(
             {
                 "unique_n_snps_in_model": len(gene_unique_snps),
-                "unique_n_snps_used": len(gene_unique_snps_in_gwas),
+                "unique_n_snps_used": n_gene_unique_snps_in_gwas,
             }
         )
 
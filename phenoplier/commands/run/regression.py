@@ -72,6 +72,23 @@ class REGRESSION_MODEL(StrEnum):
 class GENE_CORREALATION_MODE(StrEnum):
     sub = "sub"
     full = "full"
+    banded = "banded"
+
+
+# Input files of traits read from a directory, and suffix of manifest files (one
+# input file per line)
+INPUT_FILES_SUFFIXES = (".tsv", ".tsv.gz")
+MANIFEST_SUFFIX = ".list"
+
+# Number of traits loaded and fitted together when several are given
+N_TRAITS_PER_CHUNK = 50
+
+
+class InvalidTraitData(ValueError):
+    """
+    Raised when the input file of a trait cannot be used (for instance, a
+    mandatory column is missing). With several traits, the trait is skipped.
+    """
 
 
 def check_config_files(dir: str) -> None:
@@ -96,11 +113,15 @@ def regression(
         lv_model_file: Annotated[Optional[Path], Args.LV_MODEL_FILE.value] = None,
         batch_id: Annotated[Optional[int], Args.BATCH_ID.value] = None,
         batch_n_splits: Annotated[Optional[int], Args.BATCH_N_SPLITS.value] = None,
+        n_jobs: Annotated[int, Args.N_JOBS.value] = 1,
 ) -> None:
     """
     Run the Generalized Least Squares (GLS) model by default. Note that you need to run "phenoplier init" first to set up the environment.
     """
 
+    # several traits are given in a directory or a manifest file
+    is_multi_trait = input_file.is_dir() or input_file.suffix == MANIFEST_SUFFIX
+
     def check_batch_args():
         if lv_list and (batch_id is not None or batch_n_splits is not None):
             print(err.INCOMPATIBLE_BATCH_ID_AND_LV_LIST)
@@ -126,6 +147,12 @@ def regression(
 
     # Todo: Use enums to store echo messages, can be reused in tests
     def check_output_file():
+        if is_multi_trait:
+            if not output_file.is_dir():
+                print(f"Error: output directory does not exist: {str(output_file)}")
+                raise typer.Exit(1)
+            return
+
         if output_file.exists():
             print(f"Skipping, output file exists: {str(output_file)}")
             # logger.info(f"Skipping, output file exists: {str(output_file)}")
@@ -146,228 +173,328 @@ def regression(
             print(err.EXPECT_NO_GENE_CORR_FILE)
             exit(2)
 
-    def read_input() -> pd.DataFrame:
-        data = pd.read_csv(input_file, sep="\t")
+        if n_jobs < 1:
+            print(err.EXPECT_N_JOBS_GT_ZERO)
+            exit(2)
+
+    def get_input_files() -> List[Path]:
+        if input_file.is_dir():
+            return sorted(
+                f for f in input_file.iterdir() if f.name.endswith(INPUT_FILES_SUFFIXES)
+            )
+
+        if input_file.suffix == MANIFEST_SUFFIX:
+            with open(input_file) as f:
+                files = [
+                    (input_file.parent / line.strip()).resolve()
+                    for line in f
+                    if line.strip()
+                ]
+
+            missing_files = [str(f) for f in files if not f.exists()]
+            if missing_files:
+                print(f"Error: input files in manifest do not exist: {missing_files}")
+                raise typer.Exit(1)
+
+            return files
+
+        return [input_file]
+
+    def get_output_file(trait_input_file: Path) -> Path:
+        if not is_multi_trait:
+            return output_file
+
+        trait_name = trait_input_file.name
+        for suffix in (".gz",) + INPUT_FILES_SUFFIXES:
+            trait_name = trait_name.removesuffix(suffix)
+
+        return output_file / f"gls_phenoplier-{trait_name}.tsv.gz"
+
+    def read_input(trait_input_file: Path) -> pd.DataFrame:
+        data = pd.read_csv(trait_input_file, sep="\t")
         print(info.LOADING_INPUT)
         print(f"Input file has {data.shape[0]} genes")
 
         if "gene_name" not in data.columns:
             # logger.error("Mandatory columns not present in data 'gene_name'")
-            print(err.NO_GENE_NAME_COLUMN)
-            sys.exit(1)
+            raise InvalidTraitData(err.NO_GENE_NAME_COLUMN)
 
         if "pvalue" not in data.columns:
-            print(err.NO_P_VALUE_COLUMN)
             # logger.error("Mandatory columns not present in data 'pvalue'")
-            sys.exit(1)
+            raise InvalidTraitData(err.NO_P_VALUE_COLUMN)
 
         data = data.set_index("gene_name")
         return data
 
-    def remove_dup_gene_entries(input_data: pd.DataFrame) -> (pd.DataFrame, bool):
+    def get_dup_genes_keep_action():
+        # the 'keep' argument of pandas' Index.duplicated
         if dup_genes_action is DUP_GENE_ACTIONS.no_action:
-            return input_data, False
+            return False
 
         if dup_genes_action.startswith("keep"):
-            action = dup_genes_action.split("-")[1]
+            return dup_genes_action.split("-")[1]
         elif dup_genes_action == "remove-all":
-            action = False
+            return False
         else:
             raise ValueError("Wrong --dup-gene-action value")
 
-        dedup_data = input_data.loc[~input_data.index.duplicated(keep=action)]
+    def remove_dup_gene_entries(input_data: pd.DataFrame) -> pd.DataFrame:
+        if dup_genes_action is DUP_GENE_ACTIONS.no_action:
+            return input_data
+
+        dedup_data = input_data.loc[~input_data.index.duplicated(keep=get_dup_genes_keep_action())]
         print(
             f"Removed duplicated genes symbols using '{dup_genes_action}'. "
             f"Data now has {dedup_data.shape[0]} genes"
         )
-        return dedup_data, action
-
-    # Check arguments
-    check_batch_args()
-    check_model_args()
-    check_output_file()
-
-    # Load config files
-    load_settings_files(Path(project_dir))
+        return dedup_data
 
-    # Load input data
-    data = read_input()
-    data, keep_action = remove_dup_gene_entries(data)
-    # unique index (gene names)
-    if not data.index.is_unique:
-        # logger.error(
-        #     "Duplicated genes in input data. Use option --dup-gene-action "
-        #     "if you want to skip them."
-        # )
-        print(err.DUP_GENES_FOUND)
-        sys.exit(1)
-
-    # Print out useful information
-    covars_info = (
-        f"Using DEFAULT covariates: {Regression_Defaults.COVARS.value}" if covars == "default"
-        else f"Using covariates {covars}" if covars
-        else f"Running {model} without covariates."
-    )
-    print("[blue][Info]: " + covars_info)
-    # pvalues statistics
-    _data_pvalues = data["pvalue"]
-    n_missing = _data_pvalues.isna().sum()
-    n = _data_pvalues.shape[0]
-    min_pval = _data_pvalues.min()
-    mean_pval = _data_pvalues.mean()
-    max_pval = _data_pvalues.max()
-
-    # logger.info(
-    #     f"p-values statistics: min={min_pval:.1e} | mean={mean_pval:.1e} | max={max_pval:.1e} | # missing={n_missing} ({(n_missing / n) * 100:.1f}%)"
-    # )
-    print(f"p-values statistics: "
-          f"min={min_pval:.1e} | "
-          f"mean={mean_pval:.1e} | "
-          f"max={max_pval:.1e} | "
-          f"# missing={n_missing} ({(n_missing / n) * 100:.1f}%)")
-
-    if min_pval < 0.0:
-        # logger.warning("Some p-values are smaller than 0.0")
-        print("Some p-values are smaller than 0.0")
-
-    if max_pval > 1.0:
-        print("Some p-values are greater than 1.0")
-        # logger.warning("Some p-values are greater than 1.0")
-
-    final_data = data.loc[:, ["pvalue"]].rename(
-        columns={
-            "pvalue": "y",
-        }
-    )
+    def get_covars_selected() -> List[str]:
+        if covars is None:
+            return []
 
-    # Add covariates (if specified)
-    if covars is not None:
         covars_selected = str.split(covars, " ")
-        print("Covars selected: ", covars)
-
         if "all" in covars_selected:
             covars_selected = [c for c in COVAR_OPTIONS if c != "all"]
 
         if "default" in covars_selected:
             covars_selected = COVAR_OPTIONS_DEFAULT
 
-        covars_selected = sorted(covars_selected)
-
-        # logger.info(f"Using covariates: {covars_selected}")
-        print(f"Using covariates: {covars_selected}")
-
-        # get necessary columns from results
-        covars = data[["pvalue", "n", "n_indep"]]
-        covars = covars.rename(
-            columns={
-                "n_indep": "gene_size",
-            }
-        )
-
-        if "gene_density" in covars_selected:
-            covars = covars.assign(
-                gene_density=covars.apply(lambda x: x["gene_size"] / x["n"], axis=1)
-            )
+        return sorted(covars_selected)
 
-        # process snp-level covariates
-        if any(
+    def load_cohort_gene_tissues() -> Optional[pd.DataFrame]:
+        """
+        Reads the cohort metadata needed by SNP-level covariates (if any are
+        selected). It is shared by all traits, so it is read only once.
+        """
+        if not any(
                 c.startswith(snplevel_c)
-                for c in covars_selected
+                for c in get_covars_selected()
                 for snplevel_c in SNPLEVEL_COVAR_OPTIONS_PREFIXES
         ):
-            # first load the cohort metadata gene tissues file
-            if cohort_metadata_dir is None:
+            return None
+
+        # first load the cohort metadata gene tissues file
+        if cohort_metadata_dir is None:
+            # logger.error(
+            #     "To use SNP-level covariates, a cohort metadata folder must "
+            #     "be provided (--cohort-metadata-dir)"
+            # )
+            print(
+                "To use SNP-level covariates, a cohort metadata folder must "
+                "be provided (--cohort-metadata-dir)"
+            )
+            sys.exit(1)
+
+        cohort_metadata_path = Path(cohort_metadata_dir).resolve()
+        cohort_gene_tissues_filepath = cohort_metadata_path / "gene_tissues.pkl"
+        if not cohort_gene_tissues_filepath.exists():
+            cohort_gene_tissues_filepath = cohort_gene_tissues_filepath.with_suffix(
+                ".pkl.gz"
+            )
+            assert cohort_gene_tissues_filepath.exists(), (
+                f"No gene_tissues.pkl[.gz] exists in cohort metadata folder: "
+                f"{cohort_metadata_path}"
+            )
+
+        # logger.info(f"Loading cohort metadata: {str(cohort_gene_tissues_filepath)}")
+        print(f"Loading cohort metadata: {str(cohort_gene_tissues_filepath)}")
+        cohort_gene_tissues = pd.read_pickle(
+            cohort_gene_tissues_filepath
+        ).set_index("gene_name")
+        # remove duplicated gene names
+        if not cohort_gene_tissues.index.is_unique:
+            if dup_genes_action is None:
                 # logger.error(
-                #     "To use SNP-level covariates, a cohort metadata folder must "
-                #     "be provided (--cohort-metadata-dir)"
+                #     "There are duplicated gene names in cohort metadat files, --dup-gene-action must be specified"
                 # )
                 print(
-                    "To use SNP-level covariates, a cohort metadata folder must "
-                    "be provided (--cohort-metadata-dir)"
-                )
+                    "There are duplicated gene names in cohort metadat files, --dup-gene-action must be specified")
                 sys.exit(1)
 
-            cohort_metadata_dir = Path(cohort_metadata_dir).resolve()
-            cohort_gene_tissues_filepath = cohort_metadata_dir / "gene_tissues.pkl"
-            if not cohort_gene_tissues_filepath.exists():
-                cohort_gene_tissues_filepath = cohort_gene_tissues_filepath.with_suffix(
-                    ".pkl.gz"
-                )
-                assert cohort_gene_tissues_filepath.exists(), (
-                    f"No gene_tissues.pkl[.gz] exists in cohort metadata folder: "
-                    f"{cohort_metadata_dir}"
-                )
+            cohort_gene_tissues = cohort_gene_tissues.loc[
+                ~cohort_gene_tissues.index.duplicated(keep=get_dup_genes_keep_action())
+            ]
+
+        return cohort_gene_tissues
+
+    def load_trait_data(trait_input_file: Path, cohort_gene_tissues: Optional[pd.DataFrame]):
+        """
+        Reads the S-MultiXcan results of one trait and returns the data used to
+        fit the model: the dependent variable (-log10(pvalue)) and covariates (if any).
+        cohort_gene_tissues is the cohort metadata (see load_cohort_gene_tissues).
+        It raises InvalidTraitData if the input file cannot be used.
+        """
+        # Load input data
+        data = read_input(trait_input_file)
+        data = remove_dup_gene_entries(data)
+        # unique index (gene names)
+        if not data.index.is_unique:
+            # logger.error(
+            #     "Duplicated genes in input data. Use option --dup-gene-action "
+            #     "if you want to skip them."
+            # )
+            raise InvalidTraitData(err.DUP_GENES_FOUND)
+
+        # Print out useful information
+        covars_info = (
+            f"Using DEFAULT covariates: {Regression_Defaults.COVARS.value}" if covars == "default"
+            else f"Using covariates {covars}" if covars
+            else f"Running {model} without covariates."
+        )
+        print("[blue][Info]: " + covars_info)
+        # pvalues statistics
+        _data_pvalues = data["pvalue"]
+        n_missing = _data_pvalues.isna().sum()
+        n = _data_pvalues.shape[0]
+        min_pval = _data_pvalues.min()
+        mean_pval = _data_pvalues.mean()
+        max_pval = _data_pvalues.max()
 
-            # logger.info(f"Loading cohort metadata: {str(cohort_gene_tissues_filepath)}")
-            print(f"Loading cohort metadata: {str(cohort_gene_tissues_filepath)}")
-            cohort_gene_tissues = pd.read_pickle(
-                cohort_gene_tissues_filepath
-            ).set_index("gene_name")
-            # remove duplicated gene names
-            if not cohort_gene_tissues.index.is_unique:
-                if dup_genes_action is None:
-                    # logger.error(
-                    #     "There are duplicated gene names in cohort metadat files, --dup-gene-action must be specified"
-                    # )
-                    print(
-                        "There are duplicated gene names in cohort metadat files, --dup-gene-action must be specified")
-                    sys.exit(1)
+        # logger.info(
+        #     f"p-values statistics: min={min_pval:.1e} | mean={mean_pval:.1e} | max={max_pval:.1e} | # missing={n_missing} ({(n_missing / n) * 100:.1f}%)"
+        # )
+        print(f"p-values statistics: "
+              f"min={min_pval:.1e} | "
+              f"mean={mean_pval:.1e} | "
+              f"max={max_pval:.1e} | "
+              f"# missing={n_missing} ({(n_missing / n) * 100:.1f}%)")
 
-                cohort_gene_tissues = cohort_gene_tissues.loc[
-                    ~cohort_gene_tissues.index.duplicated(keep=keep_action)
-                ]
+        if min_pval < 0.0:
+            # logger.warning("Some p-values are smaller than 0.0")
+            print("Some p-values are smaller than 0.0")
+
+        if max_pval > 1.0:
+            print("Some p-values are greater than 1.0")
+            # logger.warning("Some p-values are greater than 1.0")
+
+        final_data = data.loc[:, ["pvalue"]].rename(
+            columns={
+                "pvalue": "y",
+            }
+        )
 
-            common_genes = final_data.index.intersection(cohort_gene_tissues.index)
-            cohort_gene_tissues = cohort_gene_tissues.loc[common_genes]
+        # Add covariates (if specified)
+        if covars is not None:
+            print("Covars selected: ", covars)
+            covars_selected = get_covars_selected()
 
-            # check individual covariates
-            if "gene_n_snps_used" in covars_selected:
-                covars = covars.assign(
-                    gene_n_snps_used=cohort_gene_tissues["n_snps_used_sum"]
+            # logger.info(f"Using covariates: {covars_selected}")
+            print(f"Using covariates: {covars_selected}")
+
+            # get necessary columns from results
+            covars_data = data[["pvalue", "n", "n_indep"]]
+            covars_data = covars_data.rename(
+                columns={
+                    "n_indep": "gene_size",
+                }
+            )
+
+            if "gene_density" in covars_selected:
+                covars_data = covars_data.assign(
+                    gene_density=covars_data.apply(lambda x: x["gene_size"] / x["n"], axis=1)
                 )
 
-            if "gene_n_snps_used_density" in covars_selected:
-                covars = covars.assign(
-                    gene_n_snps_used_density=cohort_gene_tissues.apply(
-                        lambda x: x["n_snps_used_sum"] / x["unique_n_snps_used"],
-                        axis=1,
+            # process snp-level covariates
+            if cohort_gene_tissues is not None:
+                common_genes = final_data.index.intersection(cohort_gene_tissues.index)
+                cohort_gene_tissues = cohort_gene_tissues.loc[common_genes]
+
+                # check individual covariates
+                if "gene_n_snps_used" in covars_selected:
+                    covars_data = covars_data.assign(
+                        gene_n_snps_used=cohort_gene_tissues["n_snps_used_sum"]
                     )
-                )
 
-        # add log versions of covariates (if specified)
-        for c in covars_selected:
-            if c.endswith("_log"):
-                c_prefix = c.split("_log")[0]
-
-                if c_prefix not in covars.columns:
-                    # logger.error(
-                    #     f"If log version of covar is selected, covar has to be "
-                    #     f"selected as well ({c_prefix} not present)"
-                    # )
-                    print(
-                        f"If log version of covar is selected, covar has to be "
-                        f"selected as well ({c_prefix} not present)"
+                if "gene_n_snps_used_density" in covars_selected:
+                    covars_data = covars_data.assign(
+                        gene_n_snps_used_density=cohort_gene_tissues.apply(
+                            lambda x: x["n_snps_used_sum"] / x["unique_n_snps_used"],
+                            axis=1,
+                        )
                     )
+
+            # add log versions of covariates (if specified)
+            for c in covars_selected:
+                if c.endswith("_log"):
+                    c_prefix = c.split("_log")[0]
+
+                    if c_prefix not in covars_data.columns:
+                        # logger.error(
+                        #     f"If log version of covar is selected, covar has to be "
+                        #     f"selected as well ({c_prefix} not present)"
+                        # )
+                        print(
+                            f"If log version of covar is selected, covar has to be "
+                            f"selected as well ({c_prefix} not present)"
+                        )
+                        sys.exit(1)
+
+                    covars_data[c] = np.log(covars_data[c_prefix])
+                    if "density" in c_prefix:
+                        covars_data[c] = -1 * covars_data[c]
+
+            final_data = pd.concat([final_data, covars_data[covars_selected]], axis=1)
+
+        # convert p-values
+        # logger.info("Replacing zero p-values by nonzero minimum divided by 10")
+        print("Replacing zero p-values by nonzero minimum divided by 10")
+        min_nonzero_pvalue = final_data[final_data["y"] > 0]["y"].min() / 10.0
+        final_data["y"] = final_data["y"].replace(0, min_nonzero_pvalue)
+
+        # logger.info("Using -log10(pvalue)")
+        print("Using -log10(pvalue)")
+        final_data["y"] = -np.log10(final_data["y"])
+
+        if final_data.shape[1] == 1:
+            final_data = final_data.squeeze().rename(trait_input_file.stem)
+
+        return final_data
+
+    def load_traits_data(traits_chunk: List[Path], cohort_gene_tissues: Optional[pd.DataFrame]) -> dict:
+        """
+        Loads the data of several traits (see load_trait_data). With several
+        traits, a trait whose input file cannot be used is skipped, so the rest
+        are still fitted; with one trait, the command exits with an error.
+        """
+        traits_data = {}
+        for trait_input_file in traits_chunk:
+            try:
+                traits_data[trait_input_file] = load_trait_data(trait_input_file, cohort_gene_tissues)
+            except InvalidTraitData as e:
+                print(str(e))
+                if not is_multi_trait:
                     sys.exit(1)
 
-                covars[c] = np.log(covars[c_prefix])
-                if "density" in c_prefix:
-                    covars[c] = -1 * covars[c]
+                logger.warning(f"Skipping trait, input file cannot be used: {str(trait_input_file)} ({str(e)})")
 
-        final_data = pd.concat([final_data, covars[covars_selected]], axis=1)
+        return traits_data
+
+    # Check arguments
+    check_batch_args()
+    check_model_args()
+    check_output_file()
 
-    # convert p-values
-    # logger.info("Replacing zero p-values by nonzero minimum divided by 10")
-    print("Replacing zero p-values by nonzero minimum divided by 10")
-    min_nonzero_pvalue = final_data[final_data["y"] > 0]["y"].min() / 10.0
-    final_data["y"] = final_data["y"].replace(0, min_nonzero_pvalue)
+    # Load config files
+    load_settings_files(Path(project_dir))
 
-    # logger.info("Using -log10(pvalue)")
-    print("Using -log10(pvalue)")
-    final_data["y"] = -np.log10(final_data["y"])
+    # Traits with existing output files are skipped (only with several traits;
+    # with one trait, check_output_file already exits)
+    traits_files = [
+        f for f in get_input_files() if not get_output_file(f).exists()
+    ]
+    if is_multi_trait:
+        print(f"{len(traits_files)} traits to process")
+        if len(traits_files) == 0:
+            raise typer.Exit(0)
 
-    if final_data.shape[1] == 1:
-        final_data = final_data.squeeze().rename(input_file.stem)
+    # Load input data (traits are processed in chunks to bound memory usage)
+    traits_chunks = [
+        traits_files[i: i + N_TRAITS_PER_CHUNK]
+        for i in range(0, len(traits_files), N_TRAITS_PER_CHUNK)
+    ]
+    cohort_gene_tissues = load_cohort_gene_tissues()
+    traits_data = load_traits_data(traits_chunks[0], cohort_gene_tissues)
 
     if gene_corr_file is not None:
         # logger.info(f"Using gene correlation file: {gene_corr_file}")
@@ -431,39 +558,27 @@ def regression(
         debug_use_ols=True if model == "ols" else False,
         debug_use_sub_gene_corr=True if gene_corr_mode == "sub" else False,
         use_own_implementation=True,
+        n_jobs=n_jobs,
+        use_banded_gene_corrs=True if gene_corr_mode == "banded" else False,
         logger=logger,
     )
 
-    results = []
-
-    # compute an association between each LV and the gene-trait associations
-    for lv_idx, lv_code in enumerate(selected_lvs):
-        print(f"Computing for {lv_code}")
-        # logger.info(f"Computing for {lv_code}")
-
-        # show warnings or logs only in the first run
-        if lv_idx == 0:
-            gls_model.set_logger(logger)
-        elif lv_idx == 1:
-            gls_model.set_logger(None)
-
-        gls_model.fit_named(lv_code, final_data)
-
-        res = gls_model.results
-
-        results.append(
-            {
-                "lv": lv_code,
-                "beta": res.params.loc["lv"],
-                "beta_se": res.bse.loc["lv"],
-                "t": res.tvalues.loc["lv"],
-                # "pvalue_twosided": res.pvalues.loc["lv"],
-                "pvalue": res.pvalues_onesided.loc["lv"],
-            }
-        )
-
-    # create final dataframe and save
-    results = pd.DataFrame(results).set_index("lv").sort_values("pvalue")
-    print(f"Writing results to {str(output_file)}")
-    # logger.info(f"Writing results to {str(output_file)}")
-    results.to_csv(output_file, sep="\t", na_rep="NA")
+    for chunk_idx, traits_chunk in enumerate(traits_chunks):
+        if chunk_idx > 0:
+            traits_data = load_traits_data(traits_chunk, cohort_gene_tissues)
+
+        if len(traits_data) == 0:
+            continue
+
+        # compute an association between each LV and the gene-trait associations
+        # (all selected LVs and traits in the chunk are fitted at once)
+        print(f"Computing for {len(selected_lvs)} LVs and {len(traits_data)} traits")
+        traits_results = gls_model.fit_named_batch_traits(selected_lvs, traits_data, lv_model_file)
+
+        for trait_input_file, results in traits_results.items():
+            # create final dataframe and save
+            results = results[["beta", "beta_se", "t", "pvalue"]].sort_values("pvalue")
+            trait_output_file = get_output_file(trait_input_file)
+            print(f"Writing results to {str(trait_output_file)}")
+            # logger.info(f"Writing results to {str(trait_output_file)}")
+            results.to_csv(trait_output_file, sep="\t", na_rep="NA")
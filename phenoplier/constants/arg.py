@@ -43,6 +43,18 @@ class Corr_Cov_Args(Enum):
     EQTL_MODEL = Common_Args.EQTL_MODEL.value
     COVARIANCE_MATRIX_DTYPE = typer.Option("--covariance-matrix-dtype", "-t",
                                            help="The numpy dtype used for the covariance matrix.")
+    BATCH_SIZE = typer.Option("--batch-size", min=2,
+                              help="Maximum number of samples (rows of the reference panel genotype files) used at "
+                                   "a time to update the covariance matrix.")
+    LD_BLOCKS = typer.Option("--ld-blocks",
+                             help="Only compute covariances between SNPs in the same LD region (see --ld-regions-file), "
+                                  "instead of the whole covariance matrix of each chromosome.")
+    LD_REGIONS_FILE = typer.Option("--ld-regions-file",
+                                   help="BED file with LD regions used with --ld-blocks. By default, the file "
+                                        "downloaded by the 'get' command (GENERAL.EUR_LD_REGIONS_FILE) is used.")
+    N_JOBS = typer.Option("--n-jobs", "-j", min=1,
+                          help="Number of processes used to compute the covariance of chromosomes in parallel. Each "
+                               "chromosome's covariance matrix is in memory while it is computed.")
     OUTPUT_DIR = typer.Option("--output-dir", "-o", help="User-defined output directory for the covariance matrix. "
                                                          "This argument supersedes the project configuration.")
 
@@ -54,6 +66,9 @@ class Corr_Preprocess_Args(Enum):
     SPREDIXCAN_FOLDER = typer.Option("--spredixcan-folder", "-s", help="S-PrediXcan folder.")
     SPREDIXCAN_FILE_PATTERN = typer.Option("--spredixcan-file-pattern", "-n", help="S-PrediXcan file pattern.")
     SMULTIXCAN_FILE = typer.Option("--smultixcan-file", "-f", help="S-MultiXcan file.")
+    SMULTIXCAN_CONDITION_NUMBER = typer.Option("--smultixcan-condition-number", "-num",
+                                               help="S-MultiXcan condition number. It must be the same one used by the "
+                                                    "'correlate' command.")
     REFERENCE_PANEL = Common_Args.REFERENCE_PANEL.value
     EQTL_MODEL = Common_Args.EQTL_MODEL.value
     PROJECT_DIR = Common_Args.PROJECT_DIR.value
@@ -75,6 +90,19 @@ class Corr_Correlate_Args(Enum):
     OUTPUT_DIR = typer.Option("--output-dir", "-o", help="User-defined output directory for predicted expression correlations. "
                                                          "This argument supersedes the project configuration.")
     INPUT_DIR = typer.Option("--input-dir", "-i", help="User-defined input data directory containing previous steps' results")
+    N_SHARDS = typer.Option("--n-shards", min=1,
+                            help="Split the gene pairs of the chromosome into this number of shards (with a similar "
+                                 "amount of work), so they can be computed by different processes or nodes. Each shard "
+                                 "is written to the 'by_chr/shards' folder (see --shard-index and --merge-shards).")
+    SHARD_INDEX = typer.Option("--shard-index", min=0,
+                               help="The shard to compute (from 0 to the number of shards minus one).")
+    MERGE_SHARDS = typer.Option("--merge-shards",
+                                help="Assemble all shards computed before into the correlation matrix of the "
+                                     "chromosome.")
+    WINDOW_DISTANCE = typer.Option("--window-distance", min=0.0,
+                                   help="Only compute correlations between genes within this distance (in mb, as in the "
+                                        "'filter' command). Gene pairs farther apart are not visited, and the correlation "
+                                        "matrix of the chromosome is stored as a sparse data frame.")
 
 
 class Corr_Postprocess_Args(Enum):
@@ -95,7 +123,9 @@ class Corr_Filter_Args(Enum):
     EQTL_MODEL = Common_Args.EQTL_MODEL.value
     DISTANCES = typer.Option("--distances", "-d", help="List of distances to generate correlation matrices for.")
     PROJECT_DIR = Common_Args.PROJECT_DIR.value
-    GENES_SYMBOLS = typer.Option("--genes-corrs-symbols", "-g", help="Path to the genes correlation symbols file.")
+    GENES_SYMBOLS = typer.Option("--genes-corrs-symbols", "-g",
+                                 help="Path to the genes correlation symbols file (a pickle file or a '.gene_corrs' "
+                                      "store folder).")
     OUTPUT_DIR = typer.Option("--output-dir", "-o", help="User-defined output directory for computed correlation matrix. "
                                                          "This argument supersedes the project configuration.")
 
@@ -110,12 +140,24 @@ class Corr_Generate_Args(Enum):
                                  help="A number from 0.0 to 1.0 indicating the top percentile of the genes in the LV "
                                       "to keep")
     PROJECT_DIR = Common_Args.PROJECT_DIR.value
-    GENES_SYMBOLS_DIR = typer.Option("--genes-symbols-dir", "-g", help="Path to the genes correlation symbols folder.")
+    GENES_SYMBOLS_DIR = typer.Option("--genes-symbols-dir", "-g",
+                                     help="Path to the genes correlation symbols folder. Matrices in '.gene_corrs' "
+                                          "store folders are used instead of pickle files with the same name.")
     OUTPUT_DIR = typer.Option("--output-dir", "-o",
                               help="User-defined output directory for computed LV-specific correlation matrix. "
                                    "This argument supersedes the project configuration.")
 
 
+class Corr_Convert_Args(Enum):
+    INPUT_DIR = typer.Option("--input-dir", "-i",
+                             help="Folder with LV-specific correlation matrices computed by the 'generate' command "
+                                  "(such as 'gene_corrs-symbols-within_distance_5mb.per_lv').")
+    OUTPUT_DIR = typer.Option("--output-dir", "-o",
+                              help="Output folder for the converted files. Default to the input folder.")
+    REMOVE_OLD_FILES = typer.Option("--remove-old-files", "-d",
+                                    help="Remove files in the old format (.npz) after conversion.")
+
+
 class Corr_Pipeline_Args(Enum):
     COHORT_NAME = Common_Args.COHORT_NAME.value
     GWAS_FILE = typer.Option("--gwas-file", "-g", help="GWAS file.")
@@ -127,6 +169,19 @@ class Corr_Pipeline_Args(Enum):
     PROJECT_DIR = Common_Args.PROJECT_DIR.value
     OUTPUT_DIR = typer.Option("--output-dir", "-o", help="User-defined output directory for the output results. This argument "
                                                          "supersedes the project configuration.")
+    N_JOBS = typer.Option("--n-jobs", "-j", min=1,
+                          help="Maximum number of 'correlate' jobs (one per chromosome) run in parallel. Default to the "
+                               "number of available cores, limited by the available memory (see --memory-per-job).")
+    MEMORY_PER_JOB = typer.Option("--memory-per-job", min=0.0,
+                                  help="Estimated memory (in GB) used by each 'correlate' job, used to limit the number "
+                                       "of jobs run in parallel.")
+    DISTANCES = typer.Option("--distances", help="List of distances (in mb) to generate correlation matrices for.")
+    LV_CODES = typer.Option("--lv-code", "-l",
+                            help="The code of a latent variable (LV) to compute the LV-specific correlation matrix for. "
+                                 "It can be given several times. If not given, the 'generate' stage is skipped.")
+    RESTART = typer.Option("--restart",
+                           help="Run all stages again, ignoring the checkpoints of a previous run in the output "
+                                "directory.")
 
 
 # Command Group: run regression
@@ -139,13 +194,17 @@ def spaced_list(raw: str) -> list[str]:
 class Regression_Args(Enum):
     INPUT_FILE = typer.Option("--input-file", "-i",
                               help="File path to S-MultiXcan result file (tab-separated and with at least columns "
-                                   "'gene' and 'pvalue').",
+                                   "'gene' and 'pvalue'). To process several traits at once, it can also be a "
+                                   "directory with S-MultiXcan result files (*.tsv or *.tsv.gz), or a manifest file "
+                                   "(*.list) with one S-MultiXcan result file path per line.",
                               exists=True,
                               resolve_path=True,
                               )
 
     OUTPUT_FILE = typer.Option("--output-file", "-o",
-                               help="File path where results will be written to.",
+                               help="File path where results will be written to. If several traits are given "
+                                    "(see --input-file), it is the directory where results are written to (one file "
+                                    "per trait).",
                                )
 
     PROJECT_DIR = Common_Args.PROJECT_DIR.value
@@ -155,11 +214,15 @@ class Regression_Args(Enum):
                               "purpose.")
 
     GENE_CORR_FILE = typer.Option("--gene-corr-file", "-g",
-                                  help="Path to a gene correlations file or folder. It's mandatory if running a GLS "
-                                       "model, and not necessary for OLS.")
+                                  help="Path to a gene correlations file or folder (a '.gene_corrs' store or a "
+                                       "'.per_lv' folder). It's mandatory if running a GLS model, and not necessary "
+                                       "for OLS.")
 
     GENE_CORR_MODE = typer.Option("--gene-corr-mode", "-m",
-                                  help="Use an LV-specific submatrix of the gene correlation matrix.")
+                                  help="Use an LV-specific submatrix of the gene correlation matrix (sub), or the "
+                                       "full one (full). With 'banded', the full matrix is factorized as a "
+                                       "banded/sparse matrix, which is faster if it was filtered by distance "
+                                       "('run gene-corr filter').")
 
     DUP_GENES_ACTION = typer.Option("--dup-genes-action", "-d",
                                     help="Decide how to deal with duplicate gene entries in the input file. Mandatory "
@@ -191,6 +254,10 @@ class Regression_Args(Enum):
                                   help="With --batch-id, it allows to distribute computation of each LV-trait pair "
                                        "across a set of batches.")
 
+    N_JOBS = typer.Option("--n-jobs", "-j",
+                          help="Number of processes used to fit LVs in parallel. Only used with LV-specific gene "
+                               "correlation matrices (--gene-corr-mode sub).")
+
 
 # Const help messages for the "run" command
 class Run_Args(Enum):
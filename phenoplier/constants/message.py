@@ -12,6 +12,7 @@ class RegressionError(StrEnum):
     EXPECT_BATCH_ID_GT_ZERO = "ERROR: --batch-id must be >= 1"
     INCOMPATIBLE_BATCH_ARGS = "ERROR: --batch-id must be <= --batch-n-splits"
     EXPECT_BATCH_N_SPLITS_LT_LVS = "ERROR: --batch-n-splits cannot be greater than te number LVs in the model"
+    EXPECT_N_JOBS_GT_ZERO = "ERROR: --n-jobs must be >= 1"
 
 class RegressionInfo(StrEnum):
     LOADING_INPUT = "INFO: Loading input data..."
@@ -7,6 +7,8 @@ import pandas as pd
 from statsmodels.stats.correlation_tools import corr_nearest
 from IPython.display import display
 
+from phenoplier.whitening import CholeskyWhitener
+
 
 def check_pos_def(matrix: pd.DataFrame, debug_messages: bool = True):
     """
@@ -35,7 +37,7 @@ def check_pos_def(matrix: pd.DataFrame, debug_messages: bool = True):
     CHOL_DECOMPOSITION_WORKED = None
 
     try:
-        np.linalg.inv(np.linalg.cholesky(matrix.to_numpy()))
+        CholeskyWhitener.from_corr_matrix(matrix.to_numpy())
         _print("Works!")
         CHOL_DECOMPOSITION_WORKED = True
     except Exception as e:
@@ -15,6 +15,8 @@ import pandas as pd
 from phenoplier.config import settings as conf
 from phenoplier.cache import read_data
 from phenoplier.commands.util.utils import get_model_tissue_names
+from phenoplier.prediction_weights import PredictionWeightsIndex, connect_tissue_weights
+from phenoplier.snps_cov_store import SnpsCovStore, get_snps_positions
 
 
 class Study(Enum):
@@ -696,23 +698,7 @@ class Gene(object):
         Returns:
             An read-only SQLite connection object.
         """
-        # check that the file for the tissue exists
-        model_prefix = conf.TWAS["PREDICTION_MODELS"][f"{model_type}_PREFIX"]
-
-        tissue_weights_file = (
-                Path(conf.TWAS["PREDICTION_MODELS"][model_type])
-                / f"{model_prefix}{tissue}.db"
-        )
-
-        if not tissue_weights_file.exists():
-            raise ValueError(
-                f"Model file for tissue does not exist: {str(tissue_weights_file)}"
-            )
-
-        import sqlite3
-
-        db_uri = f"file:{str(tissue_weights_file)}?mode=ro"
-        return sqlite3.connect(db_uri, uri=True)
+        return connect_tissue_weights(tissue, model_type)
 
     @lru_cache(maxsize=None)
     def get_prediction_weights(
@@ -737,7 +723,9 @@ class Gene(object):
                 that will be considered to compute the correlation. All snps
                 that are not present in this subset will be ignored. This is
                 used to make more accurate predictions given the SNPs in a GWAS,
-                for example.
+                for example. It can be a frozenset or, preferably, a
+                VariantSet (see phenoplier.variant_set), which is faster to
+                check and to use as a cache key.
 
         Returns:
             A pandas DataFrame with the variants' weight for the prediction of
@@ -745,43 +733,91 @@ class Gene(object):
              format) and its weight. It returns None if no predictors (SNPs) are
              available for the gene in this tissue/model.
         """
-        sqlite_conn = Gene._get_tissue_connection(tissue, model_type)
+        gene_w = self._get_prediction_weights_codes(tissue, model_type, snps_subset)
+        if gene_w is None:
+            return None
+
+        variant_codes, weights = gene_w
+        variants = PredictionWeightsIndex.get(model_type).variants
 
-        try:
-            query = f"""
-                select varID, weight
-                from weights
-                where gene like '{self.ensembl_id}.%'
-            """
+        return pd.Series(
+            weights,
+            index=pd.Index(variants[variant_codes], name="varID"),
+            name="weight",
+        )
+
+    @lru_cache(maxsize=None)
+    def _get_prediction_weights_codes(
+        self,
+        tissue: str,
+        model_type: str,
+        snps_subset: frozenset = None,
+    ):
+        """
+        Same as get_prediction_weights, but weights are returned as a tuple of
+        two numpy arrays: the variant codes (positions in
+        PredictionWeightsIndex.variants, sorted) and the weights. Variant codes
+        can be mapped to positions in the SNP covariance matrix with
+        _get_variants_cov_positions.
+        """
+        # weights of all genes are read once from the prediction models (see
+        # PredictionWeightsIndex)
+        weights_index = PredictionWeightsIndex.get(model_type)
+        variant_codes, weights = weights_index.get_weights_codes(self.ensembl_id, tissue)
 
-            df = pd.read_sql(query, sqlite_conn)
+        if weights.shape[0] == 0 or np.abs(weights).sum() == 0.0:
+            return None
 
-            if df.shape[0] == 0 or df["weight"].abs().sum() == 0.0:
+        if snps_subset is not None and len(snps_subset) > 0:
+            in_subset = weights_index.get_variants_mask(snps_subset)[variant_codes]
+            if not in_subset.any():
                 return None
+            variant_codes, weights = variant_codes[in_subset], weights[in_subset]
+
+        return variant_codes, weights
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def _get_chromosome_cov_positions(snps_chr, reference_panel: str, model_type: str):
+        """
+        Returns the positions in the SNP covariance matrix of a chromosome of
+        all variants of the chromosome in the prediction models, as a tuple
+        with the first variant code and a numpy array with the position of
+        each variant code from it (-1 for variants without genotypes).
+        """
+        variants = PredictionWeightsIndex.get(model_type).variants
+        start, end = PredictionWeightsIndex.get(model_type).get_chromosome_codes(snps_chr)
+        _, snps_cov_variants = Gene._read_snps_cov(snps_chr, reference_panel, model_type)
+
+        return start, get_snps_positions(snps_cov_variants, variants[start:end])
 
-            df = df.set_index("varID")["weight"]
+    @staticmethod
+    def _get_variants_cov_positions(variant_codes, reference_panel: str, model_type: str):
+        """
+        Given variant codes of the same chromosome (see
+        _get_prediction_weights_codes), it returns the SNP covariance matrix of
+        the chromosome and the positions of the variants in it (-1 for variants
+        without genotypes). Only numpy operations are used.
+        """
+        variants = PredictionWeightsIndex.get(model_type).variants
+        snps_chr = variants[variant_codes[0]].split("_")[0]
 
-            if snps_subset is not None and len(snps_subset) > 0:
-                snps = snps_subset.intersection(set(df.index))
-                if len(snps) == 0:
-                    return None
-                df = df.loc[snps]
+        snps_cov, _ = Gene._read_snps_cov(snps_chr, reference_panel, model_type)
+        start, cov_positions = Gene._get_chromosome_cov_positions(
+            snps_chr, reference_panel, model_type
+        )
 
-            return df.sort_index()
-        finally:
-            sqlite_conn.close()
+        return snps_cov, cov_positions[variant_codes - start]
 
     @staticmethod
-    @lru_cache(maxsize=1)
     def _read_snps_cov(snps_chr, reference_panel: str, model_type: str):
         """
         Returns the covariance matrix for all SNPs (in the predictions models)
-        in a chromosome. The structure returned (a tuple with three elements,
-        see below) is thought to speed up processing in other parts of the code.
-
-        For this function, lru_cache/maxsize is 1 because the idea is to call
-        always on the same chromosome in sequence to speed up but avoid high
-        memory consumption.
+        in a chromosome. Matrices are read from a SnpsCovStore as
+        memory-mapped arrays, and several chromosomes are kept open (see
+        SnpsCovStore), so callers can interleave chromosomes. If the 'cov'
+        command was run with LD blocks, the matrix is a BlockDiagonalCov, and
+        indexing it (always with np.ix_) only reads the blocks of the SNPs.
 
         Args:
             snps_chr:
@@ -793,30 +829,12 @@ class Gene(object):
                 The prediction model type, such as "MASHR" or "ELASTIC_NET" (see
                 conf.py).
         Returns:
-            A tuple with three elements:
-                1. A square numpy array with SNPs covariances.
-                2. A set with SNPs ids
-                3. A dictionary with SNPs ids in keys and positions as values.
+            A tuple with two elements:
+                1. A square numpy array (or BlockDiagonalCov) with SNPs
+                   covariances.
+                2. A numpy array with the SNPs ids (sorted) in rows/columns.
         """
-        input_dir = (
-                Path(conf.RESULTS["GLS"])
-                / "gene_corrs"
-                / "reference_panels"
-                / reference_panel.lower()
-                / model_type.lower()
-        )
-        snps_cov_file = input_dir / "snps_chr_blocks_cov.h5"
-        assert snps_cov_file.exists(), f"Input file does not exist: {snps_cov_file}"
-
-        # go to disk and read the data
-        with pd.HDFStore(snps_cov_file, mode="r") as store:
-            snp_cov = store[snps_chr].sort_index(axis=0).sort_index(axis=1)
-            snp_cov_variants = set(snp_cov.index)
-            snp_index_dict = {
-                snp_id: snp_idx for snp_idx, snp_id in enumerate(snp_cov.index)
-            }
-
-            return snp_cov.to_numpy(), snp_cov_variants, snp_index_dict
+        return SnpsCovStore.get_store(reference_panel, model_type).get(snps_chr)
 
     @staticmethod
     @lru_cache(maxsize=None)
@@ -914,32 +932,27 @@ class Gene(object):
                 raise ValueError("Only snps from the same chromosome are supported")
 
         # read the entire covariance matrix for this chromosome
-        snps_cov, snps_cov_variants, snp_index_dict = Gene._read_snps_cov(
+        snps_cov, snps_cov_variants = Gene._read_snps_cov(
             snps_chr, reference_panel, model_type
         )
 
         # from the specified SNP lists, only keep those for which we have
         # genotypes
         def _get_snps_with_genotypes(snps_list):
-            snps_ids_with_genotype = []
-            snps_pos_with_genotype = []
-
-            for v_idx, v in enumerate(snps_list):
-                if v in snps_cov_variants:
-                    snps_ids_with_genotype.append(v)
-                    snps_pos_with_genotype.append(v_idx)
+            snps_cov_pos = get_snps_positions(snps_cov_variants, snps_list)
+            snps_pos_with_genotype = np.flatnonzero(snps_cov_pos >= 0)
+            snps_ids_with_genotype = [snps_list[i] for i in snps_pos_with_genotype]
+
+            return (
+                snps_ids_with_genotype,
+                snps_pos_with_genotype.tolist(),
+                snps_cov_pos[snps_pos_with_genotype],
+            )
 
-            return snps_ids_with_genotype, snps_pos_with_genotype
+        snps_ids_list1, snps_pos_list1, snps_cov_pos1 = _get_snps_with_genotypes(snps_ids_list1)
+        snps_ids_list2, snps_pos_list2, snps_cov_pos2 = _get_snps_with_genotypes(snps_ids_list2)
 
-        snps_ids_list1, snps_pos_list1 = _get_snps_with_genotypes(snps_ids_list1)
-        snps_ids_list2, snps_pos_list2 = _get_snps_with_genotypes(snps_ids_list2)
-
-        snps_cov = snps_cov[
-            np.ix_(
-                [snp_index_dict[v] for v in snps_ids_list1],
-                [snp_index_dict[v] for v in snps_ids_list2],
-            )
-        ]
+        snps_cov = snps_cov[np.ix_(snps_cov_pos1, snps_cov_pos2)]
 
         if snps_cov.shape[0] == 0 or snps_cov.shape[1] == 0:
             return None
@@ -981,21 +994,24 @@ class Gene(object):
         Returns:
             A float with the covariance of the gene predicted expression.
         """
-        w = self.get_prediction_weights(tissue, model_type, snps_subset=snps_subset)
-        if w is None:
+        gene_w = self._get_prediction_weights_codes(tissue, model_type, snps_subset)
+        if gene_w is None:
             return None
+        variant_codes, w = gene_w
 
-        # LD of snps in gene model
-        gene_snps_cov_data = Gene._get_snps_cov(
-            w.index, reference_panel=reference_panel, model_type=model_type
+        # LD of snps in gene model (only those with genotypes)
+        snps_cov, snps_pos = Gene._get_variants_cov_positions(
+            variant_codes, reference_panel, model_type
         )
-        if gene_snps_cov_data is None:
+        with_genotypes = snps_pos >= 0
+        if not with_genotypes.any():
             return None
 
-        gene_snps_cov, (_, snps_pos) = gene_snps_cov_data[:2]
+        snps_pos = snps_pos[with_genotypes]
+        gene_snps_cov = snps_cov[np.ix_(snps_pos, snps_pos)]
 
         # gene model weights
-        w = w.to_numpy()[np.ix_(snps_pos)]
+        w = w[with_genotypes]
 
         # return variance of gene's predicted expression using formula from:
         #   - MetaXcan paper: https://doi.org/10.1038/s41467-018-03621-1
@@ -1057,14 +1073,12 @@ class Gene(object):
         if other_tissue is not None:
             other_gene_tissue = other_tissue
 
-        gene_w = self.get_prediction_weights(
-            tissue, model_type, snps_subset=snps_subset
-        )
+        gene_w = self._get_prediction_weights_codes(tissue, model_type, snps_subset)
         if gene_w is None:
             return None
 
-        other_gene_w = other_gene.get_prediction_weights(
-            other_gene_tissue, model_type, snps_subset=snps_subset
+        other_gene_w = other_gene._get_prediction_weights_codes(
+            other_gene_tissue, model_type, snps_subset
         )
         if other_gene_w is None:
             return None
@@ -1082,16 +1096,18 @@ class Gene(object):
         if other_gene_var is None or other_gene_var == 0.0:
             return None
 
-        (snps_cov, (_, snps_pos_list1), (_, snps_pos_list2),) = self._get_snps_cov(
-            gene_w.index,
-            other_gene_w.index,
-            reference_panel=reference_panel,
-            model_type=model_type,
+        # align weights with snps cov (only snps with genotypes)
+        snps_cov, snps_pos_list1 = Gene._get_variants_cov_positions(
+            gene_w[0], reference_panel, model_type
         )
-
-        # align weights with snps cov
-        gene_w = gene_w.to_numpy()[np.ix_(snps_pos_list1)]
-        other_gene_w = other_gene_w.to_numpy()[np.ix_(snps_pos_list2)]
+        _, snps_pos_list2 = Gene._get_variants_cov_positions(
+            other_gene_w[0], reference_panel, model_type
+        )
+        gene_w = gene_w[1][snps_pos_list1 >= 0]
+        other_gene_w = other_gene_w[1][snps_pos_list2 >= 0]
+        snps_cov = snps_cov[
+            np.ix_(snps_pos_list1[snps_pos_list1 >= 0], snps_pos_list2[snps_pos_list2 >= 0])
+        ]
 
         # formula from the MultiXcan paper:
         #   https://doi.org/10.1371/journal.pgen.1007889
@@ -0,0 +1,192 @@
+"""
+It contains a store for gene correlation matrices that can be read lazily as
+memory-mapped arrays, instead of loading whole pickled dataframes.
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from phenoplier.whitening import BlockDiagCorrMatrix
+
+
+class GeneCorrsStore(object):
+    """
+    A gene correlation matrix stored in a folder (with suffix '.gene_corrs') as
+    numpy arrays that are memory-mapped when read, so several processes reading
+    the same matrix share the operating system's page cache instead of having
+    a private copy, and subsets of genes can be read without reading the whole
+    matrix. The folder has these files:
+
+      * gene_names.npy: gene symbols in the matrix.
+      * blocks.npy: labels of the blocks of the matrix. If the matrix is block
+        diagonal (for instance, by chromosome), each block is stored
+        separately; otherwise, there is only one block with all genes.
+      * block-{label}.npy: correlations between genes in the block (a square
+        array).
+      * block-{label}_gene_idx.npy: positions of the genes in the block in
+        gene_names (sorted).
+
+    Args:
+        path:
+            Path to the folder of the store.
+    """
+
+    SUFFIX = ".gene_corrs"
+    ALL_GENES_BLOCK = "all"
+
+    def __init__(self, path: Path):
+        if not GeneCorrsStore.is_store(path):
+            raise ValueError(f"Not a gene correlations store: {path}")
+
+        self.path = Path(path)
+        self.index = pd.Index(np.load(self.path / "gene_names.npy"), dtype=object)
+        self.block_labels = np.load(self.path / "blocks.npy").tolist()
+
+    @staticmethod
+    def is_store(path: Path) -> bool:
+        """
+        Returns True if path is the folder of a GeneCorrsStore.
+        """
+        path = Path(path)
+        return path.is_dir() and (path / "blocks.npy").exists()
+
+    @staticmethod
+    def write(
+        path: Path, corr_matrix, gene_groups: pd.Series = None, gene_names: pd.Index = None
+    ) -> "GeneCorrsStore":
+        """
+        Writes a gene correlation matrix to a store.
+
+        Args:
+            path:
+                Path to the folder of the store (created if it does not exist).
+            corr_matrix:
+                A pandas dataframe or a BlockDiagCorrMatrix with gene
+                correlations.
+            gene_groups:
+                A pandas series with the group (such as the chromosome) of each
+                gene. If given and genes in different groups are not
+                correlated, each group is stored as a block. Blocks of a
+                BlockDiagCorrMatrix are always stored separately.
+            gene_names:
+                The order of genes in the store (the same genes as in
+                corr_matrix). By default, the order of genes in corr_matrix.
+
+        Returns:
+            The GeneCorrsStore written.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+
+        if isinstance(corr_matrix, BlockDiagCorrMatrix):
+            blocks = corr_matrix.blocks
+        elif gene_groups is not None and GeneCorrsStore._is_block_diag(corr_matrix, gene_groups):
+            blocks = BlockDiagCorrMatrix.from_dataframe(corr_matrix, gene_groups).blocks
+        else:
+            blocks = [corr_matrix]
+
+        if gene_names is not None:
+            gene_names = pd.Index(gene_names)
+            assert gene_names.sort_values().equals(
+                corr_matrix.index.sort_values()
+            ), "Genes are not the same as in the correlation matrix"
+        elif isinstance(corr_matrix, pd.DataFrame):
+            # keep the order of genes in the matrix
+            gene_names = corr_matrix.index
+        else:
+            gene_names = pd.Index([g for b in blocks for g in b.index])
+        np.save(path / "gene_names.npy", np.array(gene_names.tolist()))
+
+        if len(blocks) == 1:
+            block_labels = [GeneCorrsStore.ALL_GENES_BLOCK]
+        elif gene_groups is not None:
+            block_labels = [str(gene_groups.loc[b.index[0]]) for b in blocks]
+        else:
+            block_labels = [str(i) for i in range(len(blocks))]
+
+        for label, block in zip(block_labels, blocks):
+            block_idx = gene_names.get_indexer(block.index)
+            block_order = np.argsort(block_idx)
+            np.save(path / f"block-{label}.npy", block.to_numpy()[np.ix_(block_order, block_order)])
+            np.save(path / f"block-{label}_gene_idx.npy", block_idx[block_order])
+
+        np.save(path / "blocks.npy", np.array(block_labels))
+
+        return GeneCorrsStore(path)
+
+    @staticmethod
+    def _is_block_diag(corr_matrix: pd.DataFrame, gene_groups: pd.Series) -> bool:
+        """
+        Returns True if genes in different groups are not correlated. The
+        matrix is checked by chunks of rows.
+        """
+        groups = gene_groups.loc[corr_matrix.index].to_numpy()
+        data = corr_matrix.to_numpy()
+        chunk_size = 1024
+
+        for start in range(0, data.shape[0], chunk_size):
+            rows_groups = groups[start : start + chunk_size, None]
+            other_group = rows_groups != groups[None, :]
+            if np.any(data[start : start + chunk_size][other_group] != 0.0):
+                return False
+
+        return True
+
+    @property
+    def columns(self):
+        return self.index
+
+    @property
+    def shape(self):
+        return self.index.shape[0], self.index.shape[0]
+
+    def _read_block(self, label: str):
+        """
+        Returns the block (memory-mapped) and the positions of its genes.
+        """
+        block = np.load(self.path / f"block-{label}.npy", mmap_mode="r")
+        block_idx = np.load(self.path / f"block-{label}_gene_idx.npy")
+        return block, block_idx
+
+    def load(self):
+        """
+        Returns the gene correlation matrix backed by memory-mapped arrays: a
+        pandas dataframe if the store has only one block, or a
+        BlockDiagCorrMatrix otherwise. Data is not read until it is used.
+        """
+        blocks = []
+        for label in self.block_labels:
+            block, block_idx = self._read_block(label)
+            block_genes = self.index[block_idx]
+            blocks.append(pd.DataFrame(block, index=block_genes, columns=block_genes))
+
+        if len(blocks) == 1:
+            return blocks[0]
+
+        return BlockDiagCorrMatrix(blocks)
+
+    def read(self, genes):
+        """
+        Reads the correlations of the given genes (that must be in the store)
+        only, keeping the order of genes in the store. It returns a pandas
+        dataframe if the store has only one block, or a BlockDiagCorrMatrix
+        otherwise.
+        """
+        genes_idx = self.index.get_indexer(pd.Index(genes))
+        assert (genes_idx >= 0).all(), "Some genes are not in the gene correlation matrix"
+
+        blocks = []
+        for label in self.block_labels:
+            block, block_idx = self._read_block(label)
+            sub_idx = np.flatnonzero(np.isin(block_idx, genes_idx))
+            sub_genes = self.index[block_idx[sub_idx]]
+            blocks.append(
+                pd.DataFrame(block[np.ix_(sub_idx, sub_idx)], index=sub_genes, columns=sub_genes)
+            )
+
+        if len(blocks) == 1:
+            return blocks[0]
+
+        return BlockDiagCorrMatrix(blocks)
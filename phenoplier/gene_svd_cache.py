@@ -0,0 +1,113 @@
+"""
+It contains a cache of the SVD of the tissues correlations of genes (see
+phenoplier.ssm_correlations.get_gene_svd), which is written by the 'preprocess'
+command and read by 'correlate', so SVDs and variances are not computed again
+for each chromosome.
+"""
+import os
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from phenoplier.prediction_weights import PredictionWeightsIndex
+from phenoplier.snps_cov_store import SnpsCovStore
+
+
+class GeneSvdCache(object):
+    """
+    SVDs of the tissues correlations of genes (singular values and vectors,
+    per-tissue variances and weights of the SNPs in the GWAS), with one file
+    per chromosome in a folder.
+
+    Each file has a key with everything the SVDs depend on: the SNPs subset
+    (only its intersection with the variants of the prediction models), the
+    reference panel and prediction model, and the files of the prediction
+    models and SNP covariances. A file with a different key is ignored. All
+    singular values are stored, and the condition number is applied when
+    reading (see get_ssm_projection_from_svd). The condition number is also
+    part of the key, since 'preprocess' uses it to compute the variance
+    captured by the top singular values of each gene, so 'correlate' only uses
+    SVDs written with the same condition number.
+
+    Args:
+        cache_dir:
+            The folder with the cache files.
+        snps_subset:
+            The SNPs subset used to compute the SVDs (such as the SNPs in the
+            GWAS), as a VariantSet or a frozenset.
+        reference_panel:
+            The reference panel used to compute SNP covariances.
+        model_type:
+            The prediction model type, such as "MASHR" or "ELASTIC_NET".
+        condition_number:
+            The S-MultiXcan condition number used to select the top singular
+            values (see select_singular_values).
+    """
+
+    FOLDER = "gene_svd_cache"
+
+    def __init__(
+        self, cache_dir: Path, snps_subset, reference_panel: str, model_type: str, condition_number: float = 30
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.key = GeneSvdCache.get_key(snps_subset, reference_panel, model_type, condition_number)
+
+    @staticmethod
+    def get_key(snps_subset, reference_panel: str, model_type: str, condition_number: float = 30) -> dict:
+        """
+        Returns the key of the SVDs computed with the given arguments.
+        """
+        weights_index = PredictionWeightsIndex.get(model_type)
+
+        if snps_subset is not None and len(snps_subset) > 0:
+            variants_mask = weights_index.get_variants_mask(snps_subset)
+            snps_subset_hash = hashlib.sha256(np.packbits(variants_mask).tobytes()).hexdigest()
+        else:
+            snps_subset_hash = None
+
+        snps_cov_file = SnpsCovStore.get_file(reference_panel, model_type)
+        snps_cov_fingerprint = None
+        if snps_cov_file.exists():
+            snps_cov_fingerprint = [snps_cov_file.stat().st_size, snps_cov_file.stat().st_mtime_ns]
+
+        return {
+            "snps_subset": snps_subset_hash,
+            "reference_panel": reference_panel.lower(),
+            "model_type": model_type.lower(),
+            "prediction_models": hashlib.sha256(weights_index.sources.tobytes()).hexdigest(),
+            "snps_cov": snps_cov_fingerprint,
+            "condition_number": float(condition_number),
+        }
+
+    def get_file(self, chromosome: int) -> Path:
+        return self.cache_dir / f"chr{chromosome}.pkl"
+
+    def write(self, chromosome: int, genes_svd: dict):
+        """
+        Writes the SVDs of the genes of a chromosome (a dictionary with gene IDs
+        as keys and the result of get_gene_svd as values).
+        """
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        output_file = self.get_file(chromosome)
+
+        # other processes could be reading the same file
+        tmp_file = output_file.with_suffix(f".{os.getpid()}.tmp")
+        pd.to_pickle({"key": self.key, "genes": genes_svd}, tmp_file)
+        os.replace(tmp_file, output_file)
+
+    def load(self, chromosome: int) -> dict:
+        """
+        Returns the SVDs of the genes of a chromosome, or an empty dictionary if
+        the file does not exist or was computed with a different key.
+        """
+        input_file = self.get_file(chromosome)
+        if not input_file.exists():
+            return {}
+
+        data = pd.read_pickle(input_file)
+        if data["key"] != self.key:
+            return {}
+
+        return data["genes"]
@@ -2,8 +2,10 @@
 Implementation of Generalized Least Squares (GLS) model.
 """
 
+import tempfile
 from pathlib import Path
 from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -13,6 +15,98 @@ from rich import print
 
 from phenoplier.entity import Gene
 from phenoplier.config import settings as conf
+from phenoplier.gene_corrs_store import GeneCorrsStore
+from phenoplier.whitening import (
+    CholeskyWhitener,
+    BlockWhitener,
+    BlockDiagCorrMatrix,
+    get_whitener,
+)
+
+
+class GenesAlignment(object):
+    """
+    Alignment of the genes in gene-trait associations, gene-LV weights and
+    (optionally) gene correlations, as computed by
+    'GLSPhenoplier.match_and_align_genes'. It keeps the positions of the common
+    genes in each of them, so data can be aligned with numpy take operations
+    instead of indexing by gene names, and the alignment can be reused for data
+    with the same genes (such as all LVs fitted for the same trait).
+
+    Args:
+        phenotype_genes:
+            Genes in gene-trait associations (unique).
+        lv_genes:
+            Genes in gene-LV weights (unique).
+        corr_genes:
+            Genes in the gene correlation matrix (unique), or None.
+    """
+
+    def __init__(self, phenotype_genes: pd.Index, lv_genes: pd.Index, corr_genes: pd.Index = None):
+        assert phenotype_genes.is_unique, "Genes in gene-trait associations are not unique"
+        assert lv_genes.is_unique, "Genes in gene-LV weights are not unique"
+
+        self.phenotype_genes = phenotype_genes
+        self.lv_genes = lv_genes
+        self.corr_genes = corr_genes
+
+        self.corr_idx = None
+        if corr_genes is None:
+            # keep order of genes in gene-trait associations
+            genes_mask = phenotype_genes.isin(lv_genes)
+            self.genes = phenotype_genes[genes_mask]
+            self.phenotype_idx = np.flatnonzero(genes_mask)
+        else:
+            # keep order of genes in gene_correlations
+            genes_mask = corr_genes.isin(phenotype_genes) & corr_genes.isin(lv_genes)
+            self.genes = corr_genes[genes_mask]
+            self.corr_idx = np.flatnonzero(genes_mask)
+            self.phenotype_idx = phenotype_genes.get_indexer(self.genes)
+
+        self.lv_idx = lv_genes.get_indexer(self.genes)
+
+    def is_compatible(self, phenotype_genes: pd.Index, lv_genes: pd.Index, corr_genes: pd.Index = None) -> bool:
+        """
+        Returns True if this alignment was computed for the same genes.
+        """
+        if (corr_genes is None) != (self.corr_genes is None):
+            return False
+
+        return (
+            self.phenotype_genes.equals(phenotype_genes)
+            and self.lv_genes.equals(lv_genes)
+            and (corr_genes is None or self.corr_genes.equals(corr_genes))
+        )
+
+    def align(self, gene_phenotype_assoc, gene_lv_weights, gene_correlations=None):
+        """
+        Returns the given data (see 'GLSPhenoplier.match_and_align_genes')
+        aligned with the common genes.
+        """
+        if gene_correlations is not None:
+            gene_correlations = self.align_gene_correlations(gene_correlations)
+
+        return (
+            gene_phenotype_assoc.take(self.phenotype_idx),
+            gene_lv_weights.take(self.lv_idx),
+            gene_correlations,
+        )
+
+    def align_gene_correlations(self, gene_correlations):
+        """
+        Returns the gene correlations (a pandas dataframe or a
+        BlockDiagCorrMatrix) aligned with the common genes. A dense matrix is
+        copied, so it is only computed when needed.
+        """
+        if isinstance(gene_correlations, BlockDiagCorrMatrix):
+            return gene_correlations.subset(self.genes)
+
+        return pd.DataFrame(
+            gene_correlations.to_numpy()[np.ix_(self.corr_idx, self.corr_idx)],
+            index=self.genes,
+            columns=self.genes,
+        )
+
 
 class GLSPhenoplier(object):
     """
@@ -33,7 +127,9 @@ class GLSPhenoplier(object):
             be z-scores or -log10(p-values) (although this last one was not
             tested).
         gene_corrs_file_path:
-            Path to file with gene corrs matrix. If not given, it loads the
+            Path to file with gene corrs matrix (a pickled pandas dataframe or
+            BlockDiagCorrMatrix, or a GeneCorrsStore folder), or to a folder
+            with LV-specific matrices. If not given, it loads the
             default gene correlation matrix trained from GTEX_V8 and MASHR
             models.
         debug_use_ols:
@@ -45,6 +141,15 @@ class GLSPhenoplier(object):
             It uses a more efficient implementation of GLS instead of the one
             provided by statsmodels. This improved implementation caches some
             inverse matrices needed to train the model.
+        n_jobs:
+            Number of processes used to fit LVs in parallel when LV-specific
+            gene correlation matrices are used (see 'fit_named_batch_traits').
+            Default: 1
+        use_banded_gene_corrs:
+            It factorizes the full gene correlation matrix as a banded (sparse)
+            matrix (see BandedCholeskyWhitener), which is much faster when only
+            genes within some distance are correlated (and genes are sorted by
+            position). It is only used with the full gene correlation matrix.
         logger:
             A Logger instance, the string "warnings_only" or None. If None, all logging and warning is disabled.
             If "warnings_only", then warnings will be raised as python warnings using the warnings module.
@@ -53,6 +158,13 @@ class GLSPhenoplier(object):
     """
     gene_corrs_file_path: Path | None
 
+    # FIXME: here the percentile of top genes used to binarize an LV is
+    #  hardcoded at 1%, but the correlation matrices must be constructed with
+    #  the same number for each individual LV (if using a submatrix of the
+    #  correlation matrices, which is the default). In the future, either make
+    #  it an argument or read it from the gene correlation matrix.
+    LV_PERC = 0.01
+
     def __init__(
             self,
             smultixcan_result_set_filepath: str = None,
@@ -60,6 +172,8 @@ class GLSPhenoplier(object):
             debug_use_ols: bool = False,
             debug_use_sub_gene_corr: bool = False,
             use_own_implementation: bool = False,
+            n_jobs: int = 1,
+            use_banded_gene_corrs: bool = False,
             logger="warnings_only",
     ):
         self.smultixcan_result_set_filepath = conf.TWAS[
@@ -80,12 +194,15 @@ class GLSPhenoplier(object):
         self.debug_use_ols = debug_use_ols
         self.debug_use_sub_gene_corr = debug_use_sub_gene_corr
         self.use_own_implementation = use_own_implementation
+        self.n_jobs = n_jobs
+        self.use_banded_gene_corrs = use_banded_gene_corrs
 
         self.log_warning = None
         self.log_info = None
         self.set_logger(logger)
 
         self.cov_inv = None
+        self.genes_alignment = None
         self.lv_code = None
         self.phenotype_code = None
         self.model = None
@@ -125,10 +242,25 @@ class GLSPhenoplier(object):
     def _get_gene_corrs(gene_corrs_file_path: str):
         """
         Returns a matrix with correlations between predicted gene expression
-        loaded from the specified file.
+        loaded from the specified file (a pickle file) or GeneCorrsStore folder.
+        Matrices in a GeneCorrsStore are memory-mapped, so they are not read
+        until used.
         """
+        if GeneCorrsStore.is_store(gene_corrs_file_path):
+            return GeneCorrsStore(gene_corrs_file_path).load()
+
         return pd.read_pickle(gene_corrs_file_path)
 
+    def _has_gene_corrs_matrix(self) -> bool:
+        """
+        Returns True if gene_corrs_file_path is a gene correlation matrix (a
+        pickle file or a GeneCorrsStore folder), and not a folder with
+        LV-specific matrices.
+        """
+        return self.gene_corrs_file_path.is_file() or GeneCorrsStore.is_store(
+            self.gene_corrs_file_path
+        )
+
     @staticmethod
     @lru_cache(maxsize=None)
     def _get_phenotype_assoc(smultixcan_result_set_filepath: str) -> pd.DataFrame:
@@ -165,29 +297,131 @@ class GLSPhenoplier(object):
             gene_phenotype_assoc: pd.Series,
             gene_lv_weights: pd.Series,
             gene_correlations: pd.DataFrame = None,
+            genes_alignment: GenesAlignment = None,
     ):
         """
         Given the gene-trait associations, gene-lv weights and a gene
-        correlation matrix (optional), it returns a version of all them with the
-        same genes (present in all of them) and aligned (same order). This is
-        used to prepare data for fitting the GLS model.
+        correlation matrix (optional, a pandas dataframe or a
+        BlockDiagCorrMatrix), it returns a version of all them with the same
+        genes (present in all of them) and aligned (same order). This is used
+        to prepare data for fitting the GLS model. A GenesAlignment previously
+        computed for the same genes can be given to avoid computing it again.
 
         Returns:
             A tuple with three elements: gene-trait associations, gene-lv
             weights and gene correlations, all aligned with the same genes.
         """
-        common_genes = gene_phenotype_assoc.index.intersection(gene_lv_weights.index)
+        if genes_alignment is None:
+            genes_alignment = GenesAlignment(
+                gene_phenotype_assoc.index,
+                gene_lv_weights.index,
+                gene_correlations.index if gene_correlations is not None else None,
+            )
 
-        if gene_correlations is not None:
-            # keep order of genes in gene_correlations
-            common_genes = [g for g in gene_correlations.index if g in common_genes]
+        return genes_alignment.align(
+            gene_phenotype_assoc, gene_lv_weights, gene_correlations
+        )
 
-        return (
-            gene_phenotype_assoc.loc[common_genes],
-            gene_lv_weights.loc[common_genes],
-            gene_correlations.loc[common_genes, common_genes]
-            if gene_correlations is not None
-            else None,
+    def _get_genes_alignment(self, y, x, gene_corrs) -> GenesAlignment:
+        """
+        Returns the alignment of the genes in the given data (see
+        'match_and_align_genes'). The last one computed is cached in this
+        object, so it is reused if data has the same genes (for instance, when
+        several LVs are fitted for the same trait).
+        """
+        corr_genes = gene_corrs.index if gene_corrs is not None else None
+
+        if self.genes_alignment is None or not self.genes_alignment.is_compatible(
+            y.index, x.index, corr_genes
+        ):
+            self.genes_alignment = GenesAlignment(y.index, x.index, corr_genes)
+
+        return self.genes_alignment
+
+    @staticmethod
+    def binarize_lv_weights(x: pd.DataFrame, x_perc: float = None) -> pd.DataFrame:
+        """
+        Binarizes the gene weights of one or more LVs (in columns) using the top
+        genes in each LV: genes with nonzero weights at or above the percentile
+        (1 - x_perc) of an LV are set to 1.0, and the rest to 0.0.
+
+        Args:
+            x:
+                A pandas dataframe with genes in rows and LVs in columns.
+            x_perc:
+                The top percentile of genes. If None, GLSPhenoplier.LV_PERC is
+                used.
+
+        Returns:
+            A pandas dataframe with the same shape as x, with values 0.0 or 1.0.
+        """
+        if x_perc is None:
+            x_perc = GLSPhenoplier.LV_PERC
+
+        x_q = x.quantile(1.0 - x_perc)
+        # make sure top genes have nonzero weights
+        x_cond = (x > 0.0) & (x >= x_q)
+        x_binarized = x_cond.astype(np.float64)
+
+        # make sure we have two values: 0.0 and 1.0
+        n_pos = x_cond.sum()
+        assert ((n_pos > 0) & (n_pos < x.shape[0])).all(), "Wrong binarization"
+
+        return x_binarized
+
+    @staticmethod
+    def compute_lvs_stats(
+            yw: np.ndarray, zw: np.ndarray, xw: np.ndarray
+    ) -> pd.DataFrame:
+        """
+        Computes the OLS estimates of the LV coefficient for several LVs at once
+        on data that was already transformed (whitened) using the gene
+        correlation matrix. Each LV is fitted in its own model with the same
+        dependent variable and the same set of other predictors (intercept and
+        covariates). The shared predictors are projected out once (using the
+        Frisch-Waugh-Lovell theorem), so all LVs are fitted with a few matrix
+        products instead of one OLS model per LV.
+
+        Args:
+            yw:
+                A numpy array of size n with the (whitened) dependent variable.
+            zw:
+                A numpy array of size n x p with the (whitened) predictors
+                shared by all models (intercept and covariates).
+            xw:
+                A numpy array of size n x k with the (whitened) LVs.
+
+        Returns:
+            A pandas dataframe with LVs in rows (in the same order as the
+            columns of xw) and the coefficient (beta), standard error (beta_se),
+            t-statistic (t), and two-sided (pvalue_twosided) and one-sided
+            (pvalue) p-values in columns.
+        """
+        n_genes = yw.shape[0]
+        df_resid = n_genes - (zw.shape[1] + 1)
+
+        # project out the shared predictors
+        q, _ = np.linalg.qr(zw)
+        y_res = yw - q @ (q.T @ yw)
+        x_res = xw - q @ (q.T @ xw)
+
+        x_ss = np.einsum("ij,ij->j", x_res, x_res)
+        xy = x_res.T @ y_res
+
+        beta = xy / x_ss
+        rss = y_res @ y_res - beta * xy
+        beta_se = np.sqrt((rss / df_resid) / x_ss)
+        tvalues = beta / beta_se
+
+        return pd.DataFrame(
+            {
+                "beta": beta,
+                "beta_se": beta_se,
+                "t": tvalues,
+                "pvalue_twosided": 2 * stats.t.sf(np.abs(tvalues), df_resid),
+                # one-sided pvalue (see _fit_general)
+                "pvalue": stats.t.sf(tvalues, df_resid),
+            }
         )
 
     def _fit_named_internal(self, lv_code: str, phenotype: str):
@@ -240,18 +474,35 @@ class GLSPhenoplier(object):
             columns=corr_matrix.columns.copy(),
         )
 
-        lv_thres = 0.0
-        if lv_perc is not None and lv_perc > 0.0:
-            lv_thres = lv_data.quantile(1.0 - lv_perc)
+        lv_selected_genes = GLSPhenoplier.get_sub_mat_genes(
+            corr_matrix.index, lv_data, lv_perc
+        )
 
-        lv_selected_genes = lv_data[lv_data >= lv_thres].index
-        lv_selected_genes = lv_selected_genes.intersection(corr_matrix.index)
+        if isinstance(corr_matrix, BlockDiagCorrMatrix):
+            sub_corrs = corr_matrix.subset(lv_selected_genes).to_dataframe()
+            sub_mat.loc[sub_corrs.index, sub_corrs.columns] = sub_corrs
+            return sub_mat
 
         sub_mat.loc[lv_selected_genes, lv_selected_genes] = corr_matrix.loc[
             lv_selected_genes, lv_selected_genes
         ]
         return sub_mat
 
+    @staticmethod
+    def get_sub_mat_genes(genes: pd.Index, lv_data: pd.Series, lv_perc=None) -> pd.Index:
+        """
+        Returns the genes (among 'genes') that have correlation values in the
+        submatrix returned by 'get_sub_mat' (see that function for the meaning
+        of the parameters). All the other genes only have ones in the diagonal,
+        so the submatrix is an identity matrix plus a block with these genes.
+        """
+        lv_thres = 0.0
+        if lv_perc is not None and lv_perc > 0.0:
+            lv_thres = lv_data.quantile(1.0 - lv_perc)
+
+        lv_selected_genes = lv_data[lv_data >= lv_thres].index
+        return lv_selected_genes.intersection(genes)
+
     def _fit_named_cli(self, lv_code: str, phenotype, lv_weights_file: str = None):
         """
         It trains a GLS model given an LV code and a phenotype with optional
@@ -273,12 +524,12 @@ class GLSPhenoplier(object):
         """
         lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
         gene_corrs = None
-        if not self.debug_use_ols and self.gene_corrs_file_path.is_file():
+        if not self.debug_use_ols and self._has_gene_corrs_matrix():
             gene_corrs = GLSPhenoplier._get_gene_corrs(self.gene_corrs_file_path)
 
         x = lv_weights[lv_code]
 
-        if self.debug_use_sub_gene_corr and self.gene_corrs_file_path.is_file():
+        if self.debug_use_sub_gene_corr and self._has_gene_corrs_matrix():
             perc = 0.01
             self.log_info(
                 f"Using submatrix of gene correlations with perc {perc} for {lv_code}"
@@ -309,8 +560,10 @@ class GLSPhenoplier(object):
                 associations or a pandas dataframe with gene-trait associations
                 in column "y" and other covariates in the rest of the columns.
             gene_corrs:
-                A pandas dataframe with gene correlations. Gene symbols are
-                expected in the rows and columns.
+                A pandas dataframe with gene correlations, or a
+                BlockDiagCorrMatrix if they are block diagonal (for instance,
+                by chromosome). Gene symbols are expected in the rows and
+                columns.
 
         Returns:
             self
@@ -337,7 +590,9 @@ class GLSPhenoplier(object):
 
         # make sure data is aligned
         n_genes_orig_phenotype = y.shape[0]
-        y, x, gene_corrs = GLSPhenoplier.match_and_align_genes(y, x, gene_corrs)
+        y, x, gene_corrs = GLSPhenoplier.match_and_align_genes(
+            y, x, gene_corrs, self._get_genes_alignment(y, x, gene_corrs)
+        )
 
         if n_genes_orig_phenotype > y.shape[0]:
             self.log_warning(
@@ -364,24 +619,10 @@ class GLSPhenoplier(object):
             raise ValueError(f"Wrong number of columns for y: {y.shape[1]}")
 
         # binarize x using top genes in LV
-        # FIXME: here x_perc is hardcoded at 1%, but the correlation matrices
-        #  must be constructed with the same number for each individual LV (if
-        #  using a submatrix of the correlation matrices, which is the default).
-        #  In the future, either make x_perc an argument or read it from the
-        #  gene correlation matrix.
-        x_perc = 0.01
-        x_q = x.quantile(1.0 - x_perc)
-        x_binarized = x.copy()
-        # make sure top genes have nonzero weights
-        x_cond = (x_binarized > 0.0) & (x_binarized >= x_q)
-        x_binarized[x_cond] = 1.0
-        x_binarized[~x_cond] = 0.0
-        # make sure we have two values: 0.0 and 1.0
-        x_summary = x_binarized.value_counts()
-        assert x_summary.shape[0] == 2, "Wrong binarization"
-        n_pos = int(x_summary.loc[1.0])
-        n_neg = int(x_summary.loc[0.0])
-        self.log_info(f"Using binarized LV at {int(100 * x_perc)}% ({n_pos} / {n_neg})")
+        x_binarized = GLSPhenoplier.binarize_lv_weights(x.to_frame())[lv_code]
+        n_pos = int(x_binarized.sum())
+        n_neg = int(x_binarized.shape[0] - n_pos)
+        self.log_info(f"Using binarized LV at {int(100 * GLSPhenoplier.LV_PERC)}% ({n_pos} / {n_neg})")
 
         data = pd.DataFrame(
             {
@@ -407,18 +648,17 @@ class GLSPhenoplier(object):
                 if gene_corrs is not None:
                     # gene_corrs was given, meaning that it is a file
                     self.log_info(
-                        f"Correlation matrix is a file, computing the inverse "
-                        f"of Cholesky decomposition for each LV"
+                        f"Correlation matrix is a file, computing the "
+                        f"Cholesky decomposition for each LV"
                     )
 
-                    chol_mat = np.linalg.cholesky(gene_corrs)
-                    cov_inv = np.linalg.inv(chol_mat)
+                    cov_inv = get_whitener(gene_corrs)
 
                 elif self.gene_corrs_file_path.is_dir():
                     # gene_corrs is None and file to gene_corrs is directory
                     self.log_info(
-                        f"Correlation matrix is a directory, reading inverse "
-                        f"of Cholesky decomposition for each LV"
+                        f"Correlation matrix is a directory, reading "
+                        f"Cholesky decomposition for each LV"
                     )
 
                     gene_names = GLSPhenoplier.load_chol_inv_data(
@@ -426,46 +666,30 @@ class GLSPhenoplier(object):
                     )
 
                     # check if data is compatible with gene_names
-                    common_genes = data.index.intersection(gene_names)
+                    missing_idx, genes_idx = GLSPhenoplier.align_genes(
+                        data.index, gene_names
+                    )
 
-                    if common_genes.shape[0] == gene_names.shape[0]:
+                    if missing_idx.shape[0] == 0:
                         self.log_info(
                             "Data has all genes in LV-specific correlation matrix"
                         )
-                        cov_inv = GLSPhenoplier.load_chol_inv_data(
-                            self.gene_corrs_file_path, lv_code
-                        )
                     else:
-                        # data has less genes than in correlation matrix
-                        # we need to compute the inverse again
-
-                        # TODO: an optimization here is to compute a rank-1
-                        #  update of the the Cholesky decomposition instead of
-                        #  computing all again. Relevant links:
-                        #   - https://en.wikipedia.org/wiki/Cholesky_decomposition#Updating_the_decomposition
-                        #   - https://stackoverflow.com/questions/8636518/dense-cholesky-update-in-python
-                        #   - https://github.com/modusdatascience/choldate
+                        # data has less genes than in correlation matrix, so
+                        # they are removed from the Cholesky decomposition
                         self.log_warning(
                             "Data has less genes than in LV-specific correlation "
-                            "matrix. Computing Cholesky decomposition again "
-                            "using the original correlation matrix for each LV."
-                        )
-
-                        # load original correlation matrix
-                        gene_corrs = GLSPhenoplier.load_chol_inv_data(
-                            self.gene_corrs_file_path, f"{lv_code}_corr_mat"
+                            "matrix. Removing missing genes from the Cholesky "
+                            "decomposition for each LV."
                         )
 
-                        # keep genes in dependant variable only
-                        gene_corrs = pd.DataFrame(
-                            gene_corrs, index=gene_names, columns=gene_names
-                        )
-                        gene_corrs = gene_corrs.loc[common_genes, common_genes]
-                        gene_names = gene_corrs.index
-
-                        # compute inverse of Cholesky decomposition again
-                        chol_mat = np.linalg.cholesky(gene_corrs)
-                        cov_inv = np.linalg.inv(chol_mat)
+                    block_chol, block_idx = GLSPhenoplier.load_chol_block(
+                        self.gene_corrs_file_path, lv_code
+                    )
+                    cov_inv = GLSPhenoplier.get_lv_block_whitener(
+                        block_chol, block_idx, gene_names.shape[0], missing_idx
+                    )
+                    gene_names = data.index[genes_idx]
 
                     # align data to gene names in cov_inv
                     data = data.loc[gene_names]
@@ -475,25 +699,12 @@ class GLSPhenoplier(object):
                 else:
                     raise ValueError("Bad combination of arguments")
             else:
-                if self.cov_inv is None:
-                    chol_mat = np.linalg.cholesky(gene_corrs)
-                    cov_inv = np.linalg.inv(chol_mat)
-                    self.cov_inv = cov_inv
-
-                    # I cache also the gene names from the correlation matrix.
-                    # This have to be the same if new data is fitted using the same
-                    # GLSPhenoplier object.
-                    self.cov_inv_genes = gene_corrs.index.tolist()
-                else:
-                    cov_inv = self.cov_inv
-                    assert (
-                            data.index.tolist() == self.cov_inv_genes
-                    ), "Cached inverse matrix is not compatible with new data"
+                cov_inv = self._get_full_cov_inv(gene_corrs, data.index)
 
             Xn = data[predictor_cols].to_numpy()
             yn = data[phenotype_col].to_numpy()
 
-            # transform data using Cholesky decomposition
+            # transform data using Cholesky decomposition (see CholeskyWhitener)
             Xn = cov_inv @ Xn
             yn = cov_inv @ yn
 
@@ -524,6 +735,9 @@ class GLSPhenoplier(object):
             if gene_corrs is not None:
                 # self.log_info("Using a Generalized Least Squares (GLS) model")
                 print("Using a Generalized Least Squares (GLS) model")
+                if isinstance(gene_corrs, BlockDiagCorrMatrix):
+                    gene_corrs = gene_corrs.to_dataframe()
+
                 gls_model = sm.GLS(
                     data[phenotype_col], data[predictor_cols], sigma=gene_corrs
                 )
@@ -581,6 +795,519 @@ class GLSPhenoplier(object):
                 "Wrong phenotype data type. Should be str or pandas.Series (with gene symbols as index)"
             )
 
+    def fit_named_batch(self, lv_codes: list, phenotype, lv_weights_file: str = None) -> pd.DataFrame:
+        """
+        Fits the GLS model for a list of LVs and the same trait/phenotype data.
+        It is equivalent to calling 'fit_named' for each LV (with phenotype
+        data), but the phenotype and covariates are prepared and transformed
+        only once, and all LVs are fitted together with a few matrix products
+        (see 'compute_lvs_stats') instead of one statsmodels model per LV.
+
+        Args:
+            lv_codes:
+                A list of LV codes. For example: ["LV1", "LV136"]
+            phenotype:
+                The design matrix. It could be a pandas series with the
+                dependant variable (gene-trait associations) and no covariates,
+                or a pandas dataframe with the dependant variable (must be named
+                "y") and covariates.
+            lv_weights_file:
+                Path to file having the LV data.
+
+        Returns:
+            A pandas dataframe with LVs in rows (index named "lv", in the same
+            order as lv_codes) and columns "beta", "beta_se", "t",
+            "pvalue_twosided" and "pvalue" (one-sided).
+        """
+        return self.fit_named_batch_traits(
+            lv_codes, {"phenotype": phenotype}, lv_weights_file
+        )["phenotype"]
+
+    def fit_named_batch_traits(
+            self, lv_codes: list, phenotypes: dict, lv_weights_file: str = None
+    ) -> dict:
+        """
+        Same as 'fit_named_batch', but for several traits/phenotypes. The LV
+        model and the gene correlation matrices are read only once for all
+        traits (LV-specific matrices are read once per LV, not once per LV and
+        trait).
+
+        Args:
+            lv_codes:
+                A list of LV codes. For example: ["LV1", "LV136"]
+            phenotypes:
+                A dictionary with trait names as keys and the design matrices
+                (see 'fit_named_batch') as values.
+            lv_weights_file:
+                Path to file having the LV data.
+
+        Returns:
+            A dictionary with the same keys as phenotypes and the results of
+            'fit_named_batch' as values.
+        """
+        lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
+        gene_corrs = None
+        if not self.debug_use_ols and self._has_gene_corrs_matrix():
+            gene_corrs = GLSPhenoplier._get_gene_corrs(self.gene_corrs_file_path)
+
+        x = lv_weights[list(lv_codes)]
+
+        return self._fit_general_batch(x, phenotypes, gene_corrs)
+
+    def _fit_general_batch(self, x: pd.DataFrame, ys: dict, gene_corrs: pd.DataFrame) -> dict:
+        """
+        Batched version of '_fit_general'. It follows the same standard steps
+        (removing missing data, aligning genes, binarizing LVs, standardizing
+        the phenotype and covariates), but for several LVs and traits at once.
+
+        If no LV-specific correlation matrices are used (that is, OLS or the
+        full gene correlation matrix), all LVs share the same transformation,
+        and the data of each trait is whitened only once. Otherwise, data is
+        whitened with each LV-specific matrix.
+
+        Args:
+            x:
+                A pandas dataframe with gene weights for several LVs (in
+                columns).
+            ys:
+                A dictionary with trait names as keys and, as values, either a
+                pandas Series (no covariates) with gene-trait associations or a
+                pandas dataframe with gene-trait associations in column "y" and
+                other covariates in the rest of the columns.
+            gene_corrs:
+                A pandas dataframe with gene correlations, or a
+                BlockDiagCorrMatrix if they are block diagonal (for instance,
+                by chromosome). Gene symbols are expected in the rows and
+                columns.
+
+        Returns:
+            A dictionary with trait names as keys and the results (see
+            'fit_named_batch') as values.
+        """
+        assert all(
+            isinstance(c, str) and c.startswith("LV") for c in x.columns
+        ), "Columns of x have to be valid LV identifiers (str starting with 'LV')"
+
+        traits = {
+            trait_name: self._prepare_batch_data(x, y, gene_corrs)
+            for trait_name, y in ys.items()
+        }
+
+        if self.debug_use_ols:
+            results = {
+                trait_name: GLSPhenoplier.compute_lvs_stats(
+                    trait["y"], trait["z"], trait["x"]
+                )
+                for trait_name, trait in traits.items()
+            }
+        elif not self.debug_use_sub_gene_corr:
+            results = self._fit_full_gene_corrs(traits, gene_corrs)
+        else:
+            # LV-specific submatrices are computed from the original LV weights
+            # and gene correlations (see '_fit_named_cli')
+            results = self._fit_lv_specific(x.columns, traits, gene_corrs, x)
+
+        for trait_results in results.values():
+            trait_results.index = pd.Index(x.columns, name="lv")
+
+        return results
+
+    def _prepare_batch_data(self, x: pd.DataFrame, y, gene_corrs: pd.DataFrame) -> dict:
+        """
+        Prepares the data of one trait to fit several LVs (see
+        '_fit_general_batch').
+
+        Returns:
+            A dictionary with the genes used ("genes"), the standardized
+            phenotype ("y"), the shared predictors (intercept and standardized
+            covariates, "z") and the binarized LVs ("x"), all aligned with the
+            same genes, and the alignment of the genes ("genes_alignment"). The
+            gene correlations are not aligned here, since a copy for each trait
+            would be kept in memory (see '_fit_full_gene_corrs').
+        """
+        # remove missing values from gene-trait associations
+        n_genes_orig = y.shape[0]
+        y = y.dropna()
+        assert not y.isin([np.inf, -np.inf]).any(axis=None), "y contains inf values"
+        n_genes_without_nan = y.shape[0]
+        if n_genes_orig != n_genes_without_nan:
+            print(f"{n_genes_orig - n_genes_without_nan} genes with missing values have been removed")
+
+        # make sure data is aligned
+        n_genes_orig_phenotype = y.shape[0]
+        genes_alignment = self._get_genes_alignment(y, x, gene_corrs)
+        y, x, _ = GLSPhenoplier.match_and_align_genes(y, x, None, genes_alignment)
+
+        if n_genes_orig_phenotype > y.shape[0]:
+            self.log_warning(
+                f"{n_genes_orig_phenotype} genes in phenotype associations, "
+                f"but only {y.shape[0]} were found in LV models"
+            )
+
+        # create training data
+        covars = None
+        if len(y.shape) == 1:
+            dependent_var = y
+        elif len(y.shape) > 1:
+            assert (
+                    "y" in y.columns
+            ), "y must have a 'y' column with the dependant variable"
+            dependent_var = y["y"]
+            covars = y[[c for c in y.columns if c not in ("y",)]]
+        else:
+            raise ValueError(f"Wrong number of columns for y: {y.shape[1]}")
+
+        x_binarized = GLSPhenoplier.binarize_lv_weights(x)
+        self.log_info(
+            f"Using binarized LVs at {int(100 * GLSPhenoplier.LV_PERC)}% "
+            f"({x_binarized.shape[1]} LVs)"
+        )
+
+        # shared predictors: intercept and covariates
+        shared = pd.DataFrame({"i": 1.0}, index=dependent_var.index)
+        if covars is not None:
+            covars = (covars - covars.mean()) / covars.std()
+            shared = pd.concat([shared, covars], axis=1)
+
+        phenotype = (dependent_var - dependent_var.mean()) / dependent_var.std()
+
+        assert not shared.isna().any(axis=None), "Data contains NaN"
+        assert not phenotype.isna().any(), "Data contains NaN"
+
+        print(f"Final number of genes in training data: {phenotype.shape[0]}")
+
+        return {
+            "genes": phenotype.index,
+            "y": phenotype.to_numpy(),
+            "z": shared.to_numpy(),
+            "x": x_binarized.to_numpy(),
+            "genes_alignment": genes_alignment,
+        }
+
+    def _fit_full_gene_corrs(self, traits: dict, gene_corrs) -> dict:
+        """
+        Fits all LVs for each trait using the full gene correlation matrix
+        (gene_corrs, not aligned with the data). Traits with the same genes
+        share the whitened LVs, and the gene correlations are aligned only
+        when their inverse is computed, once for each set of genes.
+        """
+        results = {}
+
+        # inverses and whitened LVs, keyed by the genes in the data
+        whitened_lvs = {}
+
+        for trait_name, trait in traits.items():
+            genes = trait["genes"]
+            genes_key = tuple(genes)
+
+            if genes_key not in whitened_lvs:
+                if self.cov_inv is not None and genes.tolist() != self.cov_inv_genes:
+                    # this trait has a different set of genes (for instance,
+                    # because of missing values), so compute the inverse again
+                    self.cov_inv = None
+
+                aligned_gene_corrs = None
+                if self.cov_inv is None:
+                    aligned_gene_corrs = trait["genes_alignment"].align_gene_correlations(gene_corrs)
+
+                cov_inv = self._get_full_cov_inv(aligned_gene_corrs, genes)
+                whitened_lvs[genes_key] = (cov_inv, cov_inv @ trait["x"])
+                del aligned_gene_corrs
+
+            cov_inv, xw = whitened_lvs[genes_key]
+
+            # whiten the phenotype and shared predictors at once
+            data_w = cov_inv @ np.column_stack([trait["y"], trait["z"]])
+            results[trait_name] = GLSPhenoplier.compute_lvs_stats(
+                data_w[:, 0], data_w[:, 1:], xw
+            )
+
+        return results
+
+    def _get_full_cov_inv(self, gene_corrs, genes: pd.Index):
+        """
+        Returns a whitener with the Cholesky decomposition of the full gene
+        correlation matrix (already aligned with the data), which is used as the
+        inverse of the Cholesky factor. If the matrix is a BlockDiagCorrMatrix,
+        blocks are factorized independently (using self.n_jobs threads), and
+        the matrix (or each block) is factorized as a banded matrix if
+        self.use_banded_gene_corrs is True. It is computed only once and cached
+        in this object, so the genes in the data have to be the same in
+        subsequent calls.
+        """
+        if self.cov_inv is None:
+            self.cov_inv = get_whitener(
+                gene_corrs, self.n_jobs, self.use_banded_gene_corrs
+            )
+
+            # I cache also the gene names from the correlation matrix.
+            # This have to be the same if new data is fitted using the same
+            # GLSPhenoplier object.
+            self.cov_inv_genes = gene_corrs.index.tolist()
+        else:
+            assert (
+                    genes.tolist() == self.cov_inv_genes
+            ), "Cached inverse matrix is not compatible with new data"
+
+        return self.cov_inv
+
+    def _fit_lv_specific(
+            self,
+            lv_codes: pd.Index,
+            traits: dict,
+            gene_corrs: pd.DataFrame,
+            lv_weights: pd.DataFrame,
+    ) -> dict:
+        """
+        Fits each LV using its LV-specific submatrix of the gene correlation
+        matrix, either computed from the full gene correlation matrix (a file)
+        or read from a folder with precomputed matrices. LVs are processed in
+        the outer loop, so LV-specific matrices are read only once for all
+        traits. Here gene_corrs and lv_weights are not aligned with the data.
+        """
+        gene_names = None
+        if gene_corrs is None:
+            if not self.gene_corrs_file_path.is_dir():
+                raise ValueError("Bad combination of arguments")
+
+            gene_names = GLSPhenoplier.load_chol_inv_data(
+                self.gene_corrs_file_path, "gene_names"
+            )
+
+            if any(
+                trait["genes"].intersection(gene_names).shape[0] < gene_names.shape[0]
+                for trait in traits.values()
+            ):
+                self.log_warning(
+                    "Data has less genes than in LV-specific correlation "
+                    "matrix. Removing missing genes from the Cholesky "
+                    "decomposition for each LV."
+                )
+
+        if self.n_jobs > 1 and len(lv_codes) > 1:
+            return self._fit_lv_specific_parallel(
+                lv_codes, traits, gene_corrs, lv_weights, gene_names
+            )
+
+        return self._fit_lvs(lv_codes, traits, gene_corrs, lv_weights, gene_names)
+
+    def _fit_lvs(
+            self,
+            lv_codes: pd.Index,
+            traits: dict,
+            gene_corrs: pd.DataFrame,
+            lv_weights: pd.DataFrame,
+            gene_names: np.ndarray,
+    ) -> dict:
+        """
+        Runs the loop over LVs for '_fit_lv_specific'. The binarized LVs of
+        each trait ("x") must have the LVs in lv_codes as columns (in order).
+        """
+        results = {trait_name: [] for trait_name in traits}
+
+        # alignment of the data of each trait with the genes in the gene
+        # correlation matrix, shared by all LVs. Traits with the same missing
+        # genes share the LV-specific matrices, so they are keyed by them
+        traits_alignments = {}
+        for trait_name, trait in traits.items():
+            if gene_corrs is not None:
+                traits_alignments[trait_name] = (
+                    tuple(trait["genes"]), None, np.arange(trait["genes"].shape[0])
+                )
+            else:
+                missing_idx, genes_idx = GLSPhenoplier.align_genes(
+                    trait["genes"], gene_names
+                )
+                traits_alignments[trait_name] = (
+                    tuple(missing_idx), missing_idx, genes_idx
+                )
+
+        for lv_idx, lv_code in enumerate(lv_codes):
+            # data read for this LV, and matrices keyed by the missing genes
+            lv_files = {}
+            lv_cov_invs = {}
+
+            for trait_name, trait in traits.items():
+                genes_key, missing_idx, genes_idx = traits_alignments[trait_name]
+                if genes_key not in lv_cov_invs:
+                    lv_cov_invs[genes_key] = self._get_lv_cov_inv(
+                        lv_code, trait["genes"], gene_corrs, lv_weights, gene_names,
+                        missing_idx, lv_files,
+                    )
+                cov_inv = lv_cov_invs[genes_key]
+
+                data_w = cov_inv @ np.column_stack(
+                    [trait["y"], trait["z"], trait["x"][:, lv_idx]]
+                )[genes_idx]
+
+                results[trait_name].append(
+                    GLSPhenoplier.compute_lvs_stats(
+                        data_w[:, 0], data_w[:, 1:-1], data_w[:, -1:]
+                    )
+                )
+
+        return {
+            trait_name: pd.concat(trait_results, ignore_index=True)
+            for trait_name, trait_results in results.items()
+        }
+
+    def _fit_lv_specific_parallel(
+            self,
+            lv_codes: pd.Index,
+            traits: dict,
+            gene_corrs: pd.DataFrame,
+            lv_weights: pd.DataFrame,
+            gene_names: np.ndarray,
+    ) -> dict:
+        """
+        Same as '_fit_lvs', but LVs are split in contiguous chunks and fitted in
+        a pool of self.n_jobs processes. Large arrays (the data of each trait
+        and the gene correlation matrix) are written to a temporary folder and
+        memory-mapped by workers, so they are not copied to each process.
+        LV-specific matrices are read by each worker from the gene correlation
+        folder. Results are the same (and in the same order) as '_fit_lvs'.
+        """
+        gls_args = {
+            "gene_corrs_file_path": self.gene_corrs_file_path,
+            "debug_use_ols": self.debug_use_ols,
+            "debug_use_sub_gene_corr": self.debug_use_sub_gene_corr,
+            "use_own_implementation": self.use_own_implementation,
+        }
+
+        lvs_chunks = [
+            chunk for chunk in np.array_split(np.arange(len(lv_codes)), self.n_jobs)
+            if chunk.shape[0] > 0
+        ]
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            tmp_dir = Path(tmp_dir)
+
+            traits_genes = {}
+            for trait_idx, (trait_name, trait) in enumerate(traits.items()):
+                for k in ("y", "z", "x"):
+                    np.save(tmp_dir / f"trait{trait_idx}-{k}.npy", trait[k])
+                traits_genes[trait_name] = trait["genes"]
+
+            # block-diagonal matrices are small, so they are sent to workers
+            gene_corrs_genes = gene_corrs
+            if isinstance(gene_corrs, pd.DataFrame):
+                np.save(tmp_dir / "gene_corrs.npy", gene_corrs.to_numpy())
+                gene_corrs_genes = gene_corrs.index
+
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                tasks = [
+                    executor.submit(
+                        _fit_lvs_worker,
+                        gls_args,
+                        lv_codes[chunk],
+                        (chunk[0], chunk[-1] + 1),
+                        traits_genes,
+                        tmp_dir,
+                        gene_corrs_genes,
+                        lv_weights[lv_codes[chunk]],
+                        gene_names,
+                    )
+                    for chunk in lvs_chunks
+                ]
+
+                # keep the order of LVs
+                chunks_results = [task.result() for task in tasks]
+
+        return {
+            trait_name: pd.concat(
+                [chunk_results[trait_name] for chunk_results in chunks_results],
+                ignore_index=True,
+            )
+            for trait_name in traits
+        }
+
+    def _get_lv_cov_inv(
+            self,
+            lv_code: str,
+            genes: pd.Index,
+            gene_corrs: pd.DataFrame,
+            lv_weights: pd.DataFrame,
+            gene_names: np.ndarray,
+            missing_idx: np.ndarray,
+            lv_files: dict,
+    ) -> BlockWhitener:
+        """
+        Returns the Cholesky decomposition of the LV-specific gene correlation
+        matrix for the given genes in the data. Since this matrix is an
+        identity matrix except for a block with the top genes of the LV, it is
+        returned as a BlockWhitener. If gene_corrs is given, the matrix is
+        aligned with genes; otherwise, it is read from the gene correlations
+        folder, and it is aligned with gene_names without the positions in
+        missing_idx (see 'align_genes'). Files read from the folder are kept in
+        lv_files.
+        """
+        if gene_corrs is not None:
+            block_genes = GLSPhenoplier.get_sub_mat_genes(
+                gene_corrs.index, lv_weights[lv_code], GLSPhenoplier.LV_PERC
+            )
+            block_idx = np.sort(genes.get_indexer(block_genes))
+            block_idx = block_idx[block_idx >= 0]
+            if isinstance(gene_corrs, BlockDiagCorrMatrix):
+                block_corrs = gene_corrs.subset(genes[block_idx])
+                assert block_corrs.index.equals(genes[block_idx]), "Genes are not aligned"
+            else:
+                block_corrs = gene_corrs.loc[genes[block_idx], genes[block_idx]]
+
+            return BlockWhitener(
+                genes.shape[0], block_idx, get_whitener(block_corrs)
+            )
+
+        if lv_code not in lv_files:
+            lv_files[lv_code] = GLSPhenoplier.load_chol_block(
+                self.gene_corrs_file_path, lv_code
+            )
+        block_chol, block_idx = lv_files[lv_code]
+
+        return GLSPhenoplier.get_lv_block_whitener(
+            block_chol, block_idx, gene_names.shape[0], missing_idx
+        )
+
+    @staticmethod
+    def align_genes(genes: pd.Index, gene_names: np.ndarray):
+        """
+        Aligns the genes in the data with the genes in the LV-specific gene
+        correlation matrices (gene_names).
+
+        Returns:
+            A tuple with the positions of the genes in gene_names that are not
+            in the data (sorted), and the positions in the data of the rest of
+            the genes in gene_names (in the same order).
+        """
+        gene_names_idx = genes.get_indexer(gene_names)
+        missing_idx = np.flatnonzero(gene_names_idx < 0)
+        return missing_idx, gene_names_idx[gene_names_idx >= 0]
+
+    @staticmethod
+    def get_lv_block_whitener(
+            block_chol: np.ndarray,
+            block_idx: np.ndarray,
+            n_genes: int,
+            missing_idx: np.ndarray,
+    ) -> BlockWhitener:
+        """
+        Returns a BlockWhitener for an LV-specific gene correlation matrix with
+        n_genes genes, given the Cholesky factor of its block and the positions
+        of the block genes (see 'load_chol_block'). Genes in missing_idx
+        (positions, sorted) are removed from the matrix by updating the
+        Cholesky factor of the block, instead of computing it again.
+        """
+        block_whitener = CholeskyWhitener(block_chol)
+
+        if missing_idx.shape[0] > 0:
+            block_missing = np.isin(block_idx, missing_idx)
+            block_whitener = block_whitener.delete(np.flatnonzero(block_missing))
+
+            # positions of block genes after removing the missing genes
+            block_idx = block_idx[~block_missing]
+            block_idx = block_idx - np.searchsorted(missing_idx, block_idx)
+
+        return BlockWhitener(n_genes - missing_idx.shape[0], block_idx, block_whitener)
+
     @staticmethod
     def load_chol_inv_data(input_dir, base_filename):
         """
@@ -588,14 +1315,158 @@ class GLSPhenoplier(object):
         'base_filename' is usually the LV code (like "LV311") if the inverse of
         the Cholesky decomposition is requested, or the LV code with "_corr_mat"
         (like "LV311_corr_mat") to load the original sub correlation matrix for
-        that LV.
+        that LV. Matrices are returned as dense arrays with all genes (see
+        'load_chol_inv_block' to load only the block with the LV genes).
+
+        Files can be in the current format (.npy, see 'load_chol_inv_block') or
+        in the old one (sparse matrices in .npz files).
         """
+        if base_filename in ("metadata", "gene_names"):
+            full_filepath = input_dir / (base_filename + ".npy")
+            if full_filepath.exists():
+                return np.load(full_filepath)
+
+            full_filepath = full_filepath.with_suffix(".npz")
+            assert (
+                full_filepath.exists()
+            ), f"Input file does not exist: {str(full_filepath)}"
+
+            return np.load(full_filepath)["data"]
+
+        # files in the current format are preferred when both formats are
+        # present (as in 'load_chol_inv_block')
         full_filepath = input_dir / (base_filename + ".npz")
+        if full_filepath.exists() and not GLSPhenoplier._has_current_format(
+            input_dir, base_filename
+        ):
+            return sparse.load_npz(full_filepath).toarray()
+
+        gene_names = GLSPhenoplier.load_chol_inv_data(input_dir, "gene_names")
+        block, block_idx = GLSPhenoplier.load_chol_inv_block(input_dir, base_filename)
+
+        data = np.eye(gene_names.shape[0])
+        data[np.ix_(block_idx, block_idx)] = block
+        return data
+
+    @staticmethod
+    def load_chol_inv_block(input_dir, base_filename):
+        """
+        It loads the block of an LV-specific matrix (see 'load_chol_inv_data')
+        that has the top genes of the LV; the rest of the matrix is an identity
+        matrix. In the current format, the block is stored as a dense array in
+        '{base_filename}.npy' (read as a memory-mapped array), and the positions
+        of its genes (in 'gene_names') in '{base_filename}_gene_idx.npy'. Files
+        in the old format (sparse matrices with all genes in .npz files) are
+        also supported; in this case, the block has the rows and columns that
+        are different from the identity matrix. When both formats are present,
+        the current one is used.
+
+        Returns:
+            A tuple with the block (a square numpy array) and the positions of
+            its genes (a numpy array of integers, sorted).
+        """
+        full_filepath = input_dir / (base_filename + ".npy")
+        if full_filepath.exists():
+            block = np.load(full_filepath, mmap_mode="r")
+            block_idx = np.load(input_dir / (base_filename + "_gene_idx.npy"))
+            return block, block_idx
+
+        full_filepath = full_filepath.with_suffix(".npz")
+        if GLSPhenoplier._has_current_format(input_dir, base_filename):
+            # only the Cholesky factor is stored (see 'load_chol_block')
+            lv_code = base_filename.removesuffix("_corr_mat")
+            block_chol, block_idx = GLSPhenoplier.load_chol_block(input_dir, lv_code)
+            block_whitener = CholeskyWhitener(block_chol)
+            if lv_code != base_filename:
+                return block_whitener.to_corr_matrix(), block_idx
+            return block_whitener.to_inverse(), block_idx
+
         assert (
             full_filepath.exists()
         ), f"Input file does not exist: {str(full_filepath)}"
 
-        if base_filename in ("metadata", "gene_names"):
-            return np.load(full_filepath)["data"]
-        else:
-            return sparse.load_npz(full_filepath).toarray()
+        data = sparse.load_npz(full_filepath).tocsr()
+        data_diff = data - sparse.eye(data.shape[0], format="csr")
+        block_idx = np.flatnonzero(data_diff.getnnz(axis=0) + data_diff.getnnz(axis=1))
+        block = data[block_idx][:, block_idx].toarray()
+        return block, block_idx
+
+    @staticmethod
+    def _has_current_format(input_dir, base_filename):
+        """
+        Returns True if the LV-specific matrix 'base_filename' (see
+        'load_chol_inv_data') is stored in the current format, either as a dense
+        block or as the Cholesky factor of the block (see 'load_chol_block').
+        """
+        lv_code = base_filename.removesuffix("_corr_mat")
+        return (input_dir / (base_filename + ".npy")).exists() or (
+            input_dir / (lv_code + "_chol.npy")
+        ).exists()
+
+    @staticmethod
+    def load_chol_block(input_dir, lv_code):
+        """
+        It loads the lower-triangular Cholesky factor of the block of an
+        LV-specific gene correlation matrix (see 'load_chol_inv_block'). The
+        factor is stored as a dense array in '{lv_code}_chol.npy' (read as a
+        memory-mapped array; values above the diagonal are zero), and the
+        positions of its genes in '{lv_code}_chol_gene_idx.npy'. If these files
+        do not exist (older formats), the factor is computed from the block of
+        the correlation matrix ('{lv_code}_corr_mat').
+
+        Returns:
+            A tuple with the Cholesky factor of the block (a square numpy array)
+            and the positions of its genes (a numpy array of integers, sorted).
+        """
+        full_filepath = input_dir / (lv_code + "_chol.npy")
+        if full_filepath.exists():
+            block_chol = np.load(full_filepath, mmap_mode="r")
+            block_idx = np.load(input_dir / (lv_code + "_chol_gene_idx.npy"))
+            return block_chol, block_idx
+
+        block_corrs, block_idx = GLSPhenoplier.load_chol_inv_block(
+            input_dir, f"{lv_code}_corr_mat"
+        )
+        block_whitener = CholeskyWhitener.from_corr_matrix(block_corrs)
+        return block_whitener.chol_factor, block_idx
+
+
+def _fit_lvs_worker(
+        gls_args: dict,
+        lv_codes: pd.Index,
+        lv_cols: tuple,
+        traits_genes: dict,
+        data_dir: Path,
+        gene_corrs_genes,
+        lv_weights: pd.DataFrame,
+        gene_names: np.ndarray,
+) -> dict:
+    """
+    Fits a chunk of LVs in a worker process (see
+    'GLSPhenoplier._fit_lv_specific_parallel'). Data of traits and the gene
+    correlation matrix are memory-mapped from data_dir; lv_cols has the first
+    and last (exclusive) columns of the chunk's LVs in the binarized LVs.
+    gene_corrs_genes has the genes of the gene correlation matrix, or the
+    matrix itself if it is a BlockDiagCorrMatrix.
+    """
+    gls_model = GLSPhenoplier(**gls_args, logger=None)
+
+    traits = {}
+    for trait_idx, (trait_name, genes) in enumerate(traits_genes.items()):
+        trait = {
+            k: np.load(data_dir / f"trait{trait_idx}-{k}.npy", mmap_mode="r")
+            for k in ("y", "z", "x")
+        }
+        trait["x"] = trait["x"][:, lv_cols[0]:lv_cols[1]]
+        trait["genes"] = genes
+        traits[trait_name] = trait
+
+    gene_corrs = gene_corrs_genes
+    if isinstance(gene_corrs_genes, pd.Index):
+        gene_corrs = pd.DataFrame(
+            np.load(data_dir / "gene_corrs.npy", mmap_mode="r"),
+            index=gene_corrs_genes,
+            columns=gene_corrs_genes,
+        )
+
+    return gls_model._fit_lvs(lv_codes, traits, gene_corrs, lv_weights, gene_names)
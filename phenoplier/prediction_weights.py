@@ -0,0 +1,354 @@
+"""
+It contains functions to read the prediction weights of genes from the SQLite
+files of a PrediXcan prediction model (such as MASHR), and an index with the
+weights of all genes in all tissues, which are read in bulk instead of querying
+the files for each gene and tissue.
+"""
+import sqlite3
+import concurrent.futures
+from contextlib import closing
+from functools import lru_cache
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from phenoplier.config import settings as conf
+from phenoplier.cache import get_cache_dir
+from phenoplier.variant_set import VariantSet
+
+
+def get_tissue_weights_file(tissue: str, model_type: str, check: bool = True) -> Path:
+    """
+    Returns the path to the SQLite file with the prediction weights of a tissue.
+    If check is True, it raises a ValueError exception if the file does not
+    exist.
+    """
+    model_prefix = conf.TWAS["PREDICTION_MODELS"][f"{model_type}_PREFIX"]
+
+    tissue_weights_file = (
+            Path(conf.TWAS["PREDICTION_MODELS"][model_type])
+            / f"{model_prefix}{tissue}.db"
+    )
+
+    if check and not tissue_weights_file.exists():
+        raise ValueError(
+            f"Model file for tissue does not exist: {str(tissue_weights_file)}"
+        )
+
+    return tissue_weights_file
+
+
+def connect_tissue_weights(tissue: str, model_type: str) -> sqlite3.Connection:
+    """
+    Opens a new read-only SQLite connection to the prediction model of a tissue.
+    It raises a ValueError exception if the file does not exist.
+    """
+    tissue_weights_file = get_tissue_weights_file(tissue, model_type)
+    db_uri = f"file:{str(tissue_weights_file)}?mode=ro"
+    # connections are read-only, so they can be shared by threads
+    return sqlite3.connect(db_uri, uri=True, check_same_thread=False)
+
+
+def read_tissue_weights(tissue: str, model_type: str) -> pd.DataFrame:
+    """
+    Reads all prediction weights of a tissue, with the version removed from gene
+    IDs (such as "ENSG00000000419.12") by the query itself. The connection to
+    the file is closed after reading it.
+    """
+    with closing(connect_tissue_weights(tissue, model_type)) as sqlite_conn:
+        return pd.read_sql(
+            """
+            select
+                case when instr(gene, '.') > 0 then substr(gene, 1, instr(gene, '.') - 1) else gene end as gene,
+                varID,
+                weight
+            from weights
+            """,
+            sqlite_conn,
+        )
+
+
+class PredictionWeightsIndex(object):
+    """
+    Prediction weights of all genes and tissues of a prediction model, kept in
+    compact arrays (gene, tissue and variant codes, and weights) sorted by gene,
+    tissue and variant ID. The weights of a gene in a tissue are a contiguous
+    slice of these arrays, which is found in constant time.
+
+    Use PredictionWeightsIndex.get to get the index of a prediction model: it is
+    built once (reading all tissues' files) and saved in the cache directory,
+    and it is built again only if the prediction model files change. It is
+    also the inventory of the variants of all genes and tissues (see
+    get_inventory and get_variants_info), which is used by the 'cov' command.
+
+    Args:
+        genes:
+            A numpy array with the Ensembl IDs of genes (without version).
+        tissues:
+            A numpy array with tissue names.
+        variants:
+            A numpy array with variant IDs (sorted).
+        variant_codes:
+            A numpy array with the position in variants of each weight.
+        weights:
+            A numpy array with the weights.
+        offsets:
+            A numpy array with the position of the first weight of each gene
+            and tissue: weights of genes[i] in tissues[j] go from
+            offsets[i * len(tissues) + j] to offsets[i * len(tissues) + j + 1].
+        sources:
+            A numpy array with the path, size and modification time of the
+            files the index was built from.
+    """
+
+    ARRAYS = ("genes", "tissues", "variants", "variant_codes", "weights", "offsets", "sources")
+
+    # maximum number of tissues' files read at the same time
+    N_READERS = 8
+
+    # indexes already loaded, by model type
+    _loaded = {}
+
+    def __init__(self, genes, tissues, variants, variant_codes, weights, offsets, sources):
+        self.genes = genes
+        self.tissues = tissues
+        self.variants = variants
+        self.variant_codes = variant_codes
+        self.weights = weights
+        self.offsets = offsets
+        self.sources = sources
+
+        self._genes_pos = pd.Index(genes)
+        self._tissues_pos = {t: i for i, t in enumerate(tissues)}
+
+    @staticmethod
+    def get_cache_file(model_type: str) -> Path:
+        """
+        Returns the path to the file where the index of a prediction model is
+        saved.
+        """
+        return Path(get_cache_dir()) / "prediction_weights" / f"{model_type.lower()}.npz"
+
+    @staticmethod
+    def get_sources(model_type: str) -> np.ndarray:
+        """
+        Returns the path, size and modification time of all tissues' files of a
+        prediction model, which are used to check if a saved index is up to
+        date.
+        """
+        model_prefix = conf.TWAS["PREDICTION_MODELS"][f"{model_type}_PREFIX"]
+        models_dir = Path(conf.TWAS["PREDICTION_MODELS"][model_type]).resolve()
+
+        return np.array(
+            [
+                [str(f), str(f.stat().st_size), str(f.stat().st_mtime_ns)]
+                for f in sorted(models_dir.glob(f"{model_prefix}*.db"))
+            ],
+            dtype=str,
+        ).reshape(-1, 3)
+
+    @staticmethod
+    def get(model_type: str) -> "PredictionWeightsIndex":
+        """
+        Returns the index of a prediction model. It is read from the cache file
+        if it is up to date, or built (and saved) otherwise.
+        """
+        if model_type in PredictionWeightsIndex._loaded:
+            return PredictionWeightsIndex._loaded[model_type]
+
+        sources = PredictionWeightsIndex.get_sources(model_type)
+        cache_file = PredictionWeightsIndex.get_cache_file(model_type)
+
+        index = None
+        if cache_file.exists():
+            index = PredictionWeightsIndex.load(cache_file)
+            if not np.array_equal(index.sources, sources):
+                index = None
+
+        if index is None:
+            index = PredictionWeightsIndex.build(model_type, sources)
+            try:
+                index.save(cache_file)
+            except OSError:
+                # the cache directory could be read-only; the index is still used
+                pass
+
+        PredictionWeightsIndex._loaded[model_type] = index
+        return index
+
+    @staticmethod
+    def build(model_type: str, sources: np.ndarray = None) -> "PredictionWeightsIndex":
+        """
+        Builds the index of a prediction model by reading the weights table of
+        all tissues' files (several files at the same time, in threads).
+        """
+        if sources is None:
+            sources = PredictionWeightsIndex.get_sources(model_type)
+
+        model_prefix = conf.TWAS["PREDICTION_MODELS"][f"{model_type}_PREFIX"]
+        tissues_names = [Path(tissue_file).name[len(model_prefix) : -len(".db")] for tissue_file, _, _ in sources]
+
+        tissues_data = []
+        if len(tissues_names) > 0:
+            n_readers = min(PredictionWeightsIndex.N_READERS, len(tissues_names))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=n_readers) as executor:
+                for tissue, df in zip(
+                    tissues_names, executor.map(lambda t: read_tissue_weights(t, model_type), tissues_names)
+                ):
+                    tissues_data.append(df.assign(tissue=tissue))
+
+        if len(tissues_data) > 0:
+            data = pd.concat(tissues_data, ignore_index=True)
+        else:
+            data = pd.DataFrame({"gene": [], "varID": [], "weight": [], "tissue": []})
+
+        gene_codes, genes = pd.factorize(data["gene"], sort=True)
+        tissue_codes, tissues = pd.factorize(data["tissue"], sort=True)
+        variant_codes, variants = pd.factorize(data["varID"], sort=True)
+
+        order = np.lexsort((variant_codes, tissue_codes, gene_codes))
+        gene_tissue_codes = gene_codes[order] * len(tissues) + tissue_codes[order]
+        offsets = np.searchsorted(
+            gene_tissue_codes, np.arange(len(genes) * len(tissues) + 1)
+        )
+
+        return PredictionWeightsIndex(
+            genes=np.asarray(genes, dtype=str),
+            tissues=np.asarray(tissues, dtype=str),
+            variants=np.asarray(variants, dtype=str),
+            variant_codes=variant_codes[order].astype(np.int32),
+            weights=data["weight"].to_numpy(dtype=np.float64)[order],
+            offsets=offsets.astype(np.int64),
+            sources=sources,
+        )
+
+    def save(self, path: Path):
+        """
+        Saves the index to a file.
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        np.savez(path, **{k: getattr(self, k) for k in PredictionWeightsIndex.ARRAYS})
+
+    @staticmethod
+    def load(path: Path) -> "PredictionWeightsIndex":
+        """
+        Reads an index saved with the save method.
+        """
+        with np.load(path) as data:
+            return PredictionWeightsIndex(**{k: data[k] for k in PredictionWeightsIndex.ARRAYS})
+
+    def get_weights_codes(self, gene_id: str, tissue: str):
+        """
+        Returns the prediction weights of a gene in a tissue as a tuple of two
+        numpy arrays (views of the index): the variant codes (positions in
+        self.variants, sorted) and the weights. Arrays are empty if the gene
+        has no predictors in the tissue. It raises a ValueError exception if
+        the tissue is not in the prediction model.
+        """
+        if tissue not in self._tissues_pos:
+            raise ValueError(f"Tissue not found in prediction models: {tissue}")
+
+        start, end = 0, 0
+        if gene_id in self._genes_pos:
+            pos = self._genes_pos.get_loc(gene_id) * len(self.tissues) + self._tissues_pos[tissue]
+            start, end = self.offsets[pos], self.offsets[pos + 1]
+
+        return self.variant_codes[start:end], self.weights[start:end]
+
+    def get_weights(self, gene_id: str, tissue: str):
+        """
+        Returns the prediction weights of a gene in a tissue.
+
+        Args:
+            gene_id:
+                The Ensembl ID of the gene (without version).
+            tissue:
+                The tissue name.
+
+        Returns:
+            A pandas series with the weights indexed by variant ID (sorted),
+            which is empty if the gene has no predictors in the tissue. It
+            raises a ValueError exception if the tissue is not in the
+            prediction model.
+        """
+        variant_codes, weights = self.get_weights_codes(gene_id, tissue)
+
+        return pd.Series(
+            weights,
+            index=pd.Index(self.variants[variant_codes], name="varID"),
+            name="weight",
+        )
+
+    def get_inventory(self) -> pd.DataFrame:
+        """
+        Returns all weights of the index as a data frame with one row per gene,
+        tissue and variant, sorted in that order. Columns "gene", "tissue" and
+        "varID" are categorical (with the arrays of the index as categories), so
+        the data frame takes about as much memory as the index itself.
+        """
+        n_tissues = len(self.tissues)
+        gene_tissue_codes = np.repeat(np.arange(len(self.genes) * n_tissues), np.diff(self.offsets))
+
+        return pd.DataFrame(
+            {
+                "gene": pd.Categorical.from_codes(gene_tissue_codes // n_tissues, categories=self.genes),
+                "tissue": pd.Categorical.from_codes(gene_tissue_codes % n_tissues, categories=self.tissues),
+                "varID": pd.Categorical.from_codes(self.variant_codes, categories=self.variants),
+                "weight": self.weights,
+            }
+        )
+
+    @lru_cache(maxsize=1)
+    def get_variants_info(self) -> pd.DataFrame:
+        """
+        Returns the variants of the index (in the same order as self.variants)
+        with their chromosome (as an integer), position and alleles, parsed from
+        their IDs (such as "chr1_33071920_A_C_b38").
+        """
+        variants_info = pd.Series(self.variants, dtype=object).str.split("_", n=4, expand=True)
+        variants_info = variants_info.reindex(columns=range(4))
+
+        return pd.DataFrame(
+            {
+                "varID": self.variants.astype(object),
+                "chr": variants_info[0].str.removeprefix("chr").astype(int),
+                "position": variants_info[1].astype(int),
+                "ref_allele": variants_info[2],
+                "eff_allele": variants_info[3],
+            }
+        )
+
+    @lru_cache(maxsize=1)
+    def get_variant_keys(self) -> np.ndarray:
+        """
+        Returns the keys of the variants in self.variants (see
+        VariantSet.encode).
+        """
+        return VariantSet.encode(self.variants)
+
+    @lru_cache(maxsize=4)
+    def get_variants_mask(self, snps_subset) -> np.ndarray:
+        """
+        Returns a boolean numpy array that indicates which variants (in
+        self.variants) are in a subset of SNP IDs (a VariantSet or a frozenset).
+        """
+        if isinstance(snps_subset, VariantSet):
+            return snps_subset.contains_keys(self.get_variant_keys())
+
+        return np.fromiter(
+            (v in snps_subset for v in self.variants.tolist()),
+            dtype=bool,
+            count=self.variants.shape[0],
+        )
+
+    def get_chromosome_codes(self, snps_chr: str):
+        """
+        Returns the range (start, end) of the codes of variants in a
+        chromosome (given in format "chr{num}"). Since variant IDs are sorted
+        and start with the chromosome, codes of a chromosome are contiguous.
+        """
+        # "`" follows "_" in ASCII
+        start, end = np.searchsorted(self.variants, [f"{snps_chr}_", f"{snps_chr}`"])
+        return int(start), int(end)
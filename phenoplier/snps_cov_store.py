@@ -0,0 +1,255 @@
+"""
+It contains a store for the SNP covariance matrices (one per chromosome) of a
+reference panel and prediction model, which are read as memory-mapped arrays
+instead of loading them from the HDF5 file every time.
+"""
+import os
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from phenoplier.config import settings as conf
+
+
+def get_snps_positions(snps_cov_variants: np.ndarray, snps_ids) -> np.ndarray:
+    """
+    Returns the positions of SNPs in a covariance matrix given its SNPs ids
+    (sorted), or -1 for SNPs that are not in the matrix (no genotypes).
+    """
+    snps_ids = np.asarray(snps_ids, dtype=str)
+    if snps_cov_variants.shape[0] == 0:
+        return np.full(snps_ids.shape[0], -1, dtype=int)
+
+    pos = np.searchsorted(snps_cov_variants, snps_ids)
+    pos = np.minimum(pos, snps_cov_variants.shape[0] - 1)
+    return np.where(snps_cov_variants[pos] == snps_ids, pos, -1)
+
+
+class BlockDiagonalCov(object):
+    """
+    A block-diagonal SNP covariance matrix, where SNPs in different LD blocks
+    have zero covariance. Only the matrices of the blocks are stored, one after
+    the other in a flat array, and they are read only when SNPs in them are
+    indexed.
+
+    Only indexing with np.ix_ (rows and columns) is supported, which returns a
+    dense numpy array as if the whole matrix was indexed.
+
+    Args:
+        data:
+            A flat numpy array with the covariance matrix of each block (in
+            row-major order), one after the other.
+        blocks:
+            A numpy array with one row per SNP (rows/columns of the matrix) and
+            two columns: the block of the SNP, and its position in the block's
+            matrix.
+    """
+
+    def __init__(self, data: np.ndarray, blocks: np.ndarray):
+        self.data = data
+        self.blocks = blocks
+        self.block_sizes = np.bincount(blocks[:, 0]).astype(np.int64)
+        self.block_starts = np.concatenate(([0], np.cumsum(self.block_sizes**2)))
+
+        self.shape = (blocks.shape[0], blocks.shape[0])
+        self.dtype = data.dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes + self.blocks.nbytes
+
+    def get_block(self, block: int) -> np.ndarray:
+        """
+        Returns the covariance matrix of the SNPs in a block.
+        """
+        start, size = self.block_starts[block], self.block_sizes[block]
+        return self.data[start: start + size * size].reshape(size, size)
+
+    def __getitem__(self, key) -> np.ndarray:
+        rows, cols = (np.asarray(k).ravel() for k in key)
+        res = np.zeros((rows.shape[0], cols.shape[0]), dtype=self.dtype)
+
+        # rows and columns sorted by block, so each block is read once
+        rows_order = np.argsort(self.blocks[rows, 0], kind="stable")
+        rows_blocks = self.blocks[rows[rows_order], 0]
+        cols_order = np.argsort(self.blocks[cols, 0], kind="stable")
+        cols_blocks = self.blocks[cols[cols_order], 0]
+
+        for block in np.intersect1d(rows_blocks, cols_blocks):
+            r = rows_order[np.searchsorted(rows_blocks, block): np.searchsorted(rows_blocks, block, side="right")]
+            c = cols_order[np.searchsorted(cols_blocks, block): np.searchsorted(cols_blocks, block, side="right")]
+            res[np.ix_(r, c)] = self.get_block(block)[np.ix_(self.blocks[rows[r], 1], self.blocks[cols[c], 1])]
+
+        return res
+
+
+class SnpsCovStore(object):
+    """
+    SNP covariance matrices by chromosome, read from the HDF5 file generated by
+    the "cov" command (snps_chr_blocks_cov.h5).
+
+    The first time a chromosome is read, its covariance matrix (sorted by SNP
+    ID) is converted to a numpy array file next to the HDF5 file (in folder
+    snps_chr_blocks_cov.mmap), together with an array of the sorted SNP IDs.
+    These files are then memory-mapped, so several processes share the
+    operating system's page cache, and positions of SNPs are found with
+    np.searchsorted. The conversion is done again if the HDF5 file is newer.
+
+    If the "cov" command was run with LD blocks, a chromosome only has the
+    covariances within each LD block (keys "chr{num}_blocks" and
+    "chr{num}_blocks_cov" in the HDF5 file), and it is returned as a
+    BlockDiagonalCov.
+
+    Chromosomes read are kept open (least recently used first evicted) while
+    their total size is below max_bytes.
+
+    Args:
+        snps_cov_file:
+            Path to the HDF5 file with SNP covariance matrices.
+        max_bytes:
+            Maximum size (in bytes) of the chromosomes kept open.
+    """
+
+    MAX_BYTES = 8 * 1024**3
+
+    # stores already created, by reference panel and prediction model
+    _stores = {}
+
+    def __init__(self, snps_cov_file: Path, max_bytes: int = None):
+        self.snps_cov_file = Path(snps_cov_file)
+        self.mmap_dir = self.snps_cov_file.with_suffix(".mmap")
+        self.max_bytes = max_bytes if max_bytes is not None else SnpsCovStore.MAX_BYTES
+        self._open = OrderedDict()
+
+    @staticmethod
+    def get_file(reference_panel: str, model_type: str) -> Path:
+        """
+        Returns the path to the HDF5 file with SNP covariance matrices of a
+        reference panel and prediction model.
+        """
+        return (
+                Path(conf.RESULTS["GLS"])
+                / "gene_corrs"
+                / "reference_panels"
+                / reference_panel.lower()
+                / model_type.lower()
+                / "snps_chr_blocks_cov.h5"
+        )
+
+    @staticmethod
+    def get_store(reference_panel: str, model_type: str) -> "SnpsCovStore":
+        """
+        Returns the store of SNP covariance matrices for a reference panel and
+        prediction model.
+        """
+        key = (reference_panel.lower(), model_type.lower())
+
+        if key not in SnpsCovStore._stores:
+            snps_cov_file = SnpsCovStore.get_file(reference_panel, model_type)
+            assert snps_cov_file.exists(), f"Input file does not exist: {snps_cov_file}"
+            SnpsCovStore._stores[key] = SnpsCovStore(snps_cov_file)
+
+        return SnpsCovStore._stores[key]
+
+    @property
+    def open_bytes(self) -> int:
+        """
+        Returns the total size (in bytes) of the chromosomes kept open.
+        """
+        return sum(cov.nbytes + variants.nbytes for cov, variants in self._open.values())
+
+    def _get_files(self, snps_chr: str):
+        return (
+            self.mmap_dir / f"{snps_chr}.npy",
+            self.mmap_dir / f"{snps_chr}_variants.npy",
+            self.mmap_dir / f"{snps_chr}_blocks.npy",
+        )
+
+    @staticmethod
+    def _read_blocks(store: pd.HDFStore, snps_chr: str):
+        """
+        Reads the covariances within LD blocks of a chromosome, and returns the
+        SNP IDs (sorted), their blocks and positions (see BlockDiagonalCov), and
+        the flat array with the blocks' matrices.
+        """
+        snps_blocks = store[f"{snps_chr}_blocks"]["block"]
+        blocks_cov = store[f"{snps_chr}_blocks_cov"].to_numpy()
+
+        # SNPs are stored by block, in the order of the rows of the block's matrix
+        blocks = np.column_stack(
+            [snps_blocks.to_numpy(dtype=np.int64), snps_blocks.groupby(snps_blocks).cumcount().to_numpy()]
+        )
+        order = np.argsort(np.asarray(snps_blocks.index, dtype=str), kind="stable")
+        return np.asarray(snps_blocks.index, dtype=str)[order], blocks[order], blocks_cov
+
+    def _convert(self, snps_chr: str):
+        """
+        Converts the covariance matrix of a chromosome in the HDF5 file to numpy
+        array files, if they do not exist or are older than the HDF5 file.
+        """
+        cov_file, variants_file, blocks_file = self._get_files(snps_chr)
+        if (
+            cov_file.exists()
+            and variants_file.exists()
+            and cov_file.stat().st_mtime >= self.snps_cov_file.stat().st_mtime
+        ):
+            return
+
+        with pd.HDFStore(self.snps_cov_file, mode="r") as store:
+            if f"/{snps_chr}_blocks" in store.keys():
+                variants, blocks, cov = SnpsCovStore._read_blocks(store, snps_chr)
+            else:
+                snps_cov = store[snps_chr].sort_index(axis=0).sort_index(axis=1)
+                variants, blocks, cov = np.asarray(snps_cov.index, dtype=str), None, snps_cov.to_numpy()
+
+        # files are written with a temporary name first, since other
+        # processes could be reading the same chromosome
+        self.mmap_dir.mkdir(parents=True, exist_ok=True)
+        if blocks is None:
+            blocks_file.unlink(missing_ok=True)
+        for output_file, data in ((variants_file, variants), (blocks_file, blocks), (cov_file, cov)):
+            if data is None:
+                continue
+            tmp_file = output_file.with_suffix(f".{os.getpid()}.tmp.npy")
+            np.save(tmp_file, data)
+            os.replace(tmp_file, output_file)
+
+    def get(self, snps_chr: str):
+        """
+        Returns the covariance matrix of the SNPs in a chromosome.
+
+        Args:
+            snps_chr:
+                A string specifying the chromosome in format "chr{num}".
+
+        Returns:
+            A tuple with two elements: a square numpy array (memory-mapped)
+            with the SNP covariances (or a BlockDiagonalCov if computed with
+            LD blocks), and a numpy array with the SNP IDs in rows/columns
+            (sorted).
+        """
+        if snps_chr in self._open:
+            self._open.move_to_end(snps_chr)
+            return self._open[snps_chr]
+
+        self._convert(snps_chr)
+        cov_file, variants_file, blocks_file = self._get_files(snps_chr)
+        snps_cov = np.load(cov_file, mmap_mode="r")
+        if blocks_file.exists():
+            snps_cov = BlockDiagonalCov(snps_cov, np.load(blocks_file))
+        self._open[snps_chr] = (snps_cov, np.load(variants_file))
+
+        # close the least recently used chromosomes, but keep the one requested
+        while len(self._open) > 1 and self.open_bytes > self.max_bytes:
+            self._open.popitem(last=False)
+
+        return self._open[snps_chr]
+
+    def get_positions(self, snps_chr: str, snps_ids) -> np.ndarray:
+        """
+        Returns the positions of SNPs in the covariance matrix of a chromosome
+        (see get_snps_positions).
+        """
+        return get_snps_positions(self.get(snps_chr)[1], snps_ids)
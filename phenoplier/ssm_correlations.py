@@ -0,0 +1,586 @@
+"""
+It contains functions to compute the correlation of the model sum of squares
+(SSM) of S-MultiXcan between all pairs of genes in a chromosome at once (see
+Gene.get_ssm_correlation for the correlation of a single pair of genes).
+
+For a gene i with tissues correlation matrix C_i = W_i^T S W_i (where W_i has
+the prediction weights of the gene in each tissue, scaled by the standard
+deviation of its predicted expression, and S is the SNP covariance matrix), and
+its top singular values s_i and vectors V_i, the SSM covariance between genes i
+and j is 2 * ||A_i S A_j^T||_F^2, where A_i = diag(s_i^-1/2) V_i W_i^T is the
+"SSM projection" of the gene. Projections are computed once per gene, and then
+the correlations between all pairs of genes are computed with matrix products.
+
+To split the work of a chromosome across several processes or nodes, genes can
+be grouped in blocks, and the pairs of blocks (upper triangle) assigned to
+shards with a similar amount of work (see get_correlation_shards). If only the
+correlations of genes within some distance are needed, the pairs are found with
+a sweep over genes sorted by position (see compute_ssm_correlations_window).
+"""
+import heapq
+
+import numpy as np
+from scipy import sparse
+
+from phenoplier.entity import Gene
+from phenoplier.snps_cov_store import get_snps_positions
+
+
+def compute_ssm_projection(
+    tissues_weights: list,
+    snps_cov: np.ndarray,
+    snps_cov_variants: np.ndarray,
+    condition_number: float = 30,
+):
+    """
+    Computes the SSM projection of a gene from its prediction weights.
+
+    Args:
+        tissues_weights:
+            A list of pandas series (one per tissue) with the prediction weights
+            of the gene, indexed by SNP IDs.
+        snps_cov:
+            The SNP covariance matrix of the chromosome (a square numpy array).
+        snps_cov_variants:
+            A numpy array with the SNP IDs (sorted) in rows/columns of
+            snps_cov.
+        condition_number:
+            The condition number used to select the top eigenvalues from the
+            SVD decomposition of the tissues correlations (see
+            Gene.get_tissues_correlations_svd).
+
+    Returns:
+        A tuple with two elements: a numpy array with the positions of the SNPs
+        of the gene in snps_cov, and a numpy array with the projection (A_i^T),
+        with these SNPs in rows and the selected principal components in
+        columns. None if the gene has no SNP predictors with genotypes.
+    """
+    tissues_positions = [
+        (get_snps_positions(snps_cov_variants, w.index), w.to_numpy())
+        for w in tissues_weights
+    ]
+
+    return _compute_ssm_projection(tissues_positions, snps_cov, condition_number)
+
+
+def _compute_ssm_projection(
+    tissues_positions: list, snps_cov: np.ndarray, condition_number: float
+):
+    """
+    Same as compute_ssm_projection, but the weights of each tissue are given as
+    a tuple of two numpy arrays: the positions of the SNPs in snps_cov (-1 for
+    SNPs without genotypes) and the weights.
+    """
+    gene_svd = _compute_gene_svd(tissues_positions, snps_cov)
+    if gene_svd is None:
+        return None
+
+    return get_ssm_projection_from_svd(gene_svd, condition_number)
+
+
+def _compute_gene_svd(tissues_positions: list, snps_cov: np.ndarray):
+    """
+    Computes the SVD of the tissues correlations of a gene given its weights in
+    each tissue (as in _compute_ssm_projection).
+
+    Returns:
+        A dictionary with the positions of the SNPs of the gene in snps_cov
+        ("snps_idx"), their weights in the tissues with non-zero variance
+        ("weights", SNPs in rows and tissues in columns), the variance of the
+        predicted expression in these tissues ("variances"), a boolean array
+        indicating which of the given tissues were selected
+        ("selected_tissues"), and the three arrays returned by numpy.linalg.svd
+        ("u", "s" and "vt"). None if the gene has no SNP predictors with
+        genotypes.
+    """
+    snps_idx = np.unique(np.concatenate([pos for pos, _ in tissues_positions]))
+    snps_idx = snps_idx[snps_idx >= 0]
+    if snps_idx.shape[0] == 0:
+        return None
+
+    weights = np.zeros((snps_idx.shape[0], len(tissues_positions)))
+    for t_idx, (pos, w) in enumerate(tissues_positions):
+        with_genotypes = pos >= 0
+        weights[np.searchsorted(snps_idx, pos[with_genotypes]), t_idx] = w[with_genotypes]
+
+    gene_snps_cov = snps_cov[np.ix_(snps_idx, snps_idx)]
+
+    # variance of the predicted expression in each tissue; tissues with zero
+    # variance (no SNP predictors with genotypes) are not used
+    variances = np.einsum("st,st->t", weights, gene_snps_cov @ weights)
+    selected_tissues = variances != 0.0
+    if not selected_tissues.any():
+        return None
+    weights = weights[:, selected_tissues]
+    variances = variances[selected_tissues]
+
+    scaled_weights = weights / np.sqrt(variances)
+    tissues_corrs = scaled_weights.T @ gene_snps_cov @ scaled_weights
+    u, s, vt = np.linalg.svd(tissues_corrs)
+
+    return {
+        "snps_idx": snps_idx,
+        "weights": weights,
+        "variances": variances,
+        "selected_tissues": selected_tissues,
+        "u": u,
+        "s": s,
+        "vt": vt,
+    }
+
+
+def select_singular_values(s: np.ndarray, condition_number: float = 30) -> np.ndarray:
+    """
+    Returns a boolean numpy array that indicates the top singular values (in s)
+    selected with the condition number, as in S-MultiXcan (see
+    Gene.get_tissues_correlations_svd).
+    """
+    return s >= np.max(s) * (1.0 / condition_number)
+
+
+def get_ssm_projection_from_svd(gene_svd: dict, condition_number: float = 30):
+    """
+    Returns the SSM projection of a gene (see compute_ssm_projection) from the
+    SVD of its tissues correlations (see get_gene_svd). The top singular values
+    are selected with the condition number (see select_singular_values).
+    """
+    s, vt = gene_svd["s"], gene_svd["vt"]
+    selected = select_singular_values(s, condition_number)
+    scaled_weights = gene_svd["weights"] / np.sqrt(gene_svd["variances"])
+
+    return gene_svd["snps_idx"], (scaled_weights @ vt[selected].T) * s[selected] ** (-1 / 2)
+
+
+def get_gene_svd(
+    gene: Gene,
+    tissues: tuple = None,
+    snps_subset: frozenset = None,
+    reference_panel: str = "GTEX_V8",
+    model_type: str = "MASHR",
+):
+    """
+    Returns the SVD of the tissues correlations of a gene (see
+    _compute_gene_svd), with the names of the selected tissues in "tissues"
+    instead of "selected_tissues". The arguments are the same as in
+    Gene.get_tissues_correlations_svd, but all singular values are kept.
+    """
+    tissues = Gene._get_tissues(tissues, model_type)
+
+    snps_cov = None
+    tissues_names = []
+    tissues_positions = []
+    for tissue in tissues:
+        w = gene._get_prediction_weights_codes(tissue, model_type, snps_subset)
+        if w is None:
+            continue
+
+        variant_codes, weights = w
+        snps_cov, snps_pos = Gene._get_variants_cov_positions(
+            variant_codes, reference_panel, model_type
+        )
+        tissues_names.append(tissue)
+        tissues_positions.append((snps_pos, weights))
+
+    if len(tissues_positions) == 0:
+        return None
+
+    gene_svd = _compute_gene_svd(tissues_positions, snps_cov)
+    if gene_svd is None:
+        return None
+
+    gene_svd["tissues"] = np.array(tissues_names, dtype=str)[gene_svd.pop("selected_tissues")]
+    return gene_svd
+
+
+def get_gene_ssm_projection(
+    gene: Gene,
+    tissues: tuple = None,
+    snps_subset: frozenset = None,
+    reference_panel: str = "GTEX_V8",
+    model_type: str = "MASHR",
+    condition_number: float = 30,
+):
+    """
+    Returns the SSM projection of a gene (see compute_ssm_projection). The
+    arguments are the same as in Gene.get_ssm_correlation.
+    """
+    gene_svd = get_gene_svd(gene, tissues, snps_subset, reference_panel, model_type)
+    if gene_svd is None:
+        return None
+
+    return get_ssm_projection_from_svd(gene_svd, condition_number)
+
+
+class _StackedProjections(object):
+    """
+    SSM projections of a list of genes stacked as columns of a sparse matrix
+    (SNPs in rows). Genes without projection (None) are not included.
+    """
+
+    def __init__(self, projections: list):
+        self.genes = np.array(
+            [i for i, p in enumerate(projections) if p is not None], dtype=int
+        )
+        self.sizes = np.array([projections[i][1].shape[1] for i in self.genes], dtype=int)
+        self.offsets = np.concatenate(([0], np.cumsum(self.sizes)))
+
+        if self.genes.shape[0] == 0:
+            self.snps_idx = np.array([], dtype=int)
+            self.data = sparse.csc_matrix((0, 0))
+            return
+
+        self.snps_idx = np.unique(np.concatenate([projections[i][0] for i in self.genes]))
+
+        rows, cols, values = [], [], []
+        for gene_i, offset in zip(self.genes, self.offsets):
+            snps_idx, proj = projections[gene_i]
+            snps_pos = np.searchsorted(self.snps_idx, snps_idx)
+            rows.append(np.repeat(snps_pos, proj.shape[1]))
+            cols.append(np.tile(np.arange(offset, offset + proj.shape[1]), proj.shape[0]))
+            values.append(proj.ravel())
+
+        self.data = sparse.csc_matrix(
+            (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(self.snps_idx.shape[0], self.offsets[-1]),
+        )
+
+    def batches(self, max_n_snps: int):
+        """
+        Yields ranges (start, end) of consecutive genes (positions in
+        self.genes) with no more than max_n_snps SNPs in total (or a single
+        gene if it has more).
+        """
+        start = 0
+        while start < self.genes.shape[0]:
+            end = start + 1
+            while (
+                end < self.genes.shape[0]
+                and self.take(start, end + 1)[0].shape[0] <= max_n_snps
+            ):
+                end += 1
+            yield start, end
+            start = end
+
+    def take(self, start: int, end: int):
+        """
+        Returns the projections of genes from start to end (positions in
+        self.genes): a numpy array with the positions of their SNPs in the SNP
+        covariance matrix, and a sparse matrix with the projections of these
+        SNPs only.
+        """
+        data = self.data[:, self.offsets[start] : self.offsets[end]]
+        used_snps = np.unique(data.indices)
+        return self.snps_idx[used_snps], data[used_snps]
+
+
+def compute_ssm_correlations(
+    projections: list,
+    snps_cov: np.ndarray,
+    other_projections: list = None,
+    max_batch_n_snps: int = 2048,
+) -> np.ndarray:
+    """
+    Computes the SSM correlations between all pairs of genes given their SSM
+    projections, which are the same as computed by Gene.get_ssm_correlation
+    with use_within_distance=False (see get_genes_within_distance to set
+    correlations between genes far apart to zero).
+
+    Args:
+        projections:
+            A list with the SSM projections of genes (see
+            get_gene_ssm_projection); None for genes without projection.
+        snps_cov:
+            The SNP covariance matrix of the chromosome (a square numpy array).
+        other_projections:
+            (Optional) A second list of SSM projections. If given, the
+            correlations between genes in projections (rows) and genes in
+            other_projections (columns) are computed. Otherwise, it computes
+            the correlations between all genes in projections.
+        max_batch_n_snps:
+            Genes are processed in batches of columns with this maximum
+            number of SNPs to limit memory usage.
+
+    Returns:
+        A numpy array with genes in projections in rows and genes in
+        other_projections (or projections) in columns. Correlations with genes
+        without projection are zero.
+    """
+    symmetric = other_projections is None
+    if symmetric:
+        other_projections = projections
+
+    rows = _StackedProjections(projections)
+    cols = rows if symmetric else _StackedProjections(other_projections)
+
+    res = np.zeros((len(projections), len(other_projections)))
+
+    for cols_start, cols_end in cols.batches(max_batch_n_snps):
+        # if the result is symmetric, only the upper triangle is computed
+        rows_end = cols_end if symmetric else rows.genes.shape[0]
+        if rows_end == 0:
+            continue
+
+        rows_snps_idx, rows_proj = rows.take(0, rows_end)
+        cols_snps_idx, cols_proj = cols.take(cols_start, cols_end)
+
+        # t0_t1_cov (see Gene.get_ssm_correlation) of all pairs of genes
+        cols_cov = snps_cov[np.ix_(rows_snps_idx, cols_snps_idx)] @ cols_proj.toarray()
+        pairs_cov = np.asarray(rows_proj.T @ cols_cov)
+
+        # squared Frobenius norm of each block (pair of genes)
+        cov_ssm = np.add.reduceat(pairs_cov ** 2, rows.offsets[:rows_end], axis=0)
+        cov_ssm = np.add.reduceat(
+            cov_ssm,
+            cols.offsets[cols_start:cols_end] - cols.offsets[cols_start],
+            axis=1,
+        )
+
+        ssm_sd = np.sqrt(np.outer(rows.sizes[:rows_end], cols.sizes[cols_start:cols_end]))
+        res[np.ix_(rows.genes[:rows_end], cols.genes[cols_start:cols_end])] = cov_ssm / ssm_sd
+
+    if symmetric:
+        res = np.triu(res) + np.triu(res, k=1).T
+
+    return res
+
+
+def _get_genes_extended_positions(genes: list, distance_bp: float) -> np.ndarray:
+    """
+    Returns a numpy array with the start and end positions of genes (rows)
+    extended by a distance, or NaN if their positions are unknown.
+    """
+    positions = np.full((len(genes), 2), np.nan)
+    for gene_idx, gene in enumerate(genes):
+        start = gene.get_attribute("start_position")
+        end = gene.get_attribute("end_position")
+        if start is None or end is None:
+            continue
+        positions[gene_idx] = (int(start) - distance_bp, int(end) + distance_bp)
+
+    return positions
+
+
+def get_genes_within_distance(genes: list, distance_bp: float = 2.5e6) -> np.ndarray:
+    """
+    Returns a square boolean numpy array where each element (i, j) is True if
+    genes i and j are within a distance (see Gene.within_distance).
+    """
+    positions = _get_genes_extended_positions(genes, distance_bp)
+    starts = positions[:, 0]
+    ends = positions[:, 1]
+
+    return (
+        (starts[None, :] <= starts[:, None]) & (starts[:, None] <= ends[None, :])
+    ) | ((starts[:, None] <= starts[None, :]) & (starts[None, :] <= ends[:, None]))
+
+
+def get_gene_pairs_within_distance(genes: list, rows, cols, distance_bp: float = 2.5e6) -> np.ndarray:
+    """
+    Same as get_genes_within_distance, but only for the pairs of genes with
+    positions in rows and cols (numpy arrays with the same length). It returns
+    a boolean numpy array with one element per pair.
+    """
+    positions = _get_genes_extended_positions(genes, distance_bp)
+    starts = positions[:, 0]
+    ends = positions[:, 1]
+    rows = np.asarray(rows, dtype=int)
+    cols = np.asarray(cols, dtype=int)
+
+    return ((starts[cols] <= starts[rows]) & (starts[rows] <= ends[cols])) | (
+        (starts[rows] <= starts[cols]) & (starts[cols] <= ends[rows])
+    )
+
+
+def get_genes_window_ends(starts, ends, distance_bp: float = 2.5e6) -> np.ndarray:
+    """
+    Given the start and end positions of genes sorted by start position,
+    returns for each gene i the end (exclusive) of the range of genes j >= i
+    within a distance (as in get_genes_within_distance). Since genes are
+    sorted, the genes following i that are within the distance are
+    contiguous: those whose extended start is not after the extended end of
+    gene i.
+    """
+    starts = np.asarray(starts, dtype=float) - distance_bp
+    ends = np.asarray(ends, dtype=float) + distance_bp
+    if np.any(np.diff(starts) < 0):
+        raise ValueError("Genes must be sorted by start position")
+
+    return np.searchsorted(starts, ends, side="right")
+
+
+def compute_ssm_correlations_window(
+    projections: list,
+    snps_cov: np.ndarray,
+    starts,
+    ends,
+    distance_bp: float = 2.5e6,
+    max_batch_n_genes: int = 256,
+    **kwargs,
+) -> sparse.csr_matrix:
+    """
+    Computes the SSM correlations only between genes within a distance (see
+    compute_ssm_correlations, which receives any other keyword argument).
+    Genes must be sorted by start position. Genes are processed in batches
+    of rows, each one with the columns of the genes within the distance
+    only, so the work is proportional to the number of genes times the
+    number of genes in the window instead of the number of pairs.
+
+    Returns:
+        A sparse symmetric matrix with the correlations of genes within the
+        distance (other pairs are not stored).
+    """
+    n_genes = len(projections)
+    window_ends = get_genes_window_ends(starts, ends, distance_bp)
+
+    rows, cols, values = [], [], []
+    for start in range(0, n_genes, max_batch_n_genes):
+        end = min(start + max_batch_n_genes, n_genes)
+        cols_end = max(int(window_ends[start:end].max()), end)
+
+        data = compute_ssm_correlations(
+            projections[start:end], snps_cov, other_projections=projections[start:cols_end], **kwargs
+        )
+
+        # pairs (i, j) with i <= j < window_ends[i]
+        row_idx = np.arange(start, end)[:, None]
+        col_idx = np.arange(start, cols_end)[None, :]
+        in_window = (col_idx >= row_idx) & (col_idx < window_ends[start:end, None])
+        pairs_rows, pairs_cols = np.nonzero(in_window)
+        rows.append(pairs_rows + start)
+        cols.append(pairs_cols + start)
+        values.append(data[pairs_rows, pairs_cols])
+
+    if n_genes == 0:
+        return sparse.csr_matrix((0, 0))
+
+    res = sparse.csr_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(n_genes, n_genes),
+    )
+    res.eliminate_zeros()
+
+    return (res + sparse.triu(res, k=1).T).tocsr()
+
+
+def get_gene_n_snps(
+    gene: Gene,
+    tissues: tuple = None,
+    snps_subset: frozenset = None,
+    model_type: str = "MASHR",
+) -> int:
+    """
+    Returns the number of distinct SNP predictors of a gene across tissues (in
+    snps_subset, if given), which is used to estimate the work of computing its
+    correlations. The arguments are the same as in get_gene_ssm_projection.
+    """
+    tissues = Gene._get_tissues(tissues, model_type)
+
+    variant_codes = [
+        w[0]
+        for tissue in tissues
+        if (w := gene._get_prediction_weights_codes(tissue, model_type, snps_subset)) is not None
+    ]
+    if len(variant_codes) == 0:
+        return 0
+
+    return np.unique(np.concatenate(variant_codes)).shape[0]
+
+
+def get_correlation_shards(genes_n_snps, n_shards: int, blocks_per_shard: int = 4):
+    """
+    Splits the computation of the correlations between all pairs of genes into
+    shards. Genes (in the given order) are grouped in consecutive blocks, and
+    the pairs of blocks in the upper triangle are assigned to shards so that
+    the estimated work of each shard (the product of the number of SNPs of the
+    two blocks) is balanced. The result depends only on the arguments, so each
+    shard can be computed independently.
+
+    Args:
+        genes_n_snps:
+            A list with the number of SNPs of each gene (see get_gene_n_snps).
+        n_shards:
+            The number of shards.
+        blocks_per_shard:
+            The minimum average number of pairs of blocks per shard; more
+            blocks allow a better balance.
+
+    Returns:
+        A tuple with two elements: a list of blocks as ranges (start, end) of
+        positions in genes_n_snps, and a list (one per shard) with the pairs
+        of blocks (i, j), with i <= j, of each shard.
+    """
+    genes_n_snps = np.asarray(genes_n_snps, dtype=float)
+    n_genes = genes_n_snps.shape[0]
+
+    n_blocks = 1
+    while n_blocks < n_genes and n_blocks * (n_blocks + 1) // 2 < n_shards * blocks_per_shard:
+        n_blocks += 1
+
+    bounds = np.linspace(0, n_genes, n_blocks + 1).round().astype(int)
+    blocks = [(int(bounds[i]), int(bounds[i + 1])) for i in range(n_blocks)]
+
+    # genes without SNPs are cheap, but not free
+    blocks_n_snps = np.array([np.maximum(genes_n_snps[s:e], 1).sum() for s, e in blocks])
+
+    pairs_work = [
+        ((i, j), blocks_n_snps[i] * blocks_n_snps[j] * (0.5 if i == j else 1.0))
+        for i in range(n_blocks)
+        for j in range(i, n_blocks)
+    ]
+
+    # largest pairs first, each one to the shard with the least work so far
+    shards = [[] for _ in range(n_shards)]
+    shards_work = [(0.0, shard_idx) for shard_idx in range(n_shards)]
+    for pair, work in sorted(pairs_work, key=lambda x: (-x[1], x[0])):
+        shard_work, shard_idx = heapq.heappop(shards_work)
+        shards[shard_idx].append(pair)
+        heapq.heappush(shards_work, (shard_work + work, shard_idx))
+
+    return blocks, [sorted(pairs) for pairs in shards]
+
+
+def compute_ssm_correlations_blocks(
+    projections: list, snps_cov: np.ndarray, blocks: list, block_pairs: list, **kwargs
+) -> dict:
+    """
+    Computes the SSM correlations between the genes of some pairs of blocks
+    (see get_correlation_shards and compute_ssm_correlations, which receives
+    any other keyword argument).
+
+    Returns:
+        A dictionary with pairs of blocks (i, j) as keys and numpy arrays
+        with the correlations between genes in block i (rows) and block j
+        (columns) as values.
+    """
+    res = {}
+    for i, j in block_pairs:
+        rows = projections[blocks[i][0] : blocks[i][1]]
+        if i == j:
+            res[(i, j)] = compute_ssm_correlations(rows, snps_cov, **kwargs)
+        else:
+            cols = projections[blocks[j][0] : blocks[j][1]]
+            res[(i, j)] = compute_ssm_correlations(rows, snps_cov, other_projections=cols, **kwargs)
+
+    return res
+
+
+def merge_ssm_correlations_blocks(blocks: list, blocks_data: dict) -> np.ndarray:
+    """
+    Assembles the correlations of all pairs of blocks in the upper triangle
+    (see compute_ssm_correlations_blocks) into a square symmetric matrix. It
+    raises a ValueError exception if a pair of blocks is missing.
+    """
+    missing = [
+        (i, j) for i in range(len(blocks)) for j in range(i, len(blocks)) if (i, j) not in blocks_data
+    ]
+    if len(missing) > 0:
+        raise ValueError(f"Correlations of some pairs of gene blocks are missing: {missing}")
+
+    n_genes = blocks[-1][1] if len(blocks) > 0 else 0
+    res = np.zeros((n_genes, n_genes))
+    for (i, j), data in blocks_data.items():
+        rows, cols = slice(*blocks[i]), slice(*blocks[j])
+        res[rows, cols] = data
+        res[cols, rows] = data.T
+
+    return res
@@ -0,0 +1,124 @@
+"""
+It contains a compact set of variant IDs (such as the SNPs in a GWAS), which is
+used instead of a frozenset of strings to filter prediction weights.
+"""
+import zlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+class VariantSet(object):
+    """
+    A set of variant IDs in GTEx v8 format (such as "chr1_33071920_A_C_b38"),
+    stored as a sorted numpy array of 64-bit integer keys that encode the
+    chromosome (5 bits), the position (28 bits) and a hash of the alleles (31
+    bits). Membership of many variants is checked at once with np.searchsorted.
+
+    Instances are hashed by identity, so they are cheap arguments of methods
+    with lru_cache (unlike a frozenset with millions of strings).
+
+    Args:
+        keys:
+            A numpy array with the keys of the variants (see encode).
+        is_sorted:
+            If True, keys are already sorted and unique.
+    """
+
+    CHROMOSOMES = {str(c): c for c in range(1, 23)} | {"X": 23, "Y": 24, "M": 25, "MT": 25}
+
+    POSITION_BITS = 28
+    ALLELES_BITS = 31
+
+    def __init__(self, keys: np.ndarray, is_sorted: bool = False):
+        keys = np.asarray(keys, dtype=np.uint64)
+        self.keys = keys if is_sorted else np.unique(keys)
+
+    @staticmethod
+    def _hash(values) -> np.ndarray:
+        return np.array(
+            [zlib.crc32(v.encode("utf-8")) & ((1 << VariantSet.ALLELES_BITS) - 1) for v in values],
+            dtype=np.uint64,
+        )
+
+    @staticmethod
+    def encode(variant_ids) -> np.ndarray:
+        """
+        Returns the keys of variant IDs. IDs that do not follow the format
+        "chr{chromosome}_{position}_{alleles}" are encoded with chromosome zero
+        and a hash of the whole ID, so they never match a valid ID.
+        """
+        variant_ids = pd.Series(np.asarray(variant_ids, dtype=str), dtype=object)
+        if variant_ids.shape[0] == 0:
+            return np.array([], dtype=np.uint64)
+
+        parts = variant_ids.str.split("_", n=2, expand=True).reindex(columns=[0, 1, 2])
+        chromosomes = parts[0].str.removeprefix("chr").map(VariantSet.CHROMOSOMES)
+        positions = pd.to_numeric(parts[1], errors="coerce")
+        valid = (
+            chromosomes.notna()
+            & positions.notna()
+            & parts[2].notna()
+            & (positions >= 0)
+            & (positions < (1 << VariantSet.POSITION_BITS))
+        ).to_numpy()
+
+        # alleles are hashed once per distinct value (there are few of them)
+        alleles_codes, alleles = pd.factorize(parts[2].where(valid, ""))
+        alleles_hash = VariantSet._hash(alleles)[alleles_codes]
+
+        keys = (
+            (chromosomes.where(valid, 0).to_numpy(dtype=np.uint64) << np.uint64(VariantSet.POSITION_BITS + VariantSet.ALLELES_BITS))
+            | (positions.where(valid, 0).to_numpy(dtype=np.uint64) << np.uint64(VariantSet.ALLELES_BITS))
+            | alleles_hash
+        )
+
+        if not valid.all():
+            keys[~valid] = VariantSet._hash(variant_ids[~valid])
+
+        return keys
+
+    @staticmethod
+    def from_ids(variant_ids) -> "VariantSet":
+        """
+        Returns the set of the given variant IDs.
+        """
+        return VariantSet(VariantSet.encode(list(variant_ids)))
+
+    def __len__(self) -> int:
+        return self.keys.shape[0]
+
+    def __contains__(self, variant_id: str) -> bool:
+        return bool(self.contains([variant_id])[0])
+
+    def contains_keys(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Returns a boolean numpy array indicating which keys are in the set.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        if self.keys.shape[0] == 0:
+            return np.zeros(keys.shape[0], dtype=bool)
+
+        pos = np.minimum(np.searchsorted(self.keys, keys), self.keys.shape[0] - 1)
+        return self.keys[pos] == keys
+
+    def contains(self, variant_ids) -> np.ndarray:
+        """
+        Returns a boolean numpy array indicating which variant IDs are in the
+        set.
+        """
+        return self.contains_keys(VariantSet.encode(variant_ids))
+
+    def save(self, path: Path):
+        """
+        Saves the keys to a numpy array file.
+        """
+        np.save(path, self.keys)
+
+    @staticmethod
+    def load(path: Path) -> "VariantSet":
+        """
+        Reads a set saved with the save method.
+        """
+        return VariantSet(np.load(Path(path)), is_sorted=True)
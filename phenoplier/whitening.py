@@ -0,0 +1,495 @@
+"""
+It contains classes to whiten (decorrelate) data using a gene correlation matrix,
+which is the transformation used to fit GLS models with an OLS model.
+
+Given a correlation matrix C with Cholesky decomposition C = L L^T, data X is
+whitened as L^{-1} X. Instead of computing the inverse of L explicitly, only the
+lower-triangular factor L is kept, and whitening is done by solving the
+triangular system L W = X.
+
+Gene correlation matrices are usually block diagonal (genes in different
+chromosomes are not correlated), so they can be also represented with
+BlockDiagCorrMatrix, which is factorized and whitened block by block. If only
+genes within some distance are correlated, the matrix is also banded when
+genes are sorted by position, and BandedCholeskyWhitener can be used.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import linalg, sparse
+from scipy.linalg import lapack
+from scipy.sparse.csgraph import connected_components, reverse_cuthill_mckee
+
+
+def chol_update(chol_factor: np.ndarray, x: np.ndarray, downdate: bool = False) -> np.ndarray:
+    """
+    Computes the rank-one update (L L^T + x x^T) or downdate (L L^T - x x^T) of
+    a Cholesky decomposition in place, without factorizing the matrix again.
+
+    Args:
+        chol_factor:
+            The lower-triangular Cholesky factor (L), a square numpy array of
+            floats that is modified in place.
+        x:
+            The vector of the update (it is also modified).
+        downdate:
+            If True, the downdate is computed instead of the update. It raises
+            an exception (numpy.linalg.LinAlgError) if the result is not
+            positive definite.
+
+    Returns:
+        The updated Cholesky factor (the same array given).
+    """
+    sign = -1.0 if downdate else 1.0
+
+    for k in range(x.shape[0]):
+        l_kk = chol_factor[k, k]
+        r_sq = l_kk**2 + sign * x[k] ** 2
+        if r_sq <= 0.0:
+            raise np.linalg.LinAlgError("Downdated matrix is not positive definite")
+
+        r = np.sqrt(r_sq)
+        c = r / l_kk
+        s = x[k] / l_kk
+        chol_factor[k, k] = r
+
+        col = chol_factor[k + 1 :, k]
+        col += sign * s * x[k + 1 :]
+        col /= c
+        x[k + 1 :] *= c
+        x[k + 1 :] -= s * col
+
+    return chol_factor
+
+
+def chol_delete(chol_factor: np.ndarray, idx: np.ndarray) -> np.ndarray:
+    """
+    Given the Cholesky factor L of a matrix C, it returns the Cholesky factor of
+    C without the rows/columns in idx (positions), without factorizing the
+    submatrix again. If K are the positions kept, C[K, K] = L[K] L[K]^T, where
+    the columns of L[K] in K form a lower-triangular matrix, and each remaining
+    column (one per position deleted) is a rank-one update of it.
+
+    Returns:
+        A new array with the Cholesky factor of the submatrix.
+    """
+    size = chol_factor.shape[0]
+    delete_idx = np.unique(idx)
+    keep_mask = np.ones(size, dtype=bool)
+    keep_mask[delete_idx] = False
+    keep_idx = np.flatnonzero(keep_mask)
+
+    chol_rows = np.tril(chol_factor)[keep_idx].astype(np.float64)
+    new_chol = chol_rows[:, keep_idx]
+
+    for del_pos in delete_idx:
+        # entries of the column above the deleted position are zero
+        start = np.searchsorted(keep_idx, del_pos)
+        chol_update(new_chol[start:, start:], chol_rows[start:, del_pos].copy())
+
+    return new_chol
+
+
+class CholeskyWhitener(object):
+    """
+    Whitens data using the lower-triangular Cholesky factor of a correlation
+    matrix. Objects of this class can be used as the inverse of the Cholesky
+    factor in matrix products: 'whitener @ X' is the same as
+    'np.linalg.inv(chol_factor) @ X'.
+
+    Args:
+        chol_factor:
+            The lower-triangular Cholesky factor (L) of a correlation matrix
+            (a square numpy array). Values above the diagonal are ignored.
+    """
+
+    def __init__(self, chol_factor: np.ndarray):
+        self.chol_factor = chol_factor
+
+    @staticmethod
+    def from_corr_matrix(corr_matrix) -> "CholeskyWhitener":
+        """
+        Returns a whitener for the given correlation matrix (a numpy array or
+        pandas dataframe). It raises an exception (numpy.linalg.LinAlgError) if
+        the matrix is not positive definite.
+        """
+        return CholeskyWhitener(np.linalg.cholesky(np.asarray(corr_matrix)))
+
+    @property
+    def shape(self):
+        return self.chol_factor.shape
+
+    def whiten(self, data: np.ndarray) -> np.ndarray:
+        """
+        Returns L^{-1} data. 'data' can be a vector or a matrix with several
+        right-hand sides in columns.
+        """
+        if self.chol_factor.shape[0] == 0:
+            return np.array(data, dtype=np.float64)
+
+        return linalg.solve_triangular(
+            self.chol_factor, data, lower=True, check_finite=False
+        )
+
+    def __matmul__(self, data: np.ndarray) -> np.ndarray:
+        return self.whiten(data)
+
+    def delete(self, idx: np.ndarray) -> "CholeskyWhitener":
+        """
+        Returns a whitener for the correlation matrix without the rows/columns
+        in idx (positions), updating the Cholesky factor (see 'chol_delete').
+        """
+        if len(idx) == 0:
+            return self
+
+        return CholeskyWhitener(chol_delete(self.chol_factor, idx))
+
+    def to_inverse(self) -> np.ndarray:
+        """
+        Returns the inverse of the Cholesky factor as a dense array (used to
+        support older code and files).
+        """
+        return self.whiten(np.eye(self.chol_factor.shape[0]))
+
+    def to_corr_matrix(self) -> np.ndarray:
+        """
+        Returns the correlation matrix (L L^T) as a dense array.
+        """
+        chol_factor = np.tril(self.chol_factor)
+        return chol_factor @ chol_factor.T
+
+
+class BlockWhitener(object):
+    """
+    Whitens data using a correlation matrix that is an identity matrix except
+    for a block of rows/columns, such as the LV-specific gene correlation
+    matrices. Its Cholesky factor has the same structure, so only the rows in
+    the block are transformed and the rest are kept unchanged.
+
+    Args:
+        size:
+            Number of rows/columns of the whole correlation matrix.
+        block_idx:
+            Positions (a numpy array of integers) of the rows/columns in the
+            block.
+        block_whitener:
+            A CholeskyWhitener for the block.
+    """
+
+    def __init__(self, size: int, block_idx: np.ndarray, block_whitener: CholeskyWhitener):
+        assert block_whitener.shape[0] == block_idx.shape[0], "Block size does not match its positions"
+        self.size = size
+        self.block_idx = block_idx
+        self.block_whitener = block_whitener
+
+    @property
+    def shape(self):
+        return self.size, self.size
+
+    def whiten(self, data: np.ndarray) -> np.ndarray:
+        """
+        Returns the whitened data (a new array). 'data' can be a vector or a
+        matrix with several right-hand sides in columns.
+        """
+        assert data.shape[0] == self.size, "Data is not compatible with the whitener"
+
+        data_w = np.array(data, dtype=np.float64)
+        data_w[self.block_idx] = self.block_whitener.whiten(data_w[self.block_idx])
+        return data_w
+
+    def __matmul__(self, data: np.ndarray) -> np.ndarray:
+        return self.whiten(data)
+
+
+class BandedCholeskyWhitener(object):
+    """
+    Whitens data using the Cholesky factor of a banded correlation matrix
+    (only entries within some distance of the diagonal are nonzero), stored in
+    banded form, so the matrix is never used as a dense array. Rows and columns
+    can be reordered to reduce the bandwidth; in that case, the data is
+    reordered in the same way before whitening, which does not change the
+    results of a GLS model (whitened data only differs in an orthogonal
+    transformation).
+
+    Args:
+        chol_banded:
+            The lower-triangular Cholesky factor (L) in lower banded form (as
+            returned by scipy.linalg.cholesky_banded): L[i, j] is in
+            chol_banded[i - j, j].
+        perm:
+            Positions of the rows/columns of the correlation matrix used to
+            compute the factor (None if they were not reordered).
+    """
+
+    # number of rows of the correlation matrix processed at once when converting
+    # it to a sparse matrix
+    ROWS_CHUNK_SIZE = 1024
+
+    def __init__(self, chol_banded: np.ndarray, perm: np.ndarray = None):
+        self.chol_banded = chol_banded
+        self.perm = perm
+
+    @staticmethod
+    def to_sparse(corr_matrix) -> sparse.csr_matrix:
+        """
+        Returns a correlation matrix (a numpy array, pandas dataframe or scipy
+        sparse matrix) as a sparse matrix. Dense matrices are converted by
+        chunks of rows.
+        """
+        if sparse.issparse(corr_matrix):
+            return sparse.csr_matrix(corr_matrix)
+
+        corr_matrix = np.asarray(corr_matrix)
+        return sparse.vstack(
+            [
+                sparse.csr_matrix(corr_matrix[start : start + BandedCholeskyWhitener.ROWS_CHUNK_SIZE])
+                for start in range(0, corr_matrix.shape[0], BandedCholeskyWhitener.ROWS_CHUNK_SIZE)
+            ],
+            format="csr",
+        )
+
+    @staticmethod
+    def get_bandwidth(corr_matrix: sparse.spmatrix) -> int:
+        """
+        Returns the bandwidth of a symmetric sparse matrix: the largest distance
+        to the diagonal of a nonzero entry.
+        """
+        corr_matrix = corr_matrix.tocoo()
+        if corr_matrix.nnz == 0:
+            return 0
+        return int(np.abs(corr_matrix.row - corr_matrix.col).max())
+
+    @staticmethod
+    def from_corr_matrix(corr_matrix, reorder: bool = True) -> "BandedCholeskyWhitener":
+        """
+        Returns a whitener for the given correlation matrix (a numpy array,
+        pandas dataframe or scipy sparse matrix). If reorder is True, rows and
+        columns are reordered with the reverse Cuthill-McKee algorithm when it
+        reduces the bandwidth. It raises an exception
+        (numpy.linalg.LinAlgError) if the matrix is not positive definite.
+        """
+        corr_matrix = BandedCholeskyWhitener.to_sparse(corr_matrix)
+        bandwidth = BandedCholeskyWhitener.get_bandwidth(corr_matrix)
+
+        perm = None
+        if reorder and bandwidth > 0:
+            rcm_perm = reverse_cuthill_mckee(corr_matrix, symmetric_mode=True)
+            rcm_corr_matrix = corr_matrix[rcm_perm][:, rcm_perm]
+            rcm_bandwidth = BandedCholeskyWhitener.get_bandwidth(rcm_corr_matrix)
+
+            if rcm_bandwidth < bandwidth:
+                perm = rcm_perm
+                corr_matrix = rcm_corr_matrix
+                bandwidth = rcm_bandwidth
+
+        # lower banded form of the matrix
+        lower = sparse.tril(corr_matrix).tocoo()
+        corr_banded = np.zeros((bandwidth + 1, corr_matrix.shape[0]))
+        corr_banded[lower.row - lower.col, lower.col] = lower.data
+
+        chol_banded = linalg.cholesky_banded(corr_banded, lower=True, check_finite=False)
+        return BandedCholeskyWhitener(chol_banded, perm)
+
+    @property
+    def shape(self):
+        return self.chol_banded.shape[1], self.chol_banded.shape[1]
+
+    @property
+    def bandwidth(self) -> int:
+        return self.chol_banded.shape[0] - 1
+
+    def whiten(self, data: np.ndarray) -> np.ndarray:
+        """
+        Returns the whitened data (a new array). 'data' can be a vector or a
+        matrix with several right-hand sides in columns.
+        """
+        assert data.shape[0] == self.shape[0], "Data is not compatible with the whitener"
+
+        if self.perm is not None:
+            data = data[self.perm]
+
+        data_2d = np.array(data, dtype=np.float64).reshape(data.shape[0], -1)
+        data_w, info = lapack.dtbtrs(self.chol_banded, data_2d, uplo="L", overwrite_b=1)
+        if info != 0:
+            raise np.linalg.LinAlgError(f"Triangular solve failed (info={info})")
+
+        return data_w.reshape(data.shape)
+
+    def __matmul__(self, data: np.ndarray) -> np.ndarray:
+        return self.whiten(data)
+
+
+class BlockDiagWhitener(object):
+    """
+    Whitens data using a block-diagonal correlation matrix (see
+    BlockDiagCorrMatrix), whitening the rows of each block independently.
+
+    Args:
+        size:
+            Number of rows/columns of the whole correlation matrix.
+        blocks:
+            A list of tuples with the positions (a numpy array of integers,
+            sorted) of the rows/columns in each block and a CholeskyWhitener for
+            the block.
+    """
+
+    def __init__(self, size: int, blocks: list):
+        self.size = size
+        self.blocks = blocks
+
+    @property
+    def shape(self):
+        return self.size, self.size
+
+    def whiten(self, data: np.ndarray) -> np.ndarray:
+        """
+        Returns the whitened data (a new array). 'data' can be a vector or a
+        matrix with several right-hand sides in columns.
+        """
+        assert data.shape[0] == self.size, "Data is not compatible with the whitener"
+
+        data_w = np.array(data, dtype=np.float64)
+        for block_idx, block_whitener in self.blocks:
+            data_w[block_idx] = block_whitener.whiten(data_w[block_idx])
+        return data_w
+
+    def __matmul__(self, data: np.ndarray) -> np.ndarray:
+        return self.whiten(data)
+
+
+class BlockDiagCorrMatrix(object):
+    """
+    A gene correlation matrix that is block diagonal: genes in different blocks
+    (such as chromosomes) are not correlated. Only the blocks are stored, so
+    memory is proportional to the sum of the squared block sizes instead of the
+    squared number of genes. Genes (in 'index') are ordered block by block.
+
+    Args:
+        blocks:
+            A list of square pandas dataframes with the correlations of each
+            block (gene symbols in rows and columns). Genes can only be in one
+            block.
+    """
+
+    def __init__(self, blocks: list):
+        self.blocks = [b for b in blocks if b.shape[0] > 0]
+
+        self.index = pd.Index(
+            [g for b in self.blocks for g in b.index], dtype=object
+        )
+        assert self.index.is_unique, "Genes are in more than one block"
+
+    @staticmethod
+    def from_dataframe(corr_matrix: pd.DataFrame, gene_groups: pd.Series = None) -> "BlockDiagCorrMatrix":
+        """
+        Returns a block-diagonal version of a (dense) gene correlation matrix.
+
+        Args:
+            corr_matrix:
+                A pandas dataframe with gene correlations.
+            gene_groups:
+                A pandas series with the group (such as the chromosome) of each
+                gene in corr_matrix, so each group is a block. Correlations
+                between genes in different groups are ignored. If None, blocks
+                are the connected components of genes with nonzero
+                correlations, so the matrix is not changed.
+        """
+        genes = corr_matrix.index
+
+        if gene_groups is None:
+            _, labels = connected_components(corr_matrix.to_numpy() != 0.0, directed=False)
+        else:
+            labels = gene_groups.loc[genes].to_numpy()
+
+        # blocks sorted by their first gene in corr_matrix
+        _, first_idx, block_labels = np.unique(labels, return_index=True, return_inverse=True)
+        block_order = np.argsort(first_idx)
+
+        blocks = []
+        for block_label in block_order:
+            block_idx = np.flatnonzero(block_labels == block_label)
+            blocks.append(corr_matrix.iloc[block_idx, block_idx])
+
+        return BlockDiagCorrMatrix(blocks)
+
+    @property
+    def columns(self):
+        return self.index
+
+    @property
+    def shape(self):
+        return self.index.shape[0], self.index.shape[0]
+
+    def subset(self, genes) -> "BlockDiagCorrMatrix":
+        """
+        Returns the correlation matrix of the given genes (that must be in this
+        matrix). Genes are kept in the order of this matrix.
+        """
+        genes = pd.Index(genes)
+        assert genes.isin(self.index).all(), "Some genes are not in the correlation matrix"
+
+        blocks = []
+        for block in self.blocks:
+            block_genes = block.index[block.index.isin(genes)]
+            blocks.append(block.loc[block_genes, block_genes])
+
+        return BlockDiagCorrMatrix(blocks)
+
+    def to_dataframe(self, genes: pd.Index = None) -> pd.DataFrame:
+        """
+        Returns the correlation matrix as a dense pandas dataframe, with genes
+        in the given order (all genes in this matrix) or in the order of this
+        matrix.
+        """
+        if genes is None:
+            genes = self.index
+        genes = pd.Index(genes)
+        assert genes.shape == self.index.shape, "Genes are not the same as in the correlation matrix"
+
+        data = np.zeros(self.shape)
+        for block in self.blocks:
+            block_idx = genes.get_indexer(block.index)
+            assert (block_idx >= 0).all(), "Genes are not the same as in the correlation matrix"
+            data[np.ix_(block_idx, block_idx)] = block.to_numpy()
+
+        return pd.DataFrame(data, index=genes.copy(), columns=genes.copy())
+
+    def whitener(self, n_jobs: int = 1, banded: bool = False) -> BlockDiagWhitener:
+        """
+        Returns a whitener for this matrix, factorizing each block
+        independently (in n_jobs threads), with a dense or banded
+        (BandedCholeskyWhitener) Cholesky decomposition. It raises an exception
+        (numpy.linalg.LinAlgError) if a block is not positive definite.
+        """
+        block_factorize = CholeskyWhitener.from_corr_matrix
+        if banded:
+            block_factorize = BandedCholeskyWhitener.from_corr_matrix
+
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            blocks_whiteners = list(executor.map(block_factorize, self.blocks))
+
+        blocks = []
+        start = 0
+        for block_whitener in blocks_whiteners:
+            end = start + block_whitener.shape[0]
+            blocks.append((np.arange(start, end), block_whitener))
+            start = end
+
+        return BlockDiagWhitener(self.shape[0], blocks)
+
+
+def get_whitener(corr_matrix, n_jobs: int = 1, banded: bool = False):
+    """
+    Returns a whitener for a correlation matrix, which can be a numpy array, a
+    pandas dataframe (CholeskyWhitener, or BandedCholeskyWhitener if banded is
+    True) or a BlockDiagCorrMatrix (BlockDiagWhitener, with blocks factorized
+    in n_jobs threads).
+    """
+    if isinstance(corr_matrix, BlockDiagCorrMatrix):
+        return corr_matrix.whitener(n_jobs, banded)
+
+    if banded:
+        return BandedCholeskyWhitener.from_corr_matrix(corr_matrix)
+
+    return CholeskyWhitener.from_corr_matrix(corr_matrix)
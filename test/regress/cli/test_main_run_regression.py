@@ -3584,3 +3584,93 @@ def test_gls_cli_use_covar_debug_use_ols_vs_gls(output_file):
         results_gls["pvalue"].to_numpy(),
         results_ols["pvalue"].to_numpy(),
     )
+
+
+def _run_regression(input_file, output_file, *args):
+    return runner.invoke(
+        cli.app,
+        [
+            "run",
+            "regression",
+            "-i",
+            str(input_file),
+            "-o",
+            str(output_file),
+            "-f",
+            str(DATA_DIR / "sample-lv-model.pkl"),
+            "-g",
+            str(DATA_DIR / "sample-gene_corrs-gtex_v8-mashr.pkl"),
+            "--covars",
+            "gene_size gene_density",
+            *args,
+        ],
+    )
+
+
+@pytest.mark.parametrize("input_type", ["dir", "manifest"])
+def test_gls_cli_multiple_traits(tmp_path, monkeypatch, input_type):
+    from phenoplier.commands.run import regression as regression_module
+
+    # traits are fitted in several chunks
+    monkeypatch.setattr(regression_module, "N_TRAITS_PER_CHUNK", 2)
+
+    traits_dir = tmp_path / "traits"
+    traits_dir.mkdir()
+    rs = np.random.RandomState(0)
+    data = pd.read_csv(DATA_DIR / "random.pheno0-smultixcan-full.txt", sep="\t")
+    traits_files = {}
+    for trait_name, filename in [
+        ("trait0", "trait0.tsv"), ("trait1", "trait1.tsv"), ("trait2", "trait2.tsv"), ("trait3", "trait3.tsv.gz")
+    ]:
+        trait_data = data.assign(pvalue=rs.permutation(data["pvalue"].to_numpy()))
+        if trait_name == "trait1":
+            # other genes
+            trait_data.loc[::4, "pvalue"] = np.nan
+        trait_data.to_csv(traits_dir / filename, sep="\t", index=False)
+        traits_files[trait_name] = traits_dir / filename
+    # a trait that cannot be used is skipped, and other files in the directory are ignored
+    data.drop(columns=["gene_name"]).to_csv(traits_dir / "bad.tsv", sep="\t", index=False)
+    data.to_csv(traits_dir / "other.txt", sep="\t", index=False)
+
+    if input_type == "dir":
+        input_file = traits_dir
+    else:
+        input_file = tmp_path / "traits.list"
+        input_file.write_text(
+            "\n".join(f"traits/{f}" for f in ("trait0.tsv", "bad.tsv", "trait1.tsv", "trait2.tsv", "trait3.tsv.gz"))
+            + "\n\n"
+        )
+
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    # traits with an existing output file are skipped
+    (output_dir / "gls_phenoplier-trait2.tsv.gz").touch()
+
+    r = _run_regression(input_file, output_dir)
+    assert r.exit_code == 0, r.stdout
+    r_output = r.stdout.replace(os.linesep, "")
+    assert "4 traits to process" in r_output
+    assert err.NO_GENE_NAME_COLUMN in r_output
+
+    # one output file per trait
+    assert sorted(f.name for f in output_dir.iterdir()) == [
+        f"gls_phenoplier-{trait_name}.tsv.gz" for trait_name in ("trait0", "trait1", "trait2", "trait3")
+    ]
+    assert (output_dir / "gls_phenoplier-trait2.tsv.gz").stat().st_size == 0
+
+    # results are the same as fitting each trait alone
+    for trait_name in ("trait0", "trait1", "trait3"):
+        single_output_file = tmp_path / f"{trait_name}-single.tsv"
+        r = _run_regression(traits_files[trait_name], single_output_file)
+        assert r.exit_code == 0, r.stdout
+
+        expected = pd.read_csv(single_output_file, sep="\t")
+        observed = pd.read_csv(output_dir / f"gls_phenoplier-{trait_name}.tsv.gz", sep="\t")
+        assert expected.shape[0] > 0
+        assert not observed.isna().any().any()
+        pd.testing.assert_frame_equal(observed, expected, check_exact=False, rtol=1e-8)
+
+    # nothing to do the second time
+    r = _run_regression(input_file, output_dir)
+    assert r.exit_code == 0, r.stdout
+    assert "0 traits to process" in r.stdout.replace(os.linesep, "")
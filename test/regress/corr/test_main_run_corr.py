@@ -16,6 +16,7 @@ _BASE_COMMAND_NAME = "run gene-corr"
     ([f"{_BASE_COMMAND_NAME} correlate --help", f"{_BASE_COMMAND_NAME} correlate -h"], ""),
     ([f"{_BASE_COMMAND_NAME} postprocess --help", f"{_BASE_COMMAND_NAME} postprocess -h"], ""),
     ([f"{_BASE_COMMAND_NAME} generate --help", f"{_BASE_COMMAND_NAME} generate -h"], ""),
+    ([f"{_BASE_COMMAND_NAME} convert --help", f"{_BASE_COMMAND_NAME} convert -h"], ""),
 ])
 def test_options(options, expected_output):
     """Check that the help message is displayed when the help flag is passed."""
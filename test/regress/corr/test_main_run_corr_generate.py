@@ -4,12 +4,14 @@ import random
 import zipfile
 from pathlib import Path
 
+import numpy as np
 from typer.testing import CliRunner
 from pytest import mark
 from phenoplier import cli
+from phenoplier.gls import GLSPhenoplier
 from phenoplier.commands.invoker import invoke_corr_generate
 from phenoplier.config import settings as conf
-from test.utils import get_test_output_dir, compare_npz_files_in_dirs
+from test.utils import get_test_output_dir
 
 logger = logging.getLogger(__name__)
 
@@ -84,7 +86,14 @@ def test_cli_command(cohort, reference_panel, eqtl_model, lv_code, lv_percentile
         ref_output = (temp_extract_dir / filename).with_suffix(".per_lv")
         # Assert the output file exists
         assert test_output.exists(), f"Output directory {test_output} does not exist"
-        files = ("gene_names.npz", f"LV{lv_code}_corr_mat.npz", f"LV{lv_code}.npz")
+        # reference files are in the old format (sparse matrices in .npz files)
         logger.info(f"Comparing {test_output} and {ref_output}...")
-        success, message = compare_npz_files_in_dirs(test_output, ref_output, include_files=files)
-        assert success, message
+        assert np.array_equal(
+            GLSPhenoplier.load_chol_inv_data(test_output, "gene_names"),
+            GLSPhenoplier.load_chol_inv_data(ref_output, "gene_names"),
+        )
+        for base_filename in (f"LV{lv_code}_corr_mat", f"LV{lv_code}"):
+            assert np.allclose(
+                GLSPhenoplier.load_chol_inv_data(test_output, base_filename),
+                GLSPhenoplier.load_chol_inv_data(ref_output, base_filename),
+            ), f"{base_filename} is different"
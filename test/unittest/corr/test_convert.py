@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from phenoplier import cli
+from phenoplier.gls import GLSPhenoplier
+from phenoplier.commands.invoker import invoke_corr_convert
+from phenoplier.commands.run.correlation.generate import compute_chol_inv, store_df, store_block
+
+
+N_GENES = 200
+LV_CODES = ["LV1", "LV2", "LV3"]
+
+
+def _store_old_format(output_dir, nparray, base_filename):
+    # how LV-specific matrices were stored by older versions of 'generate'
+    if base_filename in ("metadata", "gene_names"):
+        np.savez_compressed(output_dir / (base_filename + ".npz"), data=nparray)
+    else:
+        sparse.save_npz(output_dir / (base_filename + ".npz"), sparse.csc_matrix(nparray), compressed=False)
+
+
+@pytest.fixture()
+def lv_corrs_dirs(tmp_path):
+    rs = np.random.RandomState(0)
+
+    genes = [f"GENE{i}" for i in range(N_GENES)]
+    gene_corrs = pd.DataFrame(rs.normal(size=(N_GENES * 3, N_GENES)), columns=genes).corr()
+    lv_weights = pd.DataFrame(rs.rand(N_GENES, len(LV_CODES)), index=genes, columns=LV_CODES)
+
+    # current format
+    for lv_code in LV_CODES:
+        compute_chol_inv(lv_code, {"gene_corrs.pkl": gene_corrs}, lv_weights, tmp_path, "1000g", "mashr", 0.05)
+    new_dir = tmp_path / "gene_corrs.per_lv"
+
+    # old format
+    old_dir = tmp_path / "old"
+    old_dir.mkdir()
+    _store_old_format(old_dir, np.array(["1000g", "mashr"]), "metadata")
+    _store_old_format(old_dir, np.array(genes), "gene_names")
+    for lv_code in LV_CODES:
+        corr_mat_sub = GLSPhenoplier.get_sub_mat(gene_corrs, lv_weights[lv_code], 0.05)
+        _store_old_format(old_dir, corr_mat_sub.to_numpy(), f"{lv_code}_corr_mat")
+        _store_old_format(old_dir, np.linalg.inv(np.linalg.cholesky(corr_mat_sub)), lv_code)
+
+    lv_weights.to_pickle(tmp_path / "lv_weights.pkl")
+
+    return old_dir, new_dir
+
+
+def test_load_chol_inv_data_old_and_new_formats(lv_corrs_dirs):
+    old_dir, new_dir = lv_corrs_dirs
+
+    for base_filename in ("metadata", "gene_names"):
+        assert np.array_equal(
+            GLSPhenoplier.load_chol_inv_data(old_dir, base_filename),
+            GLSPhenoplier.load_chol_inv_data(new_dir, base_filename),
+        )
+
+    for lv_code in LV_CODES:
+        for base_filename in (lv_code, f"{lv_code}_corr_mat"):
+            old_data = GLSPhenoplier.load_chol_inv_data(old_dir, base_filename)
+            new_data = GLSPhenoplier.load_chol_inv_data(new_dir, base_filename)
+            assert new_data.shape == (N_GENES, N_GENES)
+            assert np.allclose(old_data, new_data, rtol=0.0, atol=1e-10)
+
+            # the block has the LV genes only
+            block, block_idx = GLSPhenoplier.load_chol_inv_block(new_dir, base_filename)
+            assert block.shape == (block_idx.shape[0], block_idx.shape[0])
+            assert 1 < block_idx.shape[0] < N_GENES
+            assert np.array_equal(block, new_data[np.ix_(block_idx, block_idx)])
+
+
+def test_load_chol_inv_block_old_format(lv_corrs_dirs):
+    old_dir, new_dir = lv_corrs_dirs
+
+    for lv_code in LV_CODES:
+        old_block, old_block_idx = GLSPhenoplier.load_chol_inv_block(old_dir, lv_code)
+        new_block, new_block_idx = GLSPhenoplier.load_chol_inv_block(new_dir, lv_code)
+
+        assert np.array_equal(old_block_idx, new_block_idx)
+        assert np.allclose(old_block, new_block, rtol=0.0, atol=1e-10)
+
+
+@pytest.mark.parametrize("remove_old_files", [False, True])
+def test_convert(lv_corrs_dirs, tmp_path, remove_old_files):
+    old_dir, new_dir = lv_corrs_dirs
+    output_dir = tmp_path / "converted"
+
+    suc, msg = invoke_corr_convert(old_dir, output_dir, remove_old_files)
+    assert suc, msg
+
+    assert not list(output_dir.glob("*.npz"))
+    assert (len(list(old_dir.glob("*.npz"))) == 0) == remove_old_files
+
+    for base_filename in ("metadata", "gene_names"):
+        assert np.array_equal(
+            np.load(output_dir / (base_filename + ".npy")),
+            np.load(new_dir / (base_filename + ".npy")),
+        )
+
+    for lv_code in LV_CODES:
+        for base_filename in (lv_code, f"{lv_code}_corr_mat"):
+            block, block_idx = GLSPhenoplier.load_chol_inv_block(output_dir, base_filename)
+            exp_block, exp_block_idx = GLSPhenoplier.load_chol_inv_block(new_dir, base_filename)
+
+            assert np.array_equal(block_idx, exp_block_idx)
+            assert np.allclose(block, exp_block, rtol=0.0, atol=1e-10)
+
+
+def test_load_chol_block_old_and_new_formats(lv_corrs_dirs):
+    old_dir, new_dir = lv_corrs_dirs
+
+    # only the Cholesky factor is stored in the current format
+    assert not (new_dir / f"{LV_CODES[0]}.npy").exists()
+    assert not (new_dir / f"{LV_CODES[0]}_corr_mat.npy").exists()
+
+    for lv_code in LV_CODES:
+        old_chol, old_block_idx = GLSPhenoplier.load_chol_block(old_dir, lv_code)
+        new_chol, new_block_idx = GLSPhenoplier.load_chol_block(new_dir, lv_code)
+
+        assert np.array_equal(old_block_idx, new_block_idx)
+        assert np.allclose(old_chol, new_chol, rtol=0.0, atol=1e-10)
+        assert np.array_equal(new_chol, np.tril(new_chol))
+
+
+def test_convert_in_place(lv_corrs_dirs):
+    old_dir, _ = lv_corrs_dirs
+    expected = GLSPhenoplier.load_chol_inv_data(old_dir, LV_CODES[0])
+
+    suc, msg = invoke_corr_convert(old_dir)
+    assert suc, msg
+
+    # new files are used when both formats are present: old files are
+    # corrupted, so they cannot be read
+    assert (old_dir / f"{LV_CODES[0]}_chol.npy").exists()
+    for old_file in old_dir.glob("*.npz"):
+        old_file.write_bytes(b"corrupted")
+
+    assert np.allclose(GLSPhenoplier.load_chol_inv_data(old_dir, LV_CODES[0]), expected, rtol=0.0, atol=1e-10)
+    block, block_idx = GLSPhenoplier.load_chol_inv_block(old_dir, LV_CODES[0])
+    assert np.allclose(block, expected[np.ix_(block_idx, block_idx)], rtol=0.0, atol=1e-10)
+
+
+def test_convert_dense_blocks(lv_corrs_dirs, tmp_path):
+    old_dir, new_dir = lv_corrs_dirs
+
+    # format with dense blocks of the correlation matrix and the inverse of its
+    # Cholesky factor
+    blocks_dir = tmp_path / "blocks"
+    blocks_dir.mkdir()
+    for base_filename in ("metadata", "gene_names"):
+        store_df(blocks_dir, np.load(new_dir / (base_filename + ".npy")), base_filename)
+    for lv_code in LV_CODES:
+        for base_filename in (lv_code, f"{lv_code}_corr_mat"):
+            block, block_idx = GLSPhenoplier.load_chol_inv_block(old_dir, base_filename)
+            store_block(blocks_dir, block, block_idx, base_filename)
+
+    suc, msg = invoke_corr_convert(blocks_dir, remove_old_files=True)
+    assert suc, msg
+
+    assert sorted(f.name for f in blocks_dir.iterdir()) == sorted(f.name for f in new_dir.iterdir())
+    for lv_code in LV_CODES:
+        chol, block_idx = GLSPhenoplier.load_chol_block(blocks_dir, lv_code)
+        exp_chol, exp_block_idx = GLSPhenoplier.load_chol_block(new_dir, lv_code)
+
+        assert np.array_equal(block_idx, exp_block_idx)
+        assert np.allclose(chol, exp_chol, rtol=0.0, atol=1e-10)
+
+
+@pytest.mark.parametrize("all_genes", [True, False])
+def test_gls_old_and_new_formats(lv_corrs_dirs, all_genes):
+    old_dir, new_dir = lv_corrs_dirs
+    lv_weights_file = old_dir.parent / "lv_weights.pkl"
+
+    rs = np.random.RandomState(1)
+    phenotype = pd.Series(rs.normal(size=N_GENES), index=[f"GENE{i}" for i in range(N_GENES)])
+    if not all_genes:
+        phenotype = phenotype.iloc[::3]
+
+    results = [
+        GLSPhenoplier(
+            gene_corrs_file_path=gene_corrs_dir,
+            debug_use_sub_gene_corr=True,
+            use_own_implementation=True,
+            logger=None,
+        ).fit_named_batch(LV_CODES, phenotype, lv_weights_file)
+        for gene_corrs_dir in (old_dir, new_dir)
+    ]
+    pd.testing.assert_frame_equal(results[0], results[1])
@@ -1,8 +1,18 @@
 import pytest
 import numpy as np
 import pandas as pd
+import fastparquet
 
-from phenoplier.commands.run.correlation.cov import covariance, compute_snps_cov
+from phenoplier.commands.run.correlation.cov import (
+    CovarianceAccumulator,
+    covariance,
+    compute_snps_cov,
+    compute_snps_cov_ld_blocks,
+    compute_chr_cov_shard,
+    append_chr_cov_shard,
+    get_chromosomes_by_size,
+    read_ld_regions,
+)
 
 
 @pytest.fixture
@@ -54,3 +64,105 @@ def test_covariance_constant_values(generate_test_data):
     expected = constant_df.cov()
     pd.testing.assert_frame_equal(result, expected, rtol=1e-10, atol=1e-10)
 
+
+
+@pytest.mark.parametrize("dtype, rtol, batch_size", [
+    (np.float64, 1e-10, 1),
+    (np.float64, 1e-10, 7),
+    (np.float32, 1e-5, 7),
+    (np.float64, 1e-10, 1000),
+])
+def test_covariance_batches(generate_test_data, monkeypatch, dtype, rtol, batch_size):
+    # shifted data, to check the accumulation is numerically stable
+    test_data = generate_test_data((100, 10), 7) + 1000
+    # blocks of rows smaller than the matrix
+    monkeypatch.setattr(CovarianceAccumulator, "BLOCK_SIZE", 3)
+    result = covariance(test_data, dtype, batch_size)
+
+    assert result.to_numpy().dtype == dtype
+    pd.testing.assert_frame_equal(result, test_data.cov(), rtol=rtol, atol=rtol, check_dtype=False)
+
+
+def test_compute_snps_cov_row_groups(generate_test_data, tmp_path):
+    genotypes = generate_test_data((60, 6), 8).round().abs()
+    genotypes.columns = [f"chr22_{i}_A_C_b38" for i in range(genotypes.shape[1])]
+    fastparquet.write(tmp_path / "panel.chr22.variants.parquet", genotypes, row_group_offsets=25)
+
+    snps_df = pd.DataFrame({"varID": genotypes.columns.tolist() + ["chr22_999_A_C_b38"], "chr": 22})
+    variants_ids_with_genotype = set(genotypes.columns[1:])
+    result = compute_snps_cov(snps_df, tmp_path, variants_ids_with_genotype, np.float64, batch_size=10)
+
+    assert sorted(result.index) == sorted(variants_ids_with_genotype)
+    expected = genotypes.cov().loc[result.index, result.columns]
+    pd.testing.assert_frame_equal(result, expected, rtol=1e-10, atol=1e-10)
+
+
+def test_compute_snps_cov_ld_blocks(generate_test_data, tmp_path):
+    genotypes = generate_test_data((60, 8), 9).round().abs()
+    positions = [100, 150, 1000, 1001, 5000, 20000, 20001, 30000]
+    genotypes.columns = [f"chr22_{p}_A_C_b38" for p in positions]
+    fastparquet.write(tmp_path / "panel.chr22.variants.parquet", genotypes, row_group_offsets=25)
+
+    ld_regions_file = tmp_path / "ld_regions.bed"
+    ld_regions_file.write_text(
+        "chr\tstart\tstop\nchr22\t999\t19000\nchr22\t0\t999\nchr22\t19000\t25000\nchr1\t0\t2000\nchrX\t0\t10\n"
+    )
+    ld_regions = read_ld_regions(ld_regions_file)
+    assert ld_regions.values.tolist() == [[1, 0, 2000], [22, 0, 999], [22, 999, 19000], [22, 19000, 25000]]
+
+    snps_df = pd.DataFrame({"varID": genotypes.columns, "chr": 22, "position": positions})
+    snps_blocks, blocks_cov = compute_snps_cov_ld_blocks(
+        snps_df, tmp_path, set(genotypes.columns), np.float64, ld_regions, batch_size=10
+    )
+
+    # SNPs after the last region are assigned to it
+    assert snps_blocks["block"].tolist() == [0, 0, 1, 1, 1, 2, 2, 2]
+    assert snps_blocks.index.tolist() == genotypes.columns.tolist()
+
+    expected = np.concatenate([
+        genotypes.iloc[:, block].cov().to_numpy().ravel() for block in (slice(0, 2), slice(2, 5), slice(5, 8))
+    ])
+    assert np.allclose(blocks_cov, expected, rtol=1e-10, atol=1e-10)
+
+
+def test_compute_chr_cov_shard(generate_test_data, tmp_path):
+    genotypes = generate_test_data((30, 4), 10).round().abs()
+    genotypes.columns = [f"chr21_{p}_A_C_b38" for p in (10, 20, 30, 40)]
+    fastparquet.write(tmp_path / "panel.chr21.variants.parquet", genotypes)
+    snps_df = pd.DataFrame({"varID": genotypes.columns, "chr": 21, "position": [10, 20, 30, 40]})
+
+    shard_file = compute_chr_cov_shard(
+        snps_df, tmp_path, set(genotypes.columns), np.float64, 10, None, tmp_path / "chr21.h5"
+    )
+    assert shard_file == tmp_path / "chr21.h5"
+    assert not list(tmp_path.glob("*.tmp"))
+
+    with pd.HDFStore(shard_file, mode="r") as store:
+        assert store.keys() == ["/chr21"]
+        snps_cov = store["chr21"]
+    pd.testing.assert_frame_equal(
+        snps_cov.loc[genotypes.columns, genotypes.columns], genotypes.cov(), rtol=1e-10, atol=1e-10
+    )
+
+    # the shard is appended to the output file, after the data already there
+    output_file = tmp_path / "output.h5"
+    with pd.HDFStore(output_file, mode="w", complevel=4) as store:
+        store["metadata"] = snps_df
+    append_chr_cov_shard(output_file, shard_file)
+    assert not shard_file.exists()
+
+    with pd.HDFStore(output_file, mode="r") as store:
+        assert sorted(store.keys()) == ["/chr21", "/metadata"]
+        pd.testing.assert_frame_equal(store["chr21"], snps_cov)
+        pd.testing.assert_frame_equal(store["metadata"], snps_df)
+
+
+def test_get_chromosomes_by_size():
+    variants_df = pd.DataFrame({
+        "varID": ["chr1_1_A_C_b38", "chr2_1_A_C_b38", "chr2_2_A_C_b38", "chr2_3_A_C_b38", "chr3_1_A_C_b38",
+                  "chr3_2_A_C_b38", "chr4_1_A_C_b38"],
+        "chr": [1, 2, 2, 2, 3, 3, 4],
+    })
+    # chr2_3 and chr4 have no genotypes
+    with_genotype = set(variants_df["varID"]) - {"chr2_3_A_C_b38", "chr4_1_A_C_b38"}
+    assert get_chromosomes_by_size(variants_df, with_genotype) == [2, 3, 1, 4]
@@ -0,0 +1,237 @@
+import json
+
+import numpy as np
+import pytest
+
+from phenoplier import cli
+from phenoplier.commands.run.correlation import pipeline as pipeline_module
+from phenoplier.commands.run.correlation.generate import get_output_dir, get_gene_corrs_input_file
+from phenoplier.commands.run.correlation.pipeline import (
+    CHROMOSOMES,
+    MANIFEST_FILENAME,
+    pipeline,
+    get_n_workers,
+    get_inputs_hash,
+    load_checkpoint,
+)
+
+
+# Fake stages: they write their outputs and log their calls to a file (correlate runs in worker processes)
+def _log_call(output_dir, stage):
+    with open(output_dir / "calls.txt", "a") as f:
+        f.write(f"{stage}\n")
+
+
+def fake_preprocess(output_dir, **kwargs):
+    _log_call(output_dir, "preprocess")
+    for filename in ("gene_tissues.pkl", "genes_info.pkl"):
+        (output_dir / filename).write_text("preprocess")
+    return True, "ok"
+
+
+def fake_correlate(chromosome, output_dir, **kwargs):
+    _log_call(output_dir, f"correlate-chr{chromosome}")
+    if (output_dir / f"fail-chr{chromosome}").exists():
+        return False, "failed"
+    (output_dir / "by_chr").mkdir(exist_ok=True)
+    (output_dir / "by_chr" / f"gene_corrs-chr{chromosome}.pkl").write_text("correlate")
+    return True, "ok"
+
+
+def fake_postprocess(output_dir, **kwargs):
+    _log_call(output_dir, "postprocess")
+    (output_dir / "gene_corrs-symbols.pkl").write_text("postprocess")
+    _write_fake_store(output_dir / "gene_corrs-symbols.gene_corrs")
+    return True, "ok"
+
+
+def _write_fake_store(path):
+    path.mkdir(exist_ok=True)
+    np.save(path / "blocks.npy", np.zeros(1))
+
+
+def fake_filter(distances, genes_symbols, output_dir, **kwargs):
+    _log_call(output_dir, f"filter-{int(distances[0])}mb")
+    assert genes_symbols.name == "gene_corrs-symbols.gene_corrs"
+    # the pickle file and the store, as the real command
+    (output_dir / f"gene_corrs-symbols-within_distance_{int(distances[0])}mb.pkl.gz").write_text("filter")
+    _write_fake_store(output_dir / f"gene_corrs-symbols-within_distance_{int(distances[0])}mb.gene_corrs")
+    return True, "ok"
+
+
+def fake_generate(lv_code, genes_symbols_dir, output_dir, **kwargs):
+    _log_call(output_dir, f"generate-LV{lv_code}")
+    # same files and output folders as the real command (see load_gene_corrs_dict)
+    for f in genes_symbols_dir.glob("gene_corrs-symbols*.pkl.gz"):
+        assert get_gene_corrs_input_file(f).suffix == ".gene_corrs"
+        get_output_dir(f.name, output_dir).mkdir(exist_ok=True)
+    return True, "ok"
+
+
+@pytest.fixture
+def pipeline_args(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline_module, "invoke_corr_preprocess", fake_preprocess)
+    monkeypatch.setattr(pipeline_module, "invoke_corr_correlate", fake_correlate)
+    monkeypatch.setattr(pipeline_module, "invoke_corr_postprocess", fake_postprocess)
+    monkeypatch.setattr(pipeline_module, "invoke_corr_filter", fake_filter)
+    monkeypatch.setattr(pipeline_module, "invoke_corr_generate", fake_generate)
+
+    gwas_file = tmp_path / "gwas.txt.gz"
+    gwas_file.write_text("gwas")
+    spredixcan_folder = tmp_path / "spredixcan"
+    spredixcan_folder.mkdir()
+    (spredixcan_folder / "trait-Whole_Blood.csv").write_text("spredixcan")
+    smultixcan_file = tmp_path / "smultixcan.txt"
+    smultixcan_file.write_text("smultixcan")
+
+    output_dir = tmp_path / "output"
+
+    return dict(
+        cohort="1000g_eur",
+        reference_panel="1000G",
+        eqtl_model="MASHR",
+        gwas_file=gwas_file,
+        spredixcan_folder=spredixcan_folder,
+        spredixcan_file_pattern="trait-{tissue}.csv",
+        smultixcan_file=smultixcan_file,
+        n_jobs=4,
+        distances=[5, 2],
+        lv_codes=[1, 2],
+        output_dir=output_dir,
+    )
+
+
+def _pop_calls(output_dir):
+    calls_file = output_dir / "calls.txt"
+    if not calls_file.exists():
+        return []
+    calls = calls_file.read_text().split()
+    calls_file.unlink()
+    return sorted(calls)
+
+
+ALL_STAGES = sorted(
+    ["preprocess", "postprocess", "filter-5mb", "filter-2mb", "generate-LV1", "generate-LV2"]
+    + [f"correlate-chr{c}" for c in CHROMOSOMES]
+)
+
+
+def test_pipeline_runs_all_stages_and_resumes(pipeline_args):
+    output_dir = pipeline_args["output_dir"]
+
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == ALL_STAGES
+
+    manifest = json.loads((output_dir / MANIFEST_FILENAME).read_text())
+    assert sorted(manifest["stages"].keys()) == ALL_STAGES
+    assert manifest["stages"]["correlate-chr3"]["outputs"] == [str(output_dir / "by_chr" / "gene_corrs-chr3.pkl")]
+
+    # nothing changed, so all stages are skipped
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == []
+
+    # an output was removed: the stage and the ones depending on it are run again
+    (output_dir / "by_chr" / "gene_corrs-chr5.pkl").unlink()
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == sorted(
+        ["correlate-chr5", "postprocess", "filter-5mb", "filter-2mb", "generate-LV1", "generate-LV2"]
+    )
+
+    # a parameter changed
+    pipeline(**dict(pipeline_args, distances=[5, 2, 10]))
+    assert _pop_calls(output_dir) == ["filter-10mb", "generate-LV1", "generate-LV2"]
+
+    # restart ignores the manifest
+    pipeline(**dict(pipeline_args, restart=True))
+    assert _pop_calls(output_dir) == ALL_STAGES
+
+
+def test_pipeline_generate_is_resumed(pipeline_args):
+    output_dir = pipeline_args["output_dir"]
+
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == ALL_STAGES
+
+    # outputs are the folders written by generate, and inputs the stores written by filter
+    manifest = load_checkpoint(output_dir / MANIFEST_FILENAME)
+    assert manifest["stages"]["filter-5mb"]["outputs"] == [
+        str(output_dir / "gene_corrs-symbols-within_distance_5mb.pkl.gz"),
+        str(output_dir / "gene_corrs-symbols-within_distance_5mb.gene_corrs"),
+    ]
+    assert manifest["stages"]["generate-LV1"]["outputs"] == [
+        str(output_dir / "gene_corrs-symbols-within_distance_5mb.pkl.per_lv"),
+        str(output_dir / "gene_corrs-symbols-within_distance_2mb.pkl.per_lv"),
+    ]
+
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == []
+
+    # a store written by filter changed
+    np.save(output_dir / "gene_corrs-symbols-within_distance_2mb.gene_corrs" / "blocks.npy", np.zeros(2))
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == ["generate-LV1", "generate-LV2"]
+
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == []
+
+
+def test_pipeline_input_file_changed(pipeline_args):
+    output_dir = pipeline_args["output_dir"]
+    pipeline(**dict(pipeline_args, lv_codes=None))
+    assert "generate-LV1" not in _pop_calls(output_dir)
+
+    pipeline_args["smultixcan_file"].write_text("smultixcan, new version")
+    pipeline(**dict(pipeline_args, lv_codes=None))
+    assert _pop_calls(output_dir) == sorted(set(ALL_STAGES) - {"generate-LV1", "generate-LV2"})
+
+
+def test_pipeline_correlate_failure_is_resumed(pipeline_args):
+    output_dir = pipeline_args["output_dir"]
+    output_dir.mkdir()
+    (output_dir / "fail-chr7").touch()
+
+    with pytest.raises(SystemExit):
+        pipeline(**pipeline_args)
+    # other chromosomes are completed and recorded
+    calls = _pop_calls(output_dir)
+    assert calls == sorted(["preprocess"] + [f"correlate-chr{c}" for c in CHROMOSOMES])
+    manifest = load_checkpoint(output_dir / MANIFEST_FILENAME)
+    assert "correlate-chr7" not in manifest["stages"]
+    assert "correlate-chr8" in manifest["stages"]
+
+    (output_dir / "fail-chr7").unlink()
+    pipeline(**pipeline_args)
+    assert _pop_calls(output_dir) == sorted(
+        ["correlate-chr7", "postprocess", "filter-5mb", "filter-2mb", "generate-LV1", "generate-LV2"]
+    )
+
+
+def test_load_checkpoint_corrupted_file(tmp_path):
+    assert load_checkpoint(tmp_path / "nonexistent.json") == {"stages": {}}
+
+    manifest_file = tmp_path / MANIFEST_FILENAME
+    manifest_file.write_text('{"stages": {"preproc')
+    assert load_checkpoint(manifest_file) == {"stages": {}}
+
+
+def test_get_inputs_hash(tmp_path):
+    input_file = tmp_path / "input.txt"
+    input_file.write_text("data")
+
+    h = get_inputs_hash({"chromosome": 1}, [input_file])
+    assert get_inputs_hash({"chromosome": 1}, [input_file]) == h
+    assert get_inputs_hash({"chromosome": 2}, [input_file]) != h
+
+    input_file.write_text("new data")
+    assert get_inputs_hash({"chromosome": 1}, [input_file]) != h
+
+
+def test_get_n_workers(monkeypatch):
+    assert get_n_workers(22, n_jobs=4) == 4
+    assert get_n_workers(2, n_jobs=4) == 2
+
+    # limited by the available memory
+    monkeypatch.setattr(pipeline_module, "get_available_memory", lambda: 10 * 1024**3)
+    assert get_n_workers(22, memory_per_job=4.0) == min(2, get_n_workers(22, memory_per_job=0))
+    monkeypatch.setattr(pipeline_module, "get_available_memory", lambda: 1024**3)
+    assert get_n_workers(22, memory_per_job=4.0) == 1
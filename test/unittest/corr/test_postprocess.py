@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from phenoplier import cli
+from phenoplier.entity import Gene
+from phenoplier.gene_corrs_store import GeneCorrsStore
+from phenoplier.commands.util.enums import Cohort
+from phenoplier.commands.run.correlation.postprocess import postprocess
+from phenoplier.whitening import BlockDiagCorrMatrix
+
+
+def _random_corr(n_genes, seed):
+    rs = np.random.RandomState(seed)
+    return np.corrcoef(rs.normal(size=(n_genes, n_genes * 3)))
+
+
+@pytest.fixture
+def gene_corrs_by_chr(tmp_path, monkeypatch):
+    by_chr_dir = tmp_path / "by_chr"
+    by_chr_dir.mkdir()
+
+    genes_info = []
+    expected_blocks = []
+    for chromosome in range(1, 23):
+        n_genes = 2 + chromosome % 3
+        gene_ids = [f"ENSG{chromosome:04d}{i:03d}" for i in range(n_genes)]
+        corr = _random_corr(n_genes, chromosome)
+        if chromosome == 7:
+            # not positive definite
+            corr = np.ones((n_genes, n_genes))
+        corr = pd.DataFrame(corr, index=gene_ids, columns=gene_ids)
+        expected_blocks.append(corr)
+
+        # genes in the correlation files are not sorted by position
+        corr.iloc[::-1, ::-1].to_pickle(by_chr_dir / f"gene_corrs-chr{chromosome}.pkl")
+        genes_info.append(pd.DataFrame({"id": gene_ids, "chr": chromosome, "start_position": np.arange(n_genes) * 10}))
+
+    genes_info = pd.concat(genes_info, ignore_index=True)
+    genes_info.to_pickle(tmp_path / "genes_info.pkl")
+
+    monkeypatch.setattr(Gene, "GENE_ID_TO_NAME_MAP", lambda: {g: f"SYM{g[4:]}" for g in genes_info["id"]})
+    return tmp_path, expected_blocks
+
+
+def test_postprocess_assembles_blocks(gene_corrs_by_chr):
+    output_dir, expected_blocks = gene_corrs_by_chr
+
+    postprocess(
+        cohort=Cohort._1000g_eur,
+        reference_panel="1000G",
+        eqtl_model="MASHR",
+        input_dir=output_dir / "by_chr",
+        genes_info=output_dir / "genes_info.pkl",
+        output_dir=output_dir,
+    )
+
+    gene_corrs = pd.read_pickle(output_dir / "gene_corrs-symbols.pkl")
+    genes = [f"SYM{g[4:]}" for b in expected_blocks for g in b.index]
+    assert gene_corrs.index.tolist() == genes
+    assert gene_corrs.columns.tolist() == genes
+
+    start = 0
+    for chromosome, block in enumerate(expected_blocks, start=1):
+        end = start + block.shape[0]
+        corrs = gene_corrs.iloc[start:end, start:end].to_numpy()
+        if chromosome == 7:
+            # adjusted
+            assert np.linalg.eigvalsh(corrs).min() > 0
+            assert np.allclose(np.diag(corrs), 1.0)
+        else:
+            assert np.allclose(corrs, block.to_numpy())
+        # genes in other chromosomes are not correlated
+        assert (gene_corrs.iloc[start:end, end:].to_numpy() == 0.0).all()
+        start = end
+
+    store = GeneCorrsStore(output_dir / "gene_corrs-symbols.gene_corrs").load()
+    assert isinstance(store, BlockDiagCorrMatrix)
+    assert len(store.blocks) == 22
+    pd.testing.assert_frame_equal(store.to_dataframe(), gene_corrs)
@@ -0,0 +1,145 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from phenoplier.gls import GLSPhenoplier
+from phenoplier.gene_corrs_store import GeneCorrsStore
+from phenoplier.whitening import BlockDiagCorrMatrix
+from phenoplier.commands.run.correlation.generate import compute_chol_inv, load_gene_corrs_dict
+
+
+N_GENES = 120
+
+
+def _is_memory_mapped(data):
+    while data is not None:
+        if isinstance(data, np.memmap):
+            return True
+        data = getattr(data, "base", None)
+    return False
+
+
+@pytest.fixture(scope="module")
+def gene_corrs_data():
+    rs = np.random.RandomState(0)
+    genes = [f"GENE{i}" for i in range(N_GENES)]
+
+    gene_corrs = pd.DataFrame(rs.normal(size=(N_GENES * 3, N_GENES)), columns=genes).corr()
+    # genes in three chromosomes (not contiguous in the matrix)
+    gene_chrs = pd.Series(np.arange(N_GENES) % 3 + 1, index=genes)
+    same_chr = gene_chrs.to_numpy()[:, None] == gene_chrs.to_numpy()[None, :]
+
+    return gene_corrs, gene_corrs.where(same_chr, 0.0), gene_chrs
+
+
+def test_store_one_block(gene_corrs_data, tmp_path):
+    gene_corrs, _, gene_chrs = gene_corrs_data
+
+    # genes in different chromosomes are correlated, so only one block is stored
+    store = GeneCorrsStore.write(tmp_path / "gene_corrs.gene_corrs", gene_corrs, gene_chrs)
+    assert GeneCorrsStore.is_store(store.path)
+    assert store.block_labels == [GeneCorrsStore.ALL_GENES_BLOCK]
+    assert store.index.equals(gene_corrs.index)
+
+    loaded = store.load()
+    assert _is_memory_mapped(loaded.to_numpy())
+    pd.testing.assert_frame_equal(loaded, gene_corrs, check_names=False)
+
+    genes = gene_corrs.index[[50, 3, 7]]
+    pd.testing.assert_frame_equal(
+        store.read(genes), gene_corrs.iloc[[3, 7, 50], [3, 7, 50]], check_names=False
+    )
+
+
+def test_store_per_chromosome(gene_corrs_data, tmp_path):
+    _, block_diag_corrs, gene_chrs = gene_corrs_data
+
+    store = GeneCorrsStore.write(tmp_path / "gene_corrs.gene_corrs", block_diag_corrs, gene_chrs)
+    assert store.block_labels == ["1", "2", "3"]
+    assert store.index.equals(block_diag_corrs.index)
+
+    loaded = store.load()
+    assert isinstance(loaded, BlockDiagCorrMatrix)
+    pd.testing.assert_frame_equal(
+        loaded.to_dataframe(), block_diag_corrs.loc[loaded.index, loaded.index], check_names=False
+    )
+
+    genes = block_diag_corrs.index[[51, 3, 7]]
+    sub_corrs = store.read(genes)
+    assert len(sub_corrs.blocks) == 2
+    pd.testing.assert_frame_equal(
+        sub_corrs.to_dataframe(), block_diag_corrs.loc[sub_corrs.index, sub_corrs.index], check_names=False
+    )
+
+    # from a block-diagonal matrix
+    store = GeneCorrsStore.write(tmp_path / "block_diag.gene_corrs", loaded)
+    assert len(store.block_labels) == 3
+    pd.testing.assert_frame_equal(store.load().to_dataframe(), loaded.to_dataframe())
+
+
+def test_store_not_a_store(tmp_path):
+    assert not GeneCorrsStore.is_store(tmp_path)
+    with pytest.raises(ValueError):
+        GeneCorrsStore(tmp_path)
+
+
+@pytest.mark.parametrize("per_chromosome", [False, True])
+def test_gls_and_generate_with_store(gene_corrs_data, tmp_path, per_chromosome):
+    _, block_diag_corrs, gene_chrs = gene_corrs_data
+    rs = np.random.RandomState(1)
+
+    lv_weights = pd.DataFrame(
+        rs.rand(N_GENES, 3), index=block_diag_corrs.index, columns=["LV1", "LV2", "LV3"]
+    )
+    lv_weights_file = tmp_path / "lv_weights.pkl"
+    lv_weights.to_pickle(lv_weights_file)
+    phenotype = pd.Series(rs.normal(size=N_GENES), index=block_diag_corrs.index)
+
+    gene_corrs_file = tmp_path / "gene_corrs.pkl"
+    block_diag_corrs.to_pickle(gene_corrs_file)
+    store = GeneCorrsStore.write(
+        tmp_path / "gene_corrs.gene_corrs", block_diag_corrs, gene_chrs if per_chromosome else None
+    )
+
+    for debug_use_sub_gene_corr in (False, True):
+        results = [
+            GLSPhenoplier(
+                gene_corrs_file_path=path,
+                debug_use_sub_gene_corr=debug_use_sub_gene_corr,
+                use_own_implementation=True,
+                logger=None,
+            ).fit_named_batch(lv_weights.columns, phenotype, lv_weights_file)
+            for path in (gene_corrs_file, store.path)
+        ]
+        pd.testing.assert_frame_equal(results[1], results[0], check_exact=False, rtol=1e-8)
+
+    # LV-specific matrices computed from the store are the same, and they are
+    # named after the pickle file next to the store
+    filename = "gene_corrs-symbols-within_distance_5mb"
+    pickle_dir = tmp_path / "pickle"
+    pickle_dir.mkdir()
+    block_diag_corrs.to_pickle(pickle_dir / f"{filename}.pkl.gz")
+    store_dir = tmp_path / "store"
+    store_dir.mkdir()
+    block_diag_corrs.to_pickle(store_dir / f"{filename}.pkl.gz")
+    GeneCorrsStore.write(
+        store_dir / f"{filename}{GeneCorrsStore.SUFFIX}", block_diag_corrs, gene_chrs if per_chromosome else None
+    )
+    # a store without a pickle file is not used
+    GeneCorrsStore.write(store_dir / f"gene_corrs-symbols{GeneCorrsStore.SUFFIX}", block_diag_corrs, gene_chrs)
+
+    for gene_corrs_dir in (pickle_dir, store_dir):
+        gene_corrs_dict = load_gene_corrs_dict(gene_corrs_dir)
+        assert list(gene_corrs_dict.keys()) == [f"{filename}.pkl.gz"]
+        assert isinstance(gene_corrs_dict[f"{filename}.pkl.gz"], GeneCorrsStore) == (gene_corrs_dir == store_dir)
+
+        compute_chol_inv("LV1", gene_corrs_dict, lv_weights, gene_corrs_dir, "1000g", "mashr", 0.1)
+        assert sorted(f.name for f in gene_corrs_dir.glob("*.per_lv")) == [f"{filename}.pkl.per_lv"]
+
+        gene_names = np.load(gene_corrs_dir / f"{filename}.pkl.per_lv" / "gene_names.npy")
+        assert gene_names.tolist() == block_diag_corrs.index.tolist()
+
+    for base_filename in ("LV1", "LV1_corr_mat"):
+        expected = GLSPhenoplier.load_chol_inv_data(pickle_dir / f"{filename}.pkl.per_lv", base_filename)
+        observed = GLSPhenoplier.load_chol_inv_data(store_dir / f"{filename}.pkl.per_lv", base_filename)
+        assert np.allclose(observed, expected, rtol=0.0, atol=1e-10)
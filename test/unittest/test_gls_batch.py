@@ -0,0 +1,391 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from phenoplier.gls import GLSPhenoplier, GenesAlignment
+from phenoplier.whitening import BlockDiagCorrMatrix
+from phenoplier.commands.run.correlation.generate import compute_chol_inv
+
+
+N_GENES = 300
+N_LVS = 5
+
+
+@pytest.fixture(scope="module")
+def gls_data(tmp_path_factory):
+    rs = np.random.RandomState(0)
+    tmp_path = tmp_path_factory.mktemp("gls")
+
+    genes = [f"GENE{i}" for i in range(N_GENES)]
+
+    # LV weights: a few genes have zero weights in all LVs
+    lv_weights = pd.DataFrame(
+        rs.rand(N_GENES, N_LVS) * (rs.rand(N_GENES, N_LVS) > 0.1),
+        index=genes,
+        columns=[f"LV{i + 1}" for i in range(N_LVS)],
+    )
+    lv_weights_file = tmp_path / "lv_weights.pkl"
+    lv_weights.to_pickle(lv_weights_file)
+
+    # positive definite gene correlation matrix
+    gene_corrs = pd.DataFrame(
+        rs.normal(size=(N_GENES * 3, N_GENES)), columns=genes
+    ).corr()
+    gene_corrs_file = tmp_path / "gene_corrs.pkl"
+    gene_corrs.to_pickle(gene_corrs_file)
+
+    # phenotype with covariates; some genes are not in the LV model
+    phenotype = pd.DataFrame(
+        {
+            "y": rs.normal(size=N_GENES + 10),
+            "gene_size": rs.rand(N_GENES + 10),
+        },
+        index=rs.permutation(genes + [f"OTHER{i}" for i in range(10)]),
+    )
+
+    return lv_weights_file, gene_corrs_file, gene_corrs, phenotype
+
+
+def _fit_each_lv(gls_model, lv_codes, phenotype, lv_weights_file):
+    results = []
+    for lv_code in lv_codes:
+        res = gls_model._fit_named_cli(lv_code, phenotype, lv_weights_file).results
+        results.append(
+            {
+                "lv": lv_code,
+                "beta": res.params.loc["lv"],
+                "beta_se": res.bse.loc["lv"],
+                "t": res.tvalues.loc["lv"],
+                "pvalue_twosided": res.pvalues.loc["lv"],
+                "pvalue": res.pvalues_onesided.loc["lv"],
+            }
+        )
+    return pd.DataFrame(results).set_index("lv")
+
+
+def _assert_batch_equals_each_lv(gls_model, lv_weights_file, phenotype):
+    lv_codes = GLSPhenoplier._get_lv_weights(lv_weights_file).columns.tolist()
+    expected = _fit_each_lv(gls_model, lv_codes, phenotype, lv_weights_file)
+
+    observed = gls_model.fit_named_batch(lv_codes, phenotype, lv_weights_file)
+
+    assert observed.index.tolist() == lv_codes
+    assert observed.index.name == "lv"
+    pd.testing.assert_frame_equal(
+        observed[expected.columns], expected, check_exact=False, rtol=1e-8
+    )
+
+
+@pytest.mark.parametrize("with_covars", [True, False])
+def test_fit_named_batch_ols(gls_data, with_covars):
+    lv_weights_file, _, _, phenotype = gls_data
+    if not with_covars:
+        phenotype = phenotype["y"]
+
+    gls_model = GLSPhenoplier(
+        debug_use_ols=True, use_own_implementation=True, logger=None
+    )
+    _assert_batch_equals_each_lv(gls_model, lv_weights_file, phenotype)
+
+
+@pytest.mark.parametrize("with_covars", [True, False])
+def test_fit_named_batch_full_gene_corrs(gls_data, with_covars):
+    lv_weights_file, gene_corrs_file, _, phenotype = gls_data
+    if not with_covars:
+        phenotype = phenotype["y"]
+
+    gls_model = GLSPhenoplier(
+        gene_corrs_file_path=gene_corrs_file,
+        use_own_implementation=True,
+        logger=None,
+    )
+    _assert_batch_equals_each_lv(gls_model, lv_weights_file, phenotype)
+
+
+def test_fit_named_batch_sub_gene_corrs_file(gls_data):
+    lv_weights_file, gene_corrs_file, _, phenotype = gls_data
+
+    gls_model = GLSPhenoplier(
+        gene_corrs_file_path=gene_corrs_file,
+        debug_use_sub_gene_corr=True,
+        use_own_implementation=True,
+        logger=None,
+    )
+    _assert_batch_equals_each_lv(gls_model, lv_weights_file, phenotype)
+
+
+@pytest.mark.parametrize("all_genes", [True, False])
+def test_fit_named_batch_sub_gene_corrs_dir(gls_data, tmp_path, all_genes):
+    lv_weights_file, _, gene_corrs, phenotype = gls_data
+    lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
+
+    for lv_code in lv_weights.columns:
+        compute_chol_inv(
+            lv_code,
+            {"gene_corrs.pkl": gene_corrs},
+            lv_weights,
+            tmp_path,
+            "1000g",
+            "mashr",
+            GLSPhenoplier.LV_PERC,
+        )
+
+    if not all_genes:
+        # some genes in the LV-specific matrices are missing in the phenotype
+        phenotype = phenotype.drop(index=gene_corrs.index[::7])
+
+    gls_model = GLSPhenoplier(
+        gene_corrs_file_path=tmp_path / "gene_corrs.per_lv",
+        debug_use_sub_gene_corr=True,
+        use_own_implementation=True,
+        logger=None,
+    )
+    _assert_batch_equals_each_lv(gls_model, lv_weights_file, phenotype)
+
+
+@pytest.mark.parametrize("gene_corr_mode", ["ols", "full", "sub_file", "sub_dir"])
+def test_fit_named_batch_traits(gls_data, tmp_path, gene_corr_mode):
+    lv_weights_file, gene_corrs_file, gene_corrs, phenotype = gls_data
+    lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
+    lv_codes = lv_weights.columns.tolist()
+
+    gls_args = {"use_own_implementation": True, "logger": None}
+    if gene_corr_mode == "ols":
+        gls_args["debug_use_ols"] = True
+    elif gene_corr_mode == "full":
+        gls_args["gene_corrs_file_path"] = gene_corrs_file
+    elif gene_corr_mode == "sub_file":
+        gls_args["gene_corrs_file_path"] = gene_corrs_file
+        gls_args["debug_use_sub_gene_corr"] = True
+    else:
+        for lv_code in lv_codes:
+            compute_chol_inv(
+                lv_code,
+                {"gene_corrs.pkl": gene_corrs},
+                lv_weights,
+                tmp_path,
+                "1000g",
+                "mashr",
+                GLSPhenoplier.LV_PERC,
+            )
+        gls_args["gene_corrs_file_path"] = tmp_path / "gene_corrs.per_lv"
+        gls_args["debug_use_sub_gene_corr"] = True
+
+    # traits with different phenotypes and genes (missing values)
+    rs = np.random.RandomState(1)
+    phenotypes = {}
+    for trait_idx in range(4):
+        trait_data = phenotype.assign(y=rs.normal(size=phenotype.shape[0]))
+        if trait_idx % 2 == 1:
+            trait_data.loc[gene_corrs.index[trait_idx::9], "y"] = np.nan
+        phenotypes[f"trait{trait_idx}"] = trait_data
+    phenotypes["trait_no_covars"] = phenotypes["trait0"]["y"]
+
+    observed = GLSPhenoplier(**gls_args).fit_named_batch_traits(
+        lv_codes, phenotypes, lv_weights_file
+    )
+
+    assert list(observed.keys()) == list(phenotypes.keys())
+    for trait_name, trait_data in phenotypes.items():
+        expected = GLSPhenoplier(**gls_args).fit_named_batch(
+            lv_codes, trait_data, lv_weights_file
+        )
+        pd.testing.assert_frame_equal(observed[trait_name], expected)
+
+
+@pytest.mark.parametrize("gene_corr_mode,n_expected", [("ols", 0), ("full", 2), ("sub_file", 0)])
+def test_fit_named_batch_traits_aligns_gene_corrs_once(gls_data, monkeypatch, gene_corr_mode, n_expected):
+    lv_weights_file, gene_corrs_file, gene_corrs, phenotype = gls_data
+    lv_codes = GLSPhenoplier._get_lv_weights(lv_weights_file).columns.tolist()
+
+    gls_args = {"gene_corrs_file_path": gene_corrs_file, "use_own_implementation": True, "logger": None}
+    if gene_corr_mode == "ols":
+        gls_args["debug_use_ols"] = True
+    elif gene_corr_mode == "sub_file":
+        gls_args["debug_use_sub_gene_corr"] = True
+
+    aligned_genes = []
+    align_gene_correlations = GenesAlignment.align_gene_correlations
+
+    def _align_gene_correlations(self, gene_correlations):
+        aligned_genes.append(self.genes)
+        return align_gene_correlations(self, gene_correlations)
+
+    monkeypatch.setattr(GenesAlignment, "align_gene_correlations", _align_gene_correlations)
+
+    # two sets of genes, alternating
+    rs = np.random.RandomState(2)
+    phenotypes = {}
+    for trait_idx in range(6):
+        trait_data = phenotype.assign(y=rs.normal(size=phenotype.shape[0]))
+        if trait_idx % 2 == 1:
+            trait_data.loc[gene_corrs.index[::7], "y"] = np.nan
+        phenotypes[f"trait{trait_idx}"] = trait_data
+
+    GLSPhenoplier(**gls_args).fit_named_batch_traits(lv_codes, phenotypes, lv_weights_file)
+
+    # the aligned gene correlations are only computed for the full matrix, once for each set of genes
+    assert len(aligned_genes) == n_expected
+
+
+@pytest.mark.parametrize("gene_corr_mode", ["sub_file", "sub_dir"])
+def test_fit_named_batch_traits_n_jobs(gls_data, tmp_path, gene_corr_mode):
+    lv_weights_file, gene_corrs_file, gene_corrs, phenotype = gls_data
+    lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
+    lv_codes = lv_weights.columns.tolist()
+
+    gene_corrs_file_path = gene_corrs_file
+    if gene_corr_mode == "sub_dir":
+        for lv_code in lv_codes:
+            compute_chol_inv(
+                lv_code,
+                {"gene_corrs.pkl": gene_corrs},
+                lv_weights,
+                tmp_path,
+                "1000g",
+                "mashr",
+                GLSPhenoplier.LV_PERC,
+            )
+        gene_corrs_file_path = tmp_path / "gene_corrs.per_lv"
+
+    phenotypes = {
+        "trait0": phenotype,
+        "trait1": phenotype["y"].drop(index=gene_corrs.index[::7]),
+    }
+
+    def _fit(n_jobs):
+        return GLSPhenoplier(
+            gene_corrs_file_path=gene_corrs_file_path,
+            debug_use_sub_gene_corr=True,
+            use_own_implementation=True,
+            n_jobs=n_jobs,
+            logger=None,
+        ).fit_named_batch_traits(lv_codes, phenotypes, lv_weights_file)
+
+    expected = _fit(1)
+    # more processes than LVs
+    for n_jobs in (2, N_LVS + 2):
+        observed = _fit(n_jobs)
+        assert list(observed.keys()) == list(expected.keys())
+        for trait_name in expected:
+            pd.testing.assert_frame_equal(observed[trait_name], expected[trait_name])
+
+
+@pytest.mark.parametrize("gene_corr_mode", ["full", "sub_file", "sub_dir"])
+def test_fit_block_diag_gene_corrs(gls_data, tmp_path, gene_corr_mode):
+    lv_weights_file, _, gene_corrs, phenotype = gls_data
+    lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
+    lv_codes = lv_weights.columns.tolist()
+
+    # genes in three "chromosomes" (not contiguous in the matrix)
+    gene_chrs = pd.Series(np.arange(N_GENES) % 3, index=gene_corrs.index)
+    same_chr = gene_chrs.to_numpy()[:, None] == gene_chrs.to_numpy()[None, :]
+    dense_corrs = gene_corrs.where(same_chr, 0.0)
+    block_diag_corrs = BlockDiagCorrMatrix.from_dataframe(dense_corrs, gene_chrs)
+    assert len(block_diag_corrs.blocks) == 3
+
+    results = []
+    for name, corrs in (("dense", dense_corrs), ("block_diag", block_diag_corrs)):
+        gene_corrs_file_path = tmp_path / f"{name}.pkl"
+        pd.to_pickle(corrs, gene_corrs_file_path)
+
+        if gene_corr_mode == "sub_dir":
+            for lv_code in lv_codes:
+                compute_chol_inv(
+                    lv_code,
+                    {f"{name}.pkl": corrs},
+                    lv_weights,
+                    tmp_path,
+                    "1000g",
+                    "mashr",
+                    GLSPhenoplier.LV_PERC,
+                )
+            gene_corrs_file_path = tmp_path / f"{name}.per_lv"
+
+        gls_model = GLSPhenoplier(
+            gene_corrs_file_path=gene_corrs_file_path,
+            debug_use_sub_gene_corr=gene_corr_mode != "full",
+            use_own_implementation=True,
+            logger=None,
+        )
+        results.append(
+            (
+                gls_model.fit_named_batch(lv_codes, phenotype, lv_weights_file),
+                _fit_each_lv(gls_model, lv_codes[:2], phenotype, lv_weights_file),
+            )
+        )
+
+    for dense_results, block_diag_results in zip(*results):
+        pd.testing.assert_frame_equal(block_diag_results, dense_results, check_exact=False, rtol=1e-8)
+
+
+@pytest.mark.parametrize("block_diag", [False, True])
+def test_fit_banded_gene_corrs(gls_data, tmp_path, block_diag):
+    lv_weights_file, _, gene_corrs, phenotype = gls_data
+    lv_codes = GLSPhenoplier._get_lv_weights(lv_weights_file).columns.tolist()
+
+    # genes are only correlated with the closest ones
+    rs = np.random.RandomState(2)
+    factor = np.eye(N_GENES) * 3.0
+    for k in range(1, 10):
+        factor[np.arange(k, N_GENES), np.arange(N_GENES - k)] = rs.normal(size=N_GENES - k)
+    cov = factor @ factor.T
+    std = np.sqrt(np.diag(cov))
+    banded_corrs = pd.DataFrame(cov / np.outer(std, std), index=gene_corrs.index, columns=gene_corrs.index)
+    if block_diag:
+        banded_corrs = BlockDiagCorrMatrix.from_dataframe(banded_corrs)
+
+    gene_corrs_file = tmp_path / "gene_corrs.pkl"
+    pd.to_pickle(banded_corrs, gene_corrs_file)
+
+    results = []
+    for use_banded_gene_corrs in (False, True):
+        gls_model = GLSPhenoplier(
+            gene_corrs_file_path=gene_corrs_file,
+            use_own_implementation=True,
+            use_banded_gene_corrs=use_banded_gene_corrs,
+            logger=None,
+        )
+        results.append(gls_model.fit_named_batch(lv_codes, phenotype, lv_weights_file))
+
+    pd.testing.assert_frame_equal(results[1], results[0], check_exact=False, rtol=1e-8)
+
+
+@pytest.mark.parametrize("with_gene_corrs", [True, False])
+def test_match_and_align_genes(gls_data, with_gene_corrs):
+    lv_weights_file, _, gene_corrs, phenotype = gls_data
+    lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file).iloc[::-1]
+    phenotype = phenotype.drop(index=gene_corrs.index[::5])
+    if not with_gene_corrs:
+        gene_corrs = None
+
+    y, x, corrs = GLSPhenoplier.match_and_align_genes(phenotype, lv_weights, gene_corrs)
+
+    # genes in the order of the gene correlation matrix, or the phenotype
+    common_genes = phenotype.index.intersection(lv_weights.index)
+    if with_gene_corrs:
+        common_genes = [g for g in gene_corrs.index if g in common_genes]
+        pd.testing.assert_frame_equal(corrs, gene_corrs.loc[common_genes, common_genes])
+    else:
+        assert corrs is None
+    pd.testing.assert_frame_equal(y, phenotype.loc[common_genes])
+    pd.testing.assert_frame_equal(x, lv_weights.loc[common_genes])
+
+
+def test_genes_alignment_is_reused(gls_data):
+    lv_weights_file, gene_corrs_file, gene_corrs, phenotype = gls_data
+    lv_weights = GLSPhenoplier._get_lv_weights(lv_weights_file)
+
+    gls_model = GLSPhenoplier(gene_corrs_file_path=gene_corrs_file, logger=None)
+
+    alignment = gls_model._get_genes_alignment(phenotype, lv_weights["LV1"], gene_corrs)
+    assert isinstance(alignment, GenesAlignment)
+    # same genes (another LV)
+    assert gls_model._get_genes_alignment(phenotype.copy(), lv_weights["LV2"], gene_corrs) is alignment
+    assert gls_model._get_genes_alignment(phenotype, lv_weights["LV1"], None) is not alignment
+
+    # different genes
+    phenotype = phenotype.iloc[1:]
+    new_alignment = gls_model._get_genes_alignment(phenotype, lv_weights["LV1"], gene_corrs)
+    assert new_alignment is not alignment
+    assert new_alignment.genes.shape[0] == alignment.genes.shape[0] - 1
@@ -0,0 +1,187 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from phenoplier.config import settings as conf
+from phenoplier.entity import Gene
+from phenoplier.variant_set import VariantSet
+import phenoplier.prediction_weights
+from phenoplier.prediction_weights import PredictionWeightsIndex, connect_tissue_weights
+
+
+MODEL_TYPE = "TEST_MODEL"
+
+WEIGHTS = {
+    "Whole_Blood": pd.DataFrame(
+        {
+            "gene": ["ENSG00000000001.5", "ENSG00000000001.5", "ENSG00000000002.1", "ENSG00000000003.2"],
+            "varID": ["chr1_300_A_C_b38", "chr1_100_A_C_b38", "chr1_200_G_T_b38", "chr2_100_A_C_b38"],
+            "weight": [0.5, -0.25, 0.1, 0.0],
+        }
+    ),
+    "Liver": pd.DataFrame(
+        {
+            "gene": ["ENSG00000000002.1", "ENSG00000000001.5"],
+            "varID": ["chr1_200_G_T_b38", "chr1_300_A_C_b38"],
+            "weight": [-0.3, 0.7],
+        }
+    ),
+}
+
+
+def _write_model(models_dir):
+    for tissue, df in WEIGHTS.items():
+        conn = sqlite3.connect(models_dir / f"test_{tissue}.db")
+        df.to_sql("weights", conn, index=False)
+        conn.close()
+
+
+@pytest.fixture
+def prediction_model(tmp_path, monkeypatch):
+    models_dir = tmp_path / "models"
+    models_dir.mkdir()
+    _write_model(models_dir)
+
+    monkeypatch.setitem(conf.TWAS["PREDICTION_MODELS"], MODEL_TYPE, str(models_dir))
+    monkeypatch.setitem(conf.TWAS["PREDICTION_MODELS"], f"{MODEL_TYPE}_PREFIX", "test_")
+    monkeypatch.setattr(phenoplier.prediction_weights, "get_cache_dir", lambda: tmp_path / "cache")
+    monkeypatch.setattr(PredictionWeightsIndex, "_loaded", {})
+
+    return models_dir
+
+
+def test_prediction_weights_index(prediction_model):
+    index = PredictionWeightsIndex.build(MODEL_TYPE)
+
+    assert index.genes.tolist() == ["ENSG00000000001", "ENSG00000000002", "ENSG00000000003"]
+    assert index.tissues.tolist() == ["Liver", "Whole_Blood"]
+
+    w = index.get_weights("ENSG00000000001", "Whole_Blood")
+    assert w.index.tolist() == ["chr1_100_A_C_b38", "chr1_300_A_C_b38"]
+    assert w.tolist() == [-0.25, 0.5]
+
+    w = index.get_weights("ENSG00000000002", "Liver")
+    assert w.index.tolist() == ["chr1_200_G_T_b38"]
+    assert w.tolist() == [-0.3]
+
+    assert index.get_weights("ENSG00000000003", "Liver").shape[0] == 0
+    assert index.get_weights("ENSG00000000004", "Liver").shape[0] == 0
+
+    with pytest.raises(ValueError):
+        index.get_weights("ENSG00000000001", "NonExistent")
+
+
+def test_prediction_weights_index_cache_file(prediction_model):
+    cache_file = PredictionWeightsIndex.get_cache_file(MODEL_TYPE)
+    assert not cache_file.exists()
+
+    index = PredictionWeightsIndex.get(MODEL_TYPE)
+    assert cache_file.exists()
+    assert PredictionWeightsIndex.get(MODEL_TYPE) is index
+
+    loaded = PredictionWeightsIndex.load(cache_file)
+    for k in PredictionWeightsIndex.ARRAYS:
+        assert np.array_equal(getattr(loaded, k), getattr(index, k))
+
+    # if the prediction models change, the index is built again
+    WEIGHTS["Liver"].to_sql(
+        "weights", sqlite3.connect(prediction_model / "test_Liver.db"), index=False, if_exists="append"
+    )
+    PredictionWeightsIndex._loaded.clear()
+    index = PredictionWeightsIndex.get(MODEL_TYPE)
+    assert index.get_weights("ENSG00000000002", "Liver").shape[0] == 2
+
+
+def test_gene_get_prediction_weights_from_index(prediction_model):
+    gene = Gene.__new__(Gene)
+    gene.ensembl_id = "ENSG00000000001"
+
+    w = gene.get_prediction_weights("Whole_Blood", MODEL_TYPE)
+    assert w.name == "weight"
+    assert w.index.tolist() == ["chr1_100_A_C_b38", "chr1_300_A_C_b38"]
+
+    w = gene.get_prediction_weights(
+        "Whole_Blood", MODEL_TYPE, snps_subset=frozenset({"chr1_300_A_C_b38", "chr1_999_A_C_b38"})
+    )
+    assert w.to_dict() == {"chr1_300_A_C_b38": 0.5}
+
+    assert gene.get_prediction_weights("Whole_Blood", MODEL_TYPE, snps_subset=frozenset({"chr1_999_A_C_b38"})) is None
+
+    # weights are all zero
+    gene = Gene.__new__(Gene)
+    gene.ensembl_id = "ENSG00000000003"
+    assert gene.get_prediction_weights("Whole_Blood", MODEL_TYPE) is None
+    assert gene.get_prediction_weights("Liver", MODEL_TYPE) is None
+
+
+def test_connect_tissue_weights(prediction_model):
+    conn = connect_tissue_weights("Liver", MODEL_TYPE)
+    try:
+        assert pd.read_sql("select count(*) as n from weights", conn)["n"].iloc[0] > 0
+        # connections are read-only
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute("delete from weights")
+    finally:
+        conn.close()
+
+    with pytest.raises(ValueError):
+        connect_tissue_weights("NonExistent", MODEL_TYPE)
+
+
+def test_prediction_weights_index_codes(prediction_model):
+    index = PredictionWeightsIndex.build(MODEL_TYPE)
+    assert index.variants.tolist() == sorted(index.variants.tolist())
+
+    variant_codes, weights = index.get_weights_codes("ENSG00000000001", "Whole_Blood")
+    assert index.variants[variant_codes].tolist() == ["chr1_100_A_C_b38", "chr1_300_A_C_b38"]
+    assert weights.tolist() == [-0.25, 0.5]
+
+    start, end = index.get_chromosome_codes("chr1")
+    assert index.variants[start:end].tolist() == ["chr1_100_A_C_b38", "chr1_200_G_T_b38", "chr1_300_A_C_b38"]
+    start, end = index.get_chromosome_codes("chr2")
+    assert index.variants[start:end].tolist() == ["chr2_100_A_C_b38"]
+    assert index.get_chromosome_codes("chr10")[0] == index.get_chromosome_codes("chr10")[1]
+
+    mask = index.get_variants_mask(frozenset({"chr1_200_G_T_b38", "chr3_1_A_C_b38"}))
+    assert index.variants[mask].tolist() == ["chr1_200_G_T_b38"]
+
+    # same mask with a VariantSet
+    variants = VariantSet.from_ids({"chr1_200_G_T_b38", "chr3_1_A_C_b38"})
+    assert np.array_equal(index.get_variants_mask(variants), mask)
+
+
+def test_gene_get_prediction_weights_variant_set(prediction_model):
+    gene = Gene.__new__(Gene)
+    gene.ensembl_id = "ENSG00000000001"
+
+    w = gene.get_prediction_weights(
+        "Whole_Blood", MODEL_TYPE, snps_subset=VariantSet.from_ids(["chr1_300_A_C_b38", "chr1_999_A_C_b38"])
+    )
+    assert w.to_dict() == {"chr1_300_A_C_b38": 0.5}
+
+    variants = VariantSet.from_ids(["chr1_999_A_C_b38"])
+    assert gene.get_prediction_weights("Whole_Blood", MODEL_TYPE, snps_subset=variants) is None
+
+
+def test_prediction_weights_index_inventory(prediction_model):
+    index = PredictionWeightsIndex.build(MODEL_TYPE)
+
+    inventory = index.get_inventory()
+    assert inventory.shape[0] == sum(df.shape[0] for df in WEIGHTS.values())
+    for c in ("gene", "tissue", "varID"):
+        assert isinstance(inventory[c].dtype, pd.CategoricalDtype)
+
+    expected = pd.concat([df.assign(tissue=t) for t, df in WEIGHTS.items()], ignore_index=True)
+    expected = expected.assign(gene=expected["gene"].str.split(".").str[0])
+    expected = expected.sort_values(["gene", "tissue", "varID"], ignore_index=True)
+    pd.testing.assert_frame_equal(
+        inventory.astype({"gene": object, "tissue": object, "varID": object}),
+        expected[["gene", "tissue", "varID", "weight"]],
+    )
+
+    variants_info = index.get_variants_info()
+    assert variants_info["varID"].tolist() == index.variants.tolist()
+    assert variants_info.iloc[1].tolist() == ["chr1_200_G_T_b38", 1, 200, "G", "T"]
+    assert variants_info["chr"].tolist() == [1, 1, 1, 2]
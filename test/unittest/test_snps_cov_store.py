@@ -0,0 +1,126 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from phenoplier.snps_cov_store import BlockDiagonalCov, SnpsCovStore, get_snps_positions
+
+
+def _snps_cov_data(chrom, n_snps, seed):
+    rs = np.random.RandomState(seed)
+    snps_ids = [f"chr{chrom}_{p}_A_C_b38" for p in rs.choice(10**6, size=n_snps, replace=False)]
+    cov = np.cov(rs.normal(size=(n_snps * 2, n_snps)), rowvar=False)
+    # in the HDF5 file, SNPs are not sorted
+    return pd.DataFrame(cov, index=snps_ids, columns=snps_ids)
+
+
+@pytest.fixture
+def snps_cov_file(tmp_path):
+    output_file = tmp_path / "snps_chr_blocks_cov.h5"
+    with pd.HDFStore(output_file, mode="w", complevel=4) as store:
+        for chrom, n_snps in ((1, 30), (2, 20), (3, 10)):
+            store.put(f"chr{chrom}", _snps_cov_data(chrom, n_snps, chrom), format="fixed")
+    return output_file
+
+
+def test_snps_cov_store_same_as_hdf5(snps_cov_file):
+    store = SnpsCovStore(snps_cov_file)
+
+    for snps_chr in ("chr2", "chr1", "chr3"):
+        snps_cov, variants = store.get(snps_chr)
+
+        with pd.HDFStore(snps_cov_file, mode="r") as h5:
+            expected = h5[snps_chr].sort_index(axis=0).sort_index(axis=1)
+
+        assert isinstance(snps_cov, np.memmap)
+        assert variants.tolist() == expected.index.tolist()
+        assert np.array_equal(snps_cov, expected.to_numpy())
+
+    assert (snps_cov_file.parent / "snps_chr_blocks_cov.mmap" / "chr1.npy").exists()
+    assert (snps_cov_file.parent / "snps_chr_blocks_cov.mmap" / "chr1_variants.npy").exists()
+
+    # all chromosomes are kept open
+    assert list(store._open.keys()) == ["chr2", "chr1", "chr3"]
+    assert store.get("chr2")[0] is store.get("chr2")[0]
+
+
+def test_snps_cov_store_max_bytes(snps_cov_file):
+    chr1_bytes = sum(a.nbytes for a in SnpsCovStore(snps_cov_file).get("chr1"))
+    store = SnpsCovStore(snps_cov_file, max_bytes=chr1_bytes + 10)
+
+    store.get("chr1")
+    store.get("chr3")
+    assert list(store._open.keys()) == ["chr3"]
+    store.get("chr2")
+    store.get("chr3")
+    assert list(store._open.keys()) == ["chr2", "chr3"]
+    assert store.open_bytes <= chr1_bytes + 10
+
+    # a chromosome larger than max_bytes is kept open anyway
+    store.get("chr1")
+    assert list(store._open.keys()) == ["chr1"]
+
+
+def test_snps_cov_store_converted_again_if_hdf5_changes(snps_cov_file):
+    SnpsCovStore(snps_cov_file).get("chr3")
+
+    new_data = _snps_cov_data(3, 5, 100)
+    with pd.HDFStore(snps_cov_file, mode="a") as store:
+        store.put("chr3", new_data, format="fixed")
+    mtime = snps_cov_file.stat().st_mtime + 10
+    os.utime(snps_cov_file, (mtime, mtime))
+
+    snps_cov, variants = SnpsCovStore(snps_cov_file).get("chr3")
+    assert variants.tolist() == sorted(new_data.index)
+
+
+def test_snps_cov_store_get_positions(snps_cov_file):
+    store = SnpsCovStore(snps_cov_file)
+    variants = store.get("chr2")[1]
+
+    snps_ids = [variants[5], "chr2_1_A_C_b38", variants[0], variants[-1], "chr2_99999999_A_C_b38"]
+    assert store.get_positions("chr2", snps_ids).tolist() == [5, -1, 0, variants.shape[0] - 1, -1]
+
+    assert get_snps_positions(np.array([], dtype=str), ["chr2_1_A_C_b38"]).tolist() == [-1]
+    assert get_snps_positions(variants, []).shape == (0,)
+
+
+def test_snps_cov_store_ld_blocks(snps_cov_file):
+    # chr4 has the covariances of three LD blocks only
+    blocks_data = [_snps_cov_data(4, n_snps, 10 + n_snps) for n_snps in (4, 2, 5)]
+    snps_blocks = pd.DataFrame(
+        {"block": np.repeat(np.arange(len(blocks_data)), [b.shape[0] for b in blocks_data])},
+        index=pd.Index(np.concatenate([b.index for b in blocks_data]), name="varID"),
+    )
+    blocks_cov = pd.Series(np.concatenate([b.to_numpy().ravel() for b in blocks_data]))
+    with pd.HDFStore(snps_cov_file, mode="a") as store:
+        store.put("chr4_blocks", snps_blocks, format="fixed")
+        store.put("chr4_blocks_cov", blocks_cov, format="fixed")
+
+    store = SnpsCovStore(snps_cov_file)
+    snps_cov, variants = store.get("chr4")
+    assert isinstance(snps_cov, BlockDiagonalCov)
+    assert snps_cov.shape == (11, 11)
+    assert variants.tolist() == sorted(snps_blocks.index)
+    # chromosomes without LD blocks are not affected
+    assert isinstance(store.get("chr1")[0], np.memmap)
+
+    expected = pd.DataFrame(0.0, index=snps_blocks.index, columns=snps_blocks.index)
+    for b in blocks_data:
+        expected.loc[b.index, b.columns] = b
+    expected = expected.loc[variants, variants].to_numpy()
+
+    rs = np.random.RandomState(0)
+    for rows, cols in ((np.arange(11), np.arange(11)), (rs.choice(11, 5), rs.choice(11, 7)), ([3], [])):
+        assert np.array_equal(snps_cov[np.ix_(rows, cols)], expected[np.ix_(rows, cols)])
+
+
+def test_block_diagonal_cov_reads_blocks():
+    data = np.arange(1 + 4, dtype=float)
+    blocks = np.array([[1, 1], [0, 0], [1, 0]])
+    snps_cov = BlockDiagonalCov(data, blocks)
+
+    assert snps_cov.get_block(0).tolist() == [[0.0]]
+    assert snps_cov.get_block(1).tolist() == [[1.0, 2.0], [3.0, 4.0]]
+    assert snps_cov[np.ix_([0, 1, 2], [0, 1, 2])].tolist() == [[4.0, 0.0, 3.0], [0.0, 0.0, 0.0], [2.0, 0.0, 1.0]]
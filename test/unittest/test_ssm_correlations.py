@@ -0,0 +1,353 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from phenoplier.config import settings as conf
+from phenoplier.entity import Gene
+from phenoplier.gene_svd_cache import GeneSvdCache
+import phenoplier.prediction_weights
+from phenoplier.prediction_weights import PredictionWeightsIndex
+from phenoplier.ssm_correlations import (
+    compute_ssm_projection,
+    get_gene_ssm_projection,
+    get_gene_svd,
+    get_ssm_projection_from_svd,
+    compute_ssm_correlations,
+    get_genes_within_distance,
+    get_gene_pairs_within_distance,
+    get_gene_n_snps,
+    get_correlation_shards,
+    compute_ssm_correlations_blocks,
+    compute_ssm_correlations_window,
+    get_genes_window_ends,
+    merge_ssm_correlations_blocks,
+)
+
+
+N_SNPS = 60
+TISSUES = ("Whole_Blood", "Liver", "Brain_Cortex", "Lung")
+
+
+def _snps_cov():
+    rs = np.random.RandomState(0)
+    # correlated genotypes of nearby SNPs
+    genotypes = rs.normal(size=(300, N_SNPS))
+    genotypes = genotypes + 0.8 * np.roll(genotypes, 1, axis=1)
+    snps_ids = [f"chr1_{1000 + i * 10}_A_C_b38" for i in range(N_SNPS)]
+    return np.cov(genotypes, rowvar=False), snps_ids
+
+
+def _genes_weights(snps_ids):
+    """
+    Returns the prediction weights of some genes in each tissue (None if the
+    gene has no model in the tissue).
+    """
+    rs = np.random.RandomState(1)
+    genes_weights = []
+    for gene_idx in range(7):
+        tissues_weights = {}
+        for tissue in TISSUES:
+            if rs.uniform() < 0.2:
+                tissues_weights[tissue] = None
+                continue
+            gene_snps = rs.choice(snps_ids[gene_idx * 6 : gene_idx * 6 + 15], size=4, replace=False)
+            tissues_weights[tissue] = pd.Series(rs.normal(size=4), index=gene_snps).sort_index()
+        genes_weights.append(tissues_weights)
+
+    # a gene without prediction models
+    genes_weights[3] = {t: None for t in TISSUES}
+    # a tissue with SNPs that are not in the reference panel
+    genes_weights[5]["Liver"] = pd.Series([0.5, -0.2], index=["chr1_1_A_C_b38", "chr1_2_A_C_b38"])
+
+    return genes_weights
+
+
+@pytest.fixture
+def genes(tmp_path, monkeypatch):
+    snps_cov, snps_ids = _snps_cov()
+    snps_cov_variants = np.array(snps_ids)
+    genes_weights = _genes_weights(snps_ids)
+
+    genes = []
+    for gene_idx in range(len(genes_weights)):
+        gene = Gene.__new__(Gene)
+        gene.ensembl_id = f"ENSG{gene_idx:011d}"
+        gene.name = f"GENE{gene_idx}"
+        genes.append(gene)
+
+    # prediction models
+    models_dir = tmp_path / "models"
+    models_dir.mkdir()
+    for tissue in TISSUES:
+        tissue_weights = pd.concat(
+            [
+                pd.DataFrame({"gene": f"{g.ensembl_id}.1", "varID": w.index, "weight": w.to_numpy()})
+                for g, gene_weights in zip(genes, genes_weights)
+                if (w := gene_weights[tissue]) is not None
+            ]
+        )
+        with sqlite3.connect(models_dir / f"test_{tissue}.db") as conn:
+            tissue_weights.to_sql("weights", conn, index=False)
+
+    monkeypatch.setitem(conf.TWAS["PREDICTION_MODELS"], "MASHR", str(models_dir))
+    monkeypatch.setitem(conf.TWAS["PREDICTION_MODELS"], "MASHR_PREFIX", "test_")
+    monkeypatch.setattr(phenoplier.prediction_weights, "get_cache_dir", lambda: tmp_path / "cache")
+    monkeypatch.setattr(PredictionWeightsIndex, "_loaded", {})
+    Gene._get_chromosome_cov_positions.cache_clear()
+
+    monkeypatch.setattr(Gene, "chromosome", property(lambda self: "1"))
+    monkeypatch.setattr(Gene, "get_attribute", lambda self, attribute_name: 1000)
+    monkeypatch.setattr(
+        Gene,
+        "_read_snps_cov",
+        staticmethod(lambda snps_chr, reference_panel, model_type: (snps_cov, snps_cov_variants)),
+    )
+
+    yield genes, genes_weights, snps_cov, snps_cov_variants
+
+    Gene._get_chromosome_cov_positions.cache_clear()
+
+
+def _get_projections(genes_weights, snps_cov, snps_cov_variants, condition_number=30):
+    return [
+        compute_ssm_projection(
+            [w for w in tissues_weights.values() if w is not None],
+            snps_cov,
+            snps_cov_variants,
+            condition_number,
+        )
+        if any(w is not None for w in tissues_weights.values())
+        else None
+        for tissues_weights in genes_weights
+    ]
+
+
+def _get_expected_correlations(genes, **kwargs):
+    expected = np.zeros((len(genes), len(genes)))
+    for i, gene_i in enumerate(genes):
+        for j, gene_j in enumerate(genes):
+            r = gene_i.get_ssm_correlation(
+                gene_j,
+                tissues=TISSUES,
+                other_tissues=TISSUES,
+                use_within_distance=False,
+                **kwargs,
+            )
+            expected[i, j] = 0.0 if r is None else r
+    return expected
+
+
+@pytest.mark.parametrize("max_batch_n_snps", [1, 20, 2048])
+def test_compute_ssm_correlations_same_as_pairs(genes, max_batch_n_snps):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    projections = _get_projections(genes_weights, snps_cov, snps_cov_variants)
+    assert projections[3] is None
+
+    res = compute_ssm_correlations(projections, snps_cov, max_batch_n_snps=max_batch_n_snps)
+    expected = _get_expected_correlations(genes)
+
+    assert res.shape == (len(genes), len(genes))
+    assert np.allclose(res, expected, rtol=0.0, atol=1e-10)
+    assert np.allclose(res, res.T)
+    assert np.allclose(np.delete(np.diag(res), 3), 1.0)
+    assert np.all(res[3] == 0.0)
+
+
+def test_compute_ssm_correlations_with_condition_number(genes):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    projections = _get_projections(genes_weights, snps_cov, snps_cov_variants, condition_number=2)
+    res = compute_ssm_correlations(projections, snps_cov)
+    expected = _get_expected_correlations(genes, condition_number=2)
+
+    assert np.allclose(res, expected, rtol=0.0, atol=1e-10)
+
+
+def test_compute_ssm_correlations_other_genes(genes):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    projections = _get_projections(genes_weights, snps_cov, snps_cov_variants)
+    full = compute_ssm_correlations(projections, snps_cov)
+
+    res = compute_ssm_correlations(
+        projections[:3], snps_cov, other_projections=projections[2:], max_batch_n_snps=10
+    )
+    assert res.shape == (3, len(genes) - 2)
+    assert np.allclose(res, full[:3, 2:], rtol=0.0, atol=1e-10)
+
+
+def test_get_genes_within_distance(monkeypatch):
+    positions = {
+        "GENE0": (100, 200),
+        "GENE1": (2_000_000, 2_100_000),
+        "GENE2": (6_000_000, 6_500_000),
+        "GENE3": (None, None),
+        "GENE4": (10_900_000, 11_000_000),
+    }
+    genes = []
+    for name in positions:
+        gene = Gene.__new__(Gene)
+        gene.name = name
+        genes.append(gene)
+
+    def _get_attribute(self, attribute_name):
+        return positions[self.name][0 if attribute_name == "start_position" else 1]
+
+    monkeypatch.setattr(Gene, "get_attribute", _get_attribute)
+
+    res = get_genes_within_distance(genes)
+    expected = np.array([[g1.within_distance(g2) for g2 in genes] for g1 in genes])
+    assert np.array_equal(res, expected)
+    assert res[0, 1] and not res[0, 2] and res[2, 4]
+    assert not res[3].any()
+
+    # only some pairs
+    rows, cols = np.triu_indices(len(genes))
+    assert np.array_equal(get_gene_pairs_within_distance(genes, rows, cols), res[rows, cols])
+
+
+def test_get_gene_ssm_projection(genes):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    projections = _get_projections(genes_weights, snps_cov, snps_cov_variants)
+    for gene, expected in zip(genes, projections):
+        projection = get_gene_ssm_projection(gene, tissues=TISSUES)
+        if expected is None:
+            assert projection is None
+            continue
+        assert np.array_equal(projection[0], expected[0])
+        assert np.allclose(projection[1], expected[1])
+
+
+@pytest.mark.parametrize("n_shards", [1, 2, 3, 5])
+def test_get_correlation_shards(n_shards):
+    genes_n_snps = np.random.RandomState(0).randint(0, 50, size=40)
+
+    blocks, shards = get_correlation_shards(genes_n_snps, n_shards)
+    assert len(shards) == n_shards
+    assert blocks[0][0] == 0 and blocks[-1][1] == 40
+    assert all(blocks[i][1] == blocks[i + 1][0] for i in range(len(blocks) - 1))
+
+    # each pair of blocks in the upper triangle is in one shard only
+    all_pairs = sorted(p for pairs in shards for p in pairs)
+    assert all_pairs == [(i, j) for i in range(len(blocks)) for j in range(i, len(blocks))]
+    if n_shards > 1:
+        assert all(len(pairs) > 0 for pairs in shards)
+
+    # the same shards are computed again (by another process)
+    assert get_correlation_shards(genes_n_snps, n_shards) == (blocks, shards)
+
+
+def test_compute_ssm_correlations_by_shards(genes):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    projections = _get_projections(genes_weights, snps_cov, snps_cov_variants)
+    full = compute_ssm_correlations(projections, snps_cov)
+
+    genes_n_snps = [get_gene_n_snps(g, tissues=TISSUES) for g in genes]
+    assert genes_n_snps[3] == 0
+    assert genes_n_snps[0] == np.unique(np.concatenate([w.index for w in genes_weights[0].values() if w is not None])).shape[0]
+
+    blocks, shards = get_correlation_shards(genes_n_snps, 3, blocks_per_shard=2)
+    blocks_data = {}
+    for block_pairs in shards:
+        blocks_data.update(compute_ssm_correlations_blocks(projections, snps_cov, blocks, block_pairs))
+
+    res = merge_ssm_correlations_blocks(blocks, blocks_data)
+    assert np.allclose(res, full, rtol=0.0, atol=1e-10)
+
+    blocks_data.pop(shards[0][0])
+    with pytest.raises(ValueError):
+        merge_ssm_correlations_blocks(blocks, blocks_data)
+
+
+@pytest.mark.parametrize("max_batch_n_genes", [1, 3, 256])
+def test_compute_ssm_correlations_window(genes, max_batch_n_genes):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    projections = _get_projections(genes_weights, snps_cov, snps_cov_variants)
+    full = compute_ssm_correlations(projections, snps_cov)
+
+    starts = np.array([100, 1_000, 3_000_000, 3_100_000, 7_000_000, 7_500_000, 20_000_000])
+    ends = starts + np.array([500, 200_000, 1000, 3_000_000, 1000, 100, 1000])
+    distance_bp = 1e6
+
+    res = compute_ssm_correlations_window(
+        projections, snps_cov, starts, ends, distance_bp, max_batch_n_genes=max_batch_n_genes
+    )
+    assert sparse.issparse(res)
+
+    positions = {g.name: (s, e) for g, s, e in zip(genes, starts, ends)}
+    for gene in genes:
+        gene.get_attribute = lambda attribute_name, g=gene: positions[g.name][0 if attribute_name == "start_position" else 1]
+    within_distance = get_genes_within_distance(genes, distance_bp)
+    assert not within_distance.all()
+
+    assert np.allclose(res.toarray(), np.where(within_distance, full, 0.0), rtol=0.0, atol=1e-10)
+    # pairs beyond the window are not stored
+    assert not np.any(res.toarray()[~within_distance])
+    assert res.nnz <= within_distance.sum()
+
+
+def test_get_genes_window_ends():
+    starts = np.array([0, 10, 20, 100])
+    ends = np.array([50, 15, 25, 110])
+
+    assert get_genes_window_ends(starts, ends, 0).tolist() == [3, 2, 3, 4]
+    assert get_genes_window_ends(starts, ends, 40).tolist() == [4, 3, 4, 4]
+
+    with pytest.raises(ValueError):
+        get_genes_window_ends(starts[::-1], ends[::-1], 0)
+
+
+def test_get_gene_svd(genes):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+
+    for gene, tissues_weights in zip(genes, genes_weights):
+        gene_svd = get_gene_svd(gene, tissues=TISSUES)
+        if gene_svd is None:
+            assert all(w is None for w in tissues_weights.values())
+            continue
+
+        # same as Gene.get_tissues_correlations_svd (with all singular values) and Gene.get_pred_expression_variance
+        u, s, vt = gene.get_tissues_correlations_svd(tissues=TISSUES, condition_number=1e10)
+        assert np.allclose(gene_svd["s"], s)
+        assert np.allclose(np.abs(gene_svd["u"]), np.abs(u))
+        for tissue, variance in zip(gene_svd["tissues"], gene_svd["variances"]):
+            assert np.isclose(variance, gene.get_pred_expression_variance(tissue, "GTEX_V8", "MASHR"))
+
+        for condition_number in (2, 30):
+            snps_idx, proj = get_ssm_projection_from_svd(gene_svd, condition_number)
+            expected = get_gene_ssm_projection(gene, tissues=TISSUES, condition_number=condition_number)
+            assert np.array_equal(snps_idx, expected[0])
+            assert np.allclose(proj, expected[1])
+
+
+def test_gene_svd_cache(genes, tmp_path):
+    genes, genes_weights, snps_cov, snps_cov_variants = genes
+    snps_subset = frozenset(snps_cov_variants[:40])
+
+    genes_svd = {g.ensembl_id: get_gene_svd(g, tissues=TISSUES, snps_subset=snps_subset) for g in genes}
+    cache = GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, snps_subset, "1000G", "MASHR")
+    cache.write(1, genes_svd)
+
+    loaded = GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, snps_subset, "1000g", "MASHR").load(1)
+    assert loaded.keys() == genes_svd.keys()
+    assert loaded[genes[3].ensembl_id] is None
+    assert np.array_equal(loaded[genes[0].ensembl_id]["vt"], genes_svd[genes[0].ensembl_id]["vt"])
+    assert GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, snps_subset, "1000G", "MASHR").load(2) == {}
+
+    # SVDs computed with other SNPs or reference panel are not used
+    other_subset = frozenset(snps_cov_variants[:30])
+    assert GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, other_subset, "1000G", "MASHR").load(1) == {}
+    assert GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, snps_subset, "GTEX_V8", "MASHR").load(1) == {}
+    # nor SVDs written with another condition number
+    assert GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, snps_subset, "1000G", "MASHR", 10).load(1) == {}
+    assert GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, snps_subset, "1000G", "MASHR", 30.0).load(1).keys() == genes_svd.keys()
+    # SNPs not in the prediction models do not change the key
+    extended_subset = snps_subset | {"chr1_99999999_A_C_b38"}
+    assert GeneSvdCache(tmp_path / GeneSvdCache.FOLDER, extended_subset, "1000G", "MASHR").load(1).keys() == genes_svd.keys()
@@ -0,0 +1,46 @@
+import numpy as np
+
+from phenoplier.variant_set import VariantSet
+
+
+def test_variant_set_contains():
+    variants = VariantSet.from_ids(
+        ["chr1_100_A_C_b38", "chr1_100_A_G_b38", "chrX_5000_T_TA_b38", "chr22_50000000_G_T_b38", "rs12345"]
+    )
+    assert len(variants) == 5
+
+    assert "chr1_100_A_C_b38" in variants
+    assert "chrX_5000_T_TA_b38" in variants
+    assert "rs12345" in variants
+    assert "chr1_100_A_T_b38" not in variants
+    assert "chr2_100_A_C_b38" not in variants
+    assert "chrY_5000_T_TA_b38" not in variants
+    assert "rs1234" not in variants
+
+    res = variants.contains(["chr22_50000000_G_T_b38", "chr22_50000001_G_T_b38", "chr1_100_A_G_b38"])
+    assert res.tolist() == [True, False, True]
+
+    assert variants.contains([]).shape == (0,)
+    assert VariantSet.from_ids([]).contains(["chr1_100_A_C_b38"]).tolist() == [False]
+
+
+def test_variant_set_encode():
+    keys = VariantSet.encode(["chr1_100_A_C_b38", "chr1_101_A_C_b38", "chr2_1_A_C_b38", "chr1_100_A_C_b38"])
+    assert keys.dtype == np.uint64
+    # keys are ordered by chromosome and position
+    assert keys[0] < keys[1] < keys[2]
+    assert keys[0] == keys[3]
+
+    # duplicated IDs are removed
+    assert len(VariantSet(keys)) == 3
+
+
+def test_variant_set_save_and_load(tmp_path):
+    variants = VariantSet.from_ids(["chr3_300_G_A_b38", "chr1_100_A_C_b38", "chrM_10_A_C_b38"])
+    output_file = tmp_path / "variants.npy"
+    variants.save(output_file)
+
+    loaded = VariantSet.load(output_file)
+    assert np.array_equal(loaded.keys, variants.keys)
+    assert "chrM_10_A_C_b38" in loaded
+    assert "chr3_300_G_A_b38" in loaded
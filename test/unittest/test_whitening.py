@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from phenoplier.whitening import (
+    CholeskyWhitener,
+    BlockWhitener,
+    BlockDiagCorrMatrix,
+    BandedCholeskyWhitener,
+    chol_update,
+    chol_delete,
+)
+
+
+N = 50
+
+
+@pytest.fixture(scope="module")
+def corr_matrix():
+    rs = np.random.RandomState(0)
+    return np.corrcoef(rs.normal(size=(N * 3, N)), rowvar=False)
+
+
+def test_cholesky_whitener_same_as_inverse(corr_matrix):
+    rs = np.random.RandomState(1)
+    data = rs.normal(size=(N, 4))
+
+    whitener = CholeskyWhitener.from_corr_matrix(corr_matrix)
+    chol_inv = np.linalg.inv(np.linalg.cholesky(corr_matrix))
+
+    assert whitener.shape == (N, N)
+    assert np.allclose(whitener @ data, chol_inv @ data, rtol=0.0, atol=1e-10)
+    assert np.allclose(whitener @ data[:, 0], chol_inv @ data[:, 0], rtol=0.0, atol=1e-10)
+    assert np.allclose(whitener.to_inverse(), chol_inv, rtol=0.0, atol=1e-10)
+    assert np.allclose(whitener.to_corr_matrix(), corr_matrix, rtol=0.0, atol=1e-10)
+
+
+def test_cholesky_whitener_not_pos_def(corr_matrix):
+    corr_matrix = corr_matrix.copy()
+    corr_matrix[0, 1] = corr_matrix[1, 0] = 2.0
+
+    with pytest.raises(np.linalg.LinAlgError):
+        CholeskyWhitener.from_corr_matrix(corr_matrix)
+
+
+@pytest.mark.parametrize("block_size", [0, 1, 10])
+def test_block_whitener_same_as_dense(corr_matrix, block_size):
+    rs = np.random.RandomState(2)
+    size = N + 20
+    data = rs.normal(size=(size, 3))
+    block_idx = np.sort(rs.choice(size, block_size, replace=False))
+
+    dense_corr = np.eye(size)
+    dense_corr[np.ix_(block_idx, block_idx)] = corr_matrix[:block_size, :block_size]
+
+    whitener = BlockWhitener(
+        size, block_idx, CholeskyWhitener.from_corr_matrix(corr_matrix[:block_size, :block_size])
+    )
+
+    expected = np.linalg.inv(np.linalg.cholesky(dense_corr)) @ data
+    data_w = whitener @ data
+    assert np.allclose(data_w, expected, rtol=0.0, atol=1e-10)
+    # input data is not modified
+    assert not np.shares_memory(data_w, data)
+
+
+@pytest.mark.parametrize("downdate", [False, True])
+def test_chol_update(corr_matrix, downdate):
+    rs = np.random.RandomState(3)
+    x = rs.normal(scale=0.1, size=N)
+
+    sign = -1.0 if downdate else 1.0
+    expected = np.linalg.cholesky(corr_matrix + sign * np.outer(x, x))
+
+    chol_factor = np.linalg.cholesky(corr_matrix)
+    assert np.allclose(chol_update(chol_factor, x, downdate), expected, rtol=0.0, atol=1e-10)
+
+
+def test_chol_update_downdate_not_pos_def(corr_matrix):
+    x = np.zeros(N)
+    x[0] = 2.0
+
+    with pytest.raises(np.linalg.LinAlgError):
+        chol_update(np.linalg.cholesky(corr_matrix), x, downdate=True)
+
+
+@pytest.mark.parametrize("delete_idx", [[0], [N - 1], [5, 17], [0, 3, 4, 30, N - 1]])
+def test_chol_delete(corr_matrix, delete_idx):
+    keep_idx = np.setdiff1d(np.arange(N), delete_idx)
+    expected = np.linalg.cholesky(corr_matrix[np.ix_(keep_idx, keep_idx)])
+
+    whitener = CholeskyWhitener.from_corr_matrix(corr_matrix)
+    assert np.allclose(chol_delete(whitener.chol_factor, np.array(delete_idx)), expected, rtol=0.0, atol=1e-10)
+    assert np.allclose(whitener.delete(delete_idx).chol_factor, expected, rtol=0.0, atol=1e-10)
+    # original factor is not modified
+    assert np.array_equal(whitener.chol_factor, np.linalg.cholesky(corr_matrix))
+
+
+@pytest.fixture(scope="module")
+def block_diag_corr_matrix(corr_matrix):
+    # genes in three groups, not contiguous in the matrix
+    genes = [f"GENE{i}" for i in range(N)]
+    gene_groups = pd.Series(np.arange(N) % 3, index=genes)
+    same_group = gene_groups.to_numpy()[:, None] == gene_groups.to_numpy()[None, :]
+
+    return pd.DataFrame(np.where(same_group, corr_matrix, 0.0), index=genes, columns=genes), gene_groups
+
+
+@pytest.mark.parametrize("use_groups", [True, False])
+def test_block_diag_corr_matrix(block_diag_corr_matrix, use_groups):
+    dense_corrs, gene_groups = block_diag_corr_matrix
+
+    corrs = BlockDiagCorrMatrix.from_dataframe(dense_corrs, gene_groups if use_groups else None)
+
+    assert len(corrs.blocks) == 3
+    assert corrs.shape == (N, N)
+    assert corrs.index.tolist() == [g for k in range(3) for g in dense_corrs.index[k::3]]
+    pd.testing.assert_frame_equal(corrs.to_dataframe(), dense_corrs.loc[corrs.index, corrs.index])
+    # genes in the original order
+    pd.testing.assert_frame_equal(corrs.to_dataframe(dense_corrs.index), dense_corrs)
+
+    # subset keeps the order of the matrix and removes empty blocks
+    genes = corrs.index[[20, 3, 2]]
+    sub_corrs = corrs.subset(genes)
+    assert len(sub_corrs.blocks) == 2
+    assert sub_corrs.index.tolist() == corrs.index[[2, 3, 20]].tolist()
+    pd.testing.assert_frame_equal(sub_corrs.to_dataframe(), dense_corrs.loc[sub_corrs.index, sub_corrs.index])
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_block_diag_whitener_same_as_dense(block_diag_corr_matrix, n_jobs):
+    dense_corrs, gene_groups = block_diag_corr_matrix
+    corrs = BlockDiagCorrMatrix.from_dataframe(dense_corrs, gene_groups)
+    dense_corrs = corrs.to_dataframe().to_numpy()
+
+    rs = np.random.RandomState(4)
+    data = rs.normal(size=(N, 3))
+
+    whitener = corrs.whitener(n_jobs)
+    expected = np.linalg.inv(np.linalg.cholesky(dense_corrs)) @ data
+    assert np.allclose(whitener @ data, expected, rtol=0.0, atol=1e-10)
+
+
+@pytest.fixture(scope="module")
+def banded_corr_matrix():
+    # correlation matrix with bandwidth 5
+    rs = np.random.RandomState(5)
+    n = 200
+    factor = np.eye(n) * 3.0
+    for k in range(1, 6):
+        factor[np.arange(k, n), np.arange(n - k)] = rs.normal(scale=0.5, size=n - k)
+    cov = factor @ factor.T
+    std = np.sqrt(np.diag(cov))
+    return cov / np.outer(std, std)
+
+
+def _assert_equivalent_whitening(data_w, expected):
+    # whitened data can differ in an orthogonal transformation
+    assert np.allclose(data_w.T @ data_w, expected.T @ expected, rtol=0.0, atol=1e-8)
+
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_banded_whitener_same_as_dense(banded_corr_matrix, shuffle):
+    rs = np.random.RandomState(6)
+    n = banded_corr_matrix.shape[0]
+    data = rs.normal(size=(n, 3))
+
+    perm = rs.permutation(n) if shuffle else np.arange(n)
+    corr_matrix = banded_corr_matrix[np.ix_(perm, perm)]
+    data = data[perm]
+    expected = np.linalg.inv(np.linalg.cholesky(corr_matrix)) @ data
+
+    whitener = BandedCholeskyWhitener.from_corr_matrix(pd.DataFrame(corr_matrix))
+    # genes are reordered only if they are not sorted
+    assert (whitener.perm is not None) == shuffle
+    assert whitener.bandwidth == 5
+    assert whitener.shape == (n, n)
+
+    data_w = whitener @ data
+    assert data_w.shape == data.shape
+    _assert_equivalent_whitening(data_w, expected)
+    assert np.allclose(whitener @ data[:, 0], data_w[:, 0], rtol=0.0, atol=1e-12)
+    if not shuffle:
+        assert np.allclose(data_w, expected, rtol=0.0, atol=1e-10)
+
+
+def test_banded_whitener_not_pos_def(banded_corr_matrix):
+    corr_matrix = banded_corr_matrix.copy()
+    corr_matrix[0, 1] = corr_matrix[1, 0] = 2.0
+
+    with pytest.raises(np.linalg.LinAlgError):
+        BandedCholeskyWhitener.from_corr_matrix(corr_matrix)
+
+
+def test_block_diag_banded_whitener(block_diag_corr_matrix):
+    dense_corrs, gene_groups = block_diag_corr_matrix
+    corrs = BlockDiagCorrMatrix.from_dataframe(dense_corrs, gene_groups)
+
+    rs = np.random.RandomState(7)
+    data = rs.normal(size=(N, 3))
+
+    expected = corrs.whitener() @ data
+    _assert_equivalent_whitening(corrs.whitener(banded=True) @ data, expected)